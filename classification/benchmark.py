@@ -0,0 +1,444 @@
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    Benchmarks of the classification pipeline on synthetic data.
+    To launch from the classification folder, e.g.:
+    $ python3 -c "from benchmark import *; bench_csr_assembly()"
+    $ python3 -c "from benchmark import *; bench_traversals()"
+    $ python3 -c "from benchmark import *; bench_value_contexts()"
+    $ python3 -c "from benchmark import *; bench_selection()"
+    $ python3 -c "from benchmark import *; bench_results('/tmp/results')"
+    $ python3 -c "from benchmark import *; bench_batching()"
+    $ python3 -c "from benchmark import *; bench_compiled('/tmp/compiled')"
+    $ python3 -c "from benchmark import *; bench_ensemble('JS_DIR/Analysis/PDG')"
+    $ python3 -c "from benchmark import *; bench_out_of_core('/tmp/stores')"
+    $ python3 -c "from benchmark import *; bench_import()"
+"""
+
+import os
+import sys
+import pickle
+import timeit
+import asyncio
+import itertools
+import subprocess
+import numpy as np
+from scipy import sparse
+
+import features_space
+import features_ngrams
+import features_value
+import features_counting
+import features_selection
+import training_set
+import machine_learning
+import compiled_forest
+import service
+import utility
+
+
+def get_random_rows(nb_samples, nb_features, nnz, seed=0):
+    """ Yields nb_samples (indices, data) rows with nnz non-zero entries each on average. """
+
+    rng = np.random.RandomState(seed)
+    for _ in range(nb_samples):
+        row_nnz = rng.randint(0, 2 * nnz + 1)
+        indices = np.unique(rng.randint(0, nb_features, row_nnz)).astype(np.int32)
+        yield indices, rng.random_sample(len(indices))
+
+
+def bench_csr_assembly(nb_samples_list=(100000, 1000000), nb_features=100000, nnz=20,
+                       vstack_max=5000):
+    """
+        Time to assemble nb_samples rows into a CSR matrix with features_space.CsrBuilder,
+        compared to the former repeated sparse.vstack (only measured up to vstack_max samples,
+        as it is quadratic).
+    """
+
+    nb_vstack = min(vstack_max, min(nb_samples_list))
+    rows = list(get_random_rows(nb_vstack, nb_features, nnz))
+    start = timeit.default_timer()
+    concat_features = None
+    for indices, data in rows:
+        row = sparse.csr_matrix((data, indices, [0, len(indices)]), shape=(1, nb_features))
+        concat_features = sparse.vstack((concat_features, row), format='csr')
+    print('vstack: ' + str(nb_vstack) + ' samples in '
+          + str(timeit.default_timer() - start) + 's')
+
+    for nb_samples in nb_samples_list:
+        rows = list(get_random_rows(nb_samples, nb_features, nnz))
+        start = timeit.default_timer()
+        csr_builder = features_space.CsrBuilder(nb_features)
+        for indices, data in rows:
+            csr_builder.add_row(indices, data)
+        csr = csr_builder.get_csr()
+        print('CsrBuilder: ' + str(nb_samples) + ' samples (' + str(csr.nnz) + ' non-zero) in '
+              + str(timeit.default_timer() - start) + 's')
+
+
+def get_deep_pdg(depth):
+    """ Synthetic PDG: a chain of depth ExpressionStatement nodes (each one with an Identifier
+    child), every statement depending on the next one through control and data flows. """
+
+    root = features_ngrams._node.Node('Program')
+    parent, previous = root, None
+    for i in range(depth):
+        statement = features_ngrams._node.Node('ExpressionStatement', parent)
+        identifier = features_ngrams._node.Node('Identifier', statement)
+        identifier.set_attribute('name', 'x' + str(i % 10))
+        statement.set_child(identifier)
+        parent.set_child(statement)
+        if previous is not None:
+            previous.control_dep_children.append(
+                features_ngrams._node.Dependence('control dependency', statement, True))
+            previous.data_dep_children.append(
+                features_ngrams._node.Dependence('data dependency', statement, 'data',
+                                                 previous.children[0], identifier))
+        parent, previous = statement, statement
+    return root
+
+
+def get_random_pdg(nb_nodes, depth_bias=0.9, seed=0):
+    """ Synthetic AST looking like a minified file: nb_nodes nested expressions, each new node
+    being a child of the last one with probability depth_bias, of a random one otherwise. """
+
+    names = ['CallExpression', 'MemberExpression', 'BinaryExpression', 'ConditionalExpression',
+             'Identifier', 'Literal', 'SequenceExpression', 'AssignmentExpression']
+    rng = np.random.RandomState(seed)
+    inner_nodes = [features_ngrams._node.Node('Program')]  # Identifiers and Literals are leaves
+    for i in range(nb_nodes):
+        if rng.random_sample() < depth_bias:
+            parent = inner_nodes[-1]
+        else:
+            parent = inner_nodes[rng.randint(len(inner_nodes))]
+        node = features_ngrams._node.Node(names[rng.randint(len(names))], parent)
+        if node.name == 'Identifier':
+            node.set_attribute('name', 'v' + str(i % 50))
+        elif node.name == 'Literal':
+            node.set_attribute('value', i % 7)
+        else:
+            inner_nodes.append(node)
+        parent.set_child(node)
+    return inner_nodes[0]
+
+
+def bench_traversals(depth_list=(1000, 10000, 100000), levels=('ast', 'cfg', 'pdg-dfg', 'pdg')):
+    """ Time to extract the n-grams and value units of deep PDGs, for each level. """
+
+    for depth in depth_list:
+        pdg = get_deep_pdg(depth)
+        for level in levels:
+            for features_module in (features_ngrams, features_value):
+                start = timeit.default_timer()
+                features_list = features_module.get_syntactic_features(pdg, level)
+                print(features_module.__name__ + ' ' + level + ', depth ' + str(depth) + ': '
+                      + str(len(features_list)) + ' units in '
+                      + str(timeit.default_timer() - start) + 's')
+
+
+def bench_value_contexts(nb_nodes_list=(10000, 100000, 1000000), search_max=10000):
+    """
+        Time to get the (context, value) of every node of large minified-like ASTs, with the
+        single bottom-up pass of features_value.get_first_identifiers, compared to one
+        search_identifier per node (only measured up to search_max nodes, as it is quadratic
+        on deep trees). Also times the 'ast' value units extraction.
+    """
+
+    for nb_nodes in nb_nodes_list:
+        pdg = get_random_pdg(nb_nodes)
+        nodes, stack = list(), [pdg]
+        while stack:
+            nodes.append(stack.pop())
+            stack.extend(nodes[-1].children)
+
+        if nb_nodes <= search_max:
+            start = timeit.default_timer()
+            for node in nodes:
+                features_value.get_context_value(node)
+            print('search_identifier: ' + str(nb_nodes) + ' nodes in '
+                  + str(timeit.default_timer() - start) + 's')
+
+        start = timeit.default_timer()
+        first_identifiers = features_value.get_first_identifiers(pdg)
+        for node in nodes:
+            features_value.get_context(node, first_identifiers)
+        print('get_first_identifiers: ' + str(nb_nodes) + ' nodes in '
+              + str(timeit.default_timer() - start) + 's')
+
+        start = timeit.default_timer()
+        features_list = features_value.get_syntactic_features(pdg, 'ast')
+        print('value units (ast): ' + str(len(features_list)) + ' units in '
+              + str(timeit.default_timer() - start) + 's')
+
+
+def bench_selection(nb_features_list=(100000, 1000000), nb_samples=1000, seed=0):
+    """
+        Times the features selection with each criterion (features_selection.get_selection_report)
+        on random contingency tables of nb_samples samples.
+    """
+
+    rng = np.random.default_rng(seed)
+    for nb_features in nb_features_list:
+        ben_with = rng.integers(0, nb_samples // 2, nb_features)
+        mal_with = rng.integers(0, nb_samples // 2, nb_features)
+        analyzed_features_dict = dict(enumerate(np.stack(
+            [ben_with, nb_samples // 2 - ben_with, mal_with, nb_samples // 2 - mal_with],
+            axis=1).tolist()))
+        report, _ = features_selection.get_selection_report(analyzed_features_dict, 99)
+        for criterion in features_selection.CRITERIA:
+            print(criterion + ': ' + str(report[criterion]['selected']) + ' features selected out '
+                  + 'of ' + str(nb_features) + ' in ' + str(report[criterion]['time']) + 's')
+
+
+def bench_results(results_dir, nb_samples_list=(100000, 1000000), seed=0):
+    """
+        Times the post-processing of the predictions of nb_samples samples: thresholding
+        (machine_learning.predict_labels_using_threshold) and writing the results in CSV and
+        JSON Lines files of results_dir (machine_learning.write_results).
+    """
+
+    rng = np.random.default_rng(seed)
+    for nb_samples in nb_samples_list:
+        proba_malicious = rng.random(nb_samples)
+        labels_predicted_proba = np.stack([1 - proba_malicious, proba_malicious], axis=1)
+        names = ['/data/js/sample' + str(i) + '.js' for i in range(nb_samples)]
+        labels = ['?'] * nb_samples
+        confidence = rng.integers(250, 501, nb_samples) / 500
+
+        start = timeit.default_timer()
+        labels_predicted = machine_learning.predict_labels_using_threshold(
+            nb_samples, labels_predicted_proba, 0.5)
+        print('thresholding: ' + str(nb_samples) + ' samples in '
+              + str(timeit.default_timer() - start) + 's')
+
+        for extension in ('.csv', '.jsonl'):
+            results_path = os.path.join(results_dir, 'results' + str(nb_samples) + extension)
+            start = timeit.default_timer()
+            machine_learning.write_results(results_path, names, labels, labels_predicted,
+                                           labels_predicted_proba, confidence)
+            print(extension[1:] + ': ' + str(nb_samples) + ' samples (' +
+                  str(os.path.getsize(results_path) // 2 ** 20) + ' MB) in '
+                  + str(timeit.default_timer() - start) + 's')
+
+
+def get_random_model(nb_samples, nb_features, estimators):
+    """ Forest of estimators trees trained on nb_samples random rows, with the rows. """
+
+    rows = list(get_random_rows(nb_samples, nb_features, 20))
+    csr_builder = features_space.CsrBuilder(nb_features)
+    for indices, data in rows:
+        csr_builder.add_row(indices, data)
+    labels = ['malicious' if (indices < 50).any() else 'benign' for indices, _ in rows]
+    model = machine_learning.classifier_choice(estimators).fit(csr_builder.get_csr(), labels)
+    return model, rows
+
+
+async def run_clients(batcher, rows, concurrency):
+    """ concurrency clients sending the rows one after the other to batcher. Returns the
+    latency of each request. """
+
+    latencies = list()
+
+    async def client(client_rows):
+        for row in client_rows:
+            start = timeit.default_timer()
+            await batcher.predict_proba(row)
+            latencies.append(timeit.default_timer() - start)
+
+    await asyncio.gather(*[client(rows[i::concurrency]) for i in range(concurrency)])
+    batcher.close()
+    return latencies
+
+
+def bench_batching(nb_requests=512, concurrency_list=(1, 16, 64), max_batch_list=(1, 16, 64),
+                   max_wait=0.005, nb_features=1000, estimators=500):
+    """
+        Latency and throughput of the service's predictions (service.MicroBatcher) depending
+        on the number of concurrent requests and on the maximum batch size, with a forest of
+        estimators trees trained on random data.
+    """
+
+    model, rows = get_random_model(max(2000, nb_requests), nb_features, estimators)
+    rows = rows[:nb_requests]
+
+    for concurrency in concurrency_list:
+        for max_batch in max_batch_list:
+            batcher = service.MicroBatcher(model, nb_features, max_batch, max_wait)
+            start = timeit.default_timer()
+            latencies = np.array(asyncio.run(run_clients(batcher, rows, concurrency)))
+            elapsed = timeit.default_timer() - start
+            print('concurrency ' + str(concurrency) + ', max_batch ' + str(max_batch) + ': '
+                  + str(round(nb_requests / elapsed)) + ' requests/s, latency p50 '
+                  + str(round(np.percentile(latencies, 50) * 1000, 1)) + 'ms, p99 '
+                  + str(round(np.percentile(latencies, 99) * 1000, 1)) + 'ms')
+
+
+def bench_compiled(compiled_dir, batch_size_list=(1, 16, 256, 4096), nb_features=1000,
+                   estimators=500, repeat=10):
+    """
+        Loading time and latency of a forest of estimators trees compiled in compiled_dir
+        (compiled_forest.py) vs the pickled forest, with the largest difference between their
+        probabilities.
+    """
+
+    model, _ = get_random_model(2000, nb_features, estimators)
+    model_path = os.path.join(compiled_dir, 'model')
+    utility.check_folder_exists(model_path)
+    pickle.dump(model, open(model_path, 'wb'))
+    compiled_forest.export_model(model_path, os.path.join(compiled_dir, 'compiled'))
+
+    start = timeit.default_timer()
+    model = machine_learning.load_model(model_path)
+    print('pickle loading: ' + str(round((timeit.default_timer() - start) * 1000, 1)) + 'ms')
+    start = timeit.default_timer()
+    compiled = machine_learning.load_model(os.path.join(compiled_dir, 'compiled'))
+    print('compiled loading: ' + str(round((timeit.default_timer() - start) * 1000, 1)) + 'ms')
+
+    csr_builder = features_space.CsrBuilder(nb_features)
+    for indices, data in get_random_rows(max(batch_size_list), nb_features, 20, seed=1):
+        csr_builder.add_row(indices, data)
+    attributes = csr_builder.get_csr()
+    for batch_size in batch_size_list:
+        batch = attributes[:batch_size]
+        print('batch ' + str(batch_size) + ': max difference '
+              + str(np.abs(model.predict_proba(batch) - compiled.predict_proba(batch)).max()))
+        for name, forest in [('sklearn', model), ('compiled', compiled)]:
+            start = timeit.default_timer()
+            for _ in range(repeat):
+                forest.predict_proba(batch)
+            print('    ' + name + ': ' + str(round((timeit.default_timer() - start) / repeat
+                                                    * 1000, 2)) + 'ms')
+
+
+def time_units_modules(pdg_paths, units_modules, repeat=3):
+    """ Best time of repeat runs of features_counting.get_units_modules on all pdg_paths. """
+
+    times = list()
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        for pdg_path in pdg_paths:
+            features_counting.get_units_modules(None, pdg_path, units_modules)
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+
+def bench_ensemble(pdg_dir, units_modules=(('ast', 'ngrams'), ('ast', 'value'),
+                                           ('pdg-dfg', 'ngrams'), ('pdg', 'value'))):
+    """
+        Time to extract the units of the PDGs stored in pdg_dir (e.g. by
+        pdg_generation/pdgs_generation.py) for each module alone, compared to all modules at
+        once with features_counting.get_units_modules, as the ensemble does.
+    """
+
+    pdg_paths = [os.path.join(pdg_dir, pdg_name) for pdg_name in sorted(os.listdir(pdg_dir))]
+    times = list()
+    for units_module in units_modules:
+        times.append(time_units_modules(pdg_paths, [units_module]))
+        print(units_module[0] + ':' + units_module[1] + ' alone: ' + str(len(pdg_paths))
+              + ' PDGs in ' + str(times[-1]) + 's')
+    print('Modules one by one: ' + str(sum(times)) + 's, most expensive one: ' + str(max(times))
+          + 's')
+    print('All modules at once: ' + str(time_units_modules(pdg_paths, list(units_modules)))
+          + 's')
+
+
+def build_random_store(store_path, nb_samples, nb_features, nnz=20, batch_size=10000):
+    """ Training set (see training_set.py) of nb_samples random rows, appended by batches; a
+    row is malicious if it has a multiple of 31 among its columns (about half of them). """
+
+    features2int_dict_path = store_path + '_features'  # Only its digest matters
+    with open(features2int_dict_path, 'w') as features_file:
+        features_file.write(str(nb_features))
+    rows = get_random_rows(nb_samples, nb_features, nnz)
+
+    def iter_chunks():
+        for start in range(0, nb_samples, batch_size):
+            csr_builder, labels = features_space.CsrBuilder(nb_features), list()
+            for indices, data in itertools.islice(rows, batch_size):
+                csr_builder.add_row(indices, data)
+                labels.append('malicious' if (indices % 31 == 0).any() else 'benign')
+            indptr, indices, data = csr_builder.get_arrays()
+            yield [[str(i) for i in range(start, start + len(labels))], labels, indptr, indices,
+                   data]
+
+    training_set.append_chunks(store_path, iter_chunks(), features2int_dict_path, nb_features)
+
+
+def get_fit_peak_memory(store_path, estimators, shard_size=None):
+    """ Peak memory (MB) of a new process training a forest on the training set store_path,
+    out of core by shards of shard_size samples, or in memory if shard_size is None. """
+
+    if shard_size is None:
+        fit = 'names, attributes, labels = training_set.load_training_set(%r); '\
+              'machine_learning.classifier_choice(%d).fit(attributes, labels)'\
+              % (store_path, estimators)
+    else:
+        fit = 'machine_learning.fit_out_of_core(%r, %d, %d)' % (store_path, estimators,
+                                                               shard_size)
+    code = 'import training_set, machine_learning, utility; ' + fit\
+        + '; print(utility.get_peak_memory())'
+    output = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(output.stdout.decode('utf-8').split()[-1])
+
+
+def bench_out_of_core(stores_dir, nb_samples_list=(50000, 100000, 200000), nb_features=2 ** 20,
+                      estimators=20, shard_size=25000):
+    """
+        Peak memory of the out-of-core training (machine_learning.fit_out_of_core) on random
+        training sets of doubling sizes, compared to the training in memory: the former should
+        stay flat, as only one shard of shard_size samples is loaded at a time.
+    """
+
+    os.makedirs(stores_dir, exist_ok=True)
+    for nb_samples in nb_samples_list:
+        store_path = os.path.join(stores_dir, 'store' + str(nb_samples))
+        if training_set.load_store_meta(store_path) is None:
+            build_random_store(store_path, nb_samples, nb_features)
+        for mode, mode_shard_size in [('in memory', None), ('out of core', shard_size)]:
+            start = timeit.default_timer()
+            peak_memory = get_fit_peak_memory(store_path, estimators, mode_shard_size)
+            print(str(nb_samples) + ' samples, ' + mode + ': peak memory ' + str(peak_memory)
+                  + ' MB, in ' + str(timeit.default_timer() - start) + 's')
+
+
+def get_import_time(module, dependencies):
+    """ Time to import module in a new process, and which of dependencies it imported. """
+
+    code = 'import sys, timeit; start = timeit.default_timer(); import ' + module\
+        + '; print(timeit.default_timer() - start, *[int(dependency in sys.modules) for '\
+        + 'dependency in ' + repr(list(dependencies)) + '])'
+    output = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    res = output.stdout.decode('utf-8').split()[-1 - len(dependencies):]
+    return float(res[0]), [dependency for dependency, imported in zip(dependencies, res[1:])
+                           if imported == '1']
+
+
+def bench_import(modules=('jstap', 'learner', 'classifier', 'machine_learning',
+                          'features_selection', 'static_analysis', 'evaluation'),
+                 dependencies=('numpy', 'scipy.sparse', 'scipy.stats', 'sklearn',
+                               'pdgs_generation'), repeat=5):
+    """ Import time of the entry points of JStap (best of repeat new processes), and the heavy
+    dependencies they import: sklearn and scipy.stats are only imported to train or select
+    features, the PDGs generation to build a PDG. """
+
+    for module in modules:
+        times, imported = list(), list()
+        for _ in range(repeat):
+            import_time, imported = get_import_time(module, dependencies)
+            times.append(import_time)
+        print(module + ': ' + str(round(1000 * min(times), 1)) + 'ms, imports '
+              + (', '.join(imported) or 'none of ' + ', '.join(dependencies)))
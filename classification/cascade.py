@@ -0,0 +1,227 @@
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    Early-exit cascade over several modules, the cheapest first (e.g. tokens, which needs no
+    PDG, then the PDG-based modules): each stage only classifies the samples whose probability
+    of being malicious, combined over the stages already run, is still in the uncertain band.
+    The PDGs and the costlier modules are thus only computed for the uncertain samples.
+"""
+
+import sys
+import shutil
+import timeit
+import logging
+from functools import partial
+import numpy as np
+
+import parallel
+import features_space
+import static_analysis
+import machine_learning
+
+
+BANDS = ['0.2:0.8']  # Per default, the samples with a probability in ]0.2, 0.8[ go on
+COMBINE = ['last', 'mean', 'max']
+
+
+def get_bands(bands_specs, nb_stages):
+    """ Parses the 'low:high' uncertain bands, either one for all stages or one per stage but
+    the last. Returns the list of (low, high) per stage but the last, or None if not valid. """
+
+    try:
+        bands = [tuple(float(bound) for bound in band_spec.split(':'))
+                 for band_spec in bands_specs]
+    except ValueError:
+        bands = None
+    if bands is None or any(len(band) != 2 or not 0 <= band[0] <= band[1] <= 1
+                            for band in bands):
+        logging.error('Expected LOW:HIGH bands with 0 <= LOW <= HIGH <= 1, got %s', bands_specs)
+        return None
+    if len(bands) == 1:
+        return bands * (nb_stages - 1)
+    if len(bands) != nb_stages - 1:
+        logging.error('Expected one band, or one per stage but the last (%s), got %s',
+                      str(nb_stages - 1), str(len(bands)))
+        return None
+    return bands
+
+
+def combine_proba(stages_proba, combine='last'):
+    """
+        Combines the probabilities of being malicious given by the stages run.
+
+        -------
+        Parameters:
+        - stages_proba: np.array
+            (n_stages, n_samples) probabilities, nan for the stages which did not score a sample.
+        - combine: str
+            'last' (probability of the last stage which scored the sample), 'mean' or 'max' (of
+            the probabilities of the stages which scored the sample).
+
+        -------
+        Returns:
+        - np.array
+            Combined probability per sample, nan if no stage scored it.
+    """
+
+    scored = ~np.isnan(stages_proba)
+    nb_scored = scored.sum(axis=0)
+    if combine == 'mean':
+        combined = np.where(scored, stages_proba, 0).sum(axis=0) / np.maximum(nb_scored, 1)
+    elif combine == 'max':
+        combined = np.where(scored, stages_proba, -np.inf).max(axis=0)
+    else:
+        last = len(stages_proba) - 1 - np.argmax(scored[::-1], axis=0)
+        combined = stages_proba[last, np.arange(stages_proba.shape[1])]
+    return np.where(nb_scored > 0, combined, np.nan)
+
+
+def get_features_stage(item, module, pdg_dir):
+    """ Features vector of a JS file for a module, its PDG being built in pdg_dir if the module
+    needs it and it was not stored. Returns [file id, PDG built (None if not built, False if it
+    could not be), (indices, data) or None, time spent]. Run by the workers, whose
+    features2int_dicts are set once. """
+
+    start = timeit.default_timer()
+    [file_id, js_path, pdg_path] = item
+    pdg_built, rows = static_analysis.get_features_file_modules(js_path, [module], pdg_dir,
+                                                                pdg_path, keep_pdg=True)
+    return [file_id, pdg_built, rows[module], timeit.default_timer() - start]
+
+
+def run_cascade(files2do, modules_models, bands, combine='last'):
+    """
+        Classifies JS files with an early-exit cascade of modules.
+
+        -------
+        Parameters:
+        - files2do: list of str
+            JS files; their PDGs are read from Analysis/PDG in their folder (see
+            static_analysis.get_pdg_path), or built if a stage needs them.
+        - modules_models: dict
+            Key: module (level, features_choice, n), in the order of the stages;
+            Value: [model path, features dictionary path], see model_bundle.get_modules_models.
+        - bands: list of (low, high)
+            Uncertain band of each stage but the last: the samples whose combined probability
+            is strictly between low and high go on to the next stage.
+        - combine: str
+            How to combine the probabilities of the stages, see combine_proba.
+
+        -------
+        Returns:
+        - np.array
+            (n_stages, n_files) probabilities of being malicious, nan if not scored.
+        - np.array
+            Combined probability of each file, nan if no stage could score it.
+        - dict
+            Report on the samples each stage handled, its time, the time spent on the files by
+            the workers (work), and the PDGs avoided.
+        - or None if a features dictionary could not be used.
+    """
+
+    start = timeit.default_timer()
+    modules = list(modules_models.keys())
+    nb_files = len(files2do)
+    stages_proba = np.full((len(modules), nb_files), np.nan)
+    pdg_paths = [static_analysis.get_pdg_path(js_path) for js_path in files2do]
+    pdgs_needed = np.zeros(nb_files, dtype=bool)
+    report = {'nb_files': nb_files, 'stages': list(), 'pdgs_built': 0}
+    remaining = np.arange(nb_files)
+    features2int_dicts = static_analysis.load_features2int_dicts(
+        modules, [modules_models[module][1] for module in modules])
+    if features2int_dicts is None:
+        return None
+    pdg_dir = static_analysis.get_tmp_dir('jstap_cascade_')
+
+    try:
+        for stage, module in enumerate(modules):
+            features2int_dict = features2int_dicts[module]
+            model = machine_learning.load_model(modules_models[module][0])
+            stage_start = timeit.default_timer()
+            if module[0] != 'tokens':
+                pdgs_needed[remaining] = True
+            csr_builder = features_space.CsrBuilder(len(features2int_dict))
+            scored, work = list(), 0
+            for [file_id, pdg_built, row, file_time] in parallel.parallel_imap(
+                    partial(get_features_stage, module=module, pdg_dir=pdg_dir),
+                    [[file_id, files2do[file_id], pdg_paths[file_id]] for file_id in remaining
+                     if module[0] == 'tokens' or pdg_paths[file_id] is not None],
+                    initializer=static_analysis.set_features2int_dicts,
+                    initargs=({module: features2int_dict},)):
+                work += file_time
+                if pdg_built is False:  # Not built again by the next stages
+                    pdg_paths[file_id] = None
+                elif pdg_built is not None:  # Kept for the next stages
+                    pdg_paths[file_id] = pdg_built
+                    report['pdgs_built'] += 1
+                if row is not None:
+                    scored.append(file_id)
+                    csr_builder.add_row(*row)
+            if scored:
+                stages_proba[stage, scored] = model.predict_proba(csr_builder.get_csr())[:, 1]
+
+            nb_samples = len(remaining)
+            if stage < len(modules) - 1:
+                low, high = bands[stage]
+                proba = combine_proba(stages_proba[:stage + 1, remaining], combine)
+                remaining = remaining[np.isnan(proba) | ((proba > low) & (proba < high))]
+            else:
+                remaining = remaining[:0]
+            report['stages'].append({'module': module[0] + ':' + module[1],
+                                     'samples': nb_samples, 'scored': len(scored),
+                                     'decided': nb_samples - len(remaining),
+                                     'time': timeit.default_timer() - stage_start, 'work': work})
+    finally:
+        shutil.rmtree(pdg_dir, ignore_errors=True)
+
+    report['time'] = timeit.default_timer() - start
+    report['work'] = sum(stage_report['work'] for stage_report in report['stages'])
+    # Work to run all modules on all files, extrapolated from the work per file of each stage
+    report['work_all_modules'] = sum(stage_report['work'] * nb_files / stage_report['samples']
+                                     for stage_report in report['stages']
+                                     if stage_report['samples'])
+    report['pdgs_needed'] = int(pdgs_needed.sum())
+    report['pdgs_avoided'] = nb_files - report['pdgs_needed']\
+        if any(module[0] != 'tokens' for module in modules) else 0
+    return stages_proba, combine_proba(stages_proba, combine), report
+
+
+def print_cascade_results(names, labels, labels_predicted, proba, nb_stages):
+    """ Prints the predictions with the combined probability and the number of stages run. """
+
+    sys.stdout.write(''.join(
+        '%s: %s (%s) Proba: %s Stages: %s\n' % (name, label_predicted, label, round(p, 3),
+                                                nb_stage)
+        for name, label_predicted, label, p, nb_stage in zip(names, labels_predicted, labels,
+                                                             proba.tolist(), nb_stages)))
+
+
+def print_report(report):
+    """ Prints the samples handled by each stage and the savings of the cascade. """
+
+    print('> Cascade: ' + str(report['nb_files']) + ' files')
+    for stage_report in report['stages']:
+        print(stage_report['module'] + ': ' + str(stage_report['samples']) + ' samples, '
+              + str(stage_report['decided']) + ' decided, in '
+              + str(round(stage_report['time'], 3)) + 's')
+    print('PDGs needed: ' + str(report['pdgs_needed']) + ' (built: '
+          + str(report['pdgs_built']) + '), avoided: ' + str(report['pdgs_avoided']))
+    savings = 0
+    if report['work_all_modules']:
+        savings = 1 - report['work'] / report['work_all_modules']
+    print('Time: ' + str(round(report['time'], 3)) + 's; files analysis: '
+          + str(round(report['work'], 3)) + 's vs ' + str(round(report['work_all_modules'], 3))
+          + 's for all modules on all files (estimated), savings: ' + str(round(100 * savings, 1))
+          + '%')
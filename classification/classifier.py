@@ -20,14 +20,18 @@ import os
 import pickle
 import argparse
 import logging
+import numpy as np
 
 import machine_learning
+import cascade
+import ensemble
+import model_bundle
 import utility
 import static_analysis
 
 
 def test_model(names, labels, attributes, model, print_res=False, print_res_verbose=True,
-               print_score=True, threshold=0.50):
+               print_score=True, threshold=0.50, return_confidence=False, results_path=None):
     """
         Use an existing model to classify new JS inputs.
 
@@ -53,17 +57,30 @@ def test_model(names, labels, attributes, model, print_res=False, print_res_verb
         - threshold: float
             Probability of a sample being malicious over which the sample will be classified
             as malicious.
+        - return_confidence: bool
+            Indicates whether to return the confidence of the predictions too.
+        - results_path: str
+            If given, the predictions are written in this CSV or JSON Lines file (see
+            machine_learning.write_results) instead of being printed.
 
         -------
         Returns:
         - list:
             List of labels predicted.
+        - np.array, if return_confidence:
+            Confidence of each prediction, i.e. fraction of the trees which gave the same
+            prediction as the forest.
     """
 
     if isinstance(model, str):
-        model = pickle.load(open(model, 'rb'))
+        model = machine_learning.load_model(model)
 
-    labels_predicted_proba_test = model.predict_proba(attributes)
+    counts_of_same_predictions = None
+    if print_res_verbose or return_confidence:  # The trees' agreement comes with the prediction
+        labels_predicted_proba_test, counts_of_same_predictions = machine_learning.\
+            predict_proba_agreement(model, attributes, threshold)
+    else:
+        labels_predicted_proba_test = model.predict_proba(attributes)
     # Probability of the samples for each class in the model.
     # First column = benign, second = malicious.
     # labels_predicted_test = model.predict(attributes_test)
@@ -74,17 +91,27 @@ def test_model(names, labels, attributes, model, print_res=False, print_res_verb
     # Perform classification using a threshold (probability of the sample being malicious)
     # to predict the target values
 
-    if print_res:
-        machine_learning.get_classification_results(names, labels_predicted_test)
+    if results_path is not None:
+        confidence = None
+        if counts_of_same_predictions is not None:
+            confidence = counts_of_same_predictions / model.n_estimators
+        machine_learning.write_results(results_path, names, labels, labels_predicted_test,
+                                       labels_predicted_proba_test, confidence)
+
+    else:
+        if print_res:
+            machine_learning.get_classification_results(names, labels_predicted_test)
 
-    if print_res_verbose:
-        machine_learning.get_classification_results_verbose(names, labels, labels_predicted_test,
-                                                            labels_predicted_proba_test, model,
-                                                            attributes, threshold)
+        if print_res_verbose:
+            machine_learning.get_classification_results_verbose(
+                names, labels, labels_predicted_test, labels_predicted_proba_test, model,
+                attributes, threshold, counts_of_same_predictions.tolist())
 
     if print_score:
         machine_learning.get_score(labels, labels_predicted_test)
 
+    if return_confidence:
+        return labels_predicted_test, counts_of_same_predictions / model.n_estimators
     return labels_predicted_test
 
 
@@ -109,22 +136,51 @@ def parsing_commands():
     parser.add_argument('--m', metavar='MODEL', type=str, nargs=1,
                         help='path of the model used to classify the new JS inputs '
                              '(see >$ python3 <path-of-clustering/learner.py> -help) '
-                             'to build a model)')
-    parser.add_argument('--th', metavar='THRESHOLD', type=float, nargs=1, default=[0.50],
-                        help='threshold over which all samples are considered malicious')
+                             'to build a model); for a model bundle, the level, features and n '
+                             'are the bundle\'s')
+    parser.add_argument('--th', metavar='THRESHOLD', type=float, nargs=1, default=[None],
+                        help='threshold over which all samples are considered malicious; per '
+                             'default, the one of the model bundle, or 0.5')
+    parser.add_argument('--modules', metavar='LEVEL:FEATURES:MODEL', type=str, nargs='+',
+                        help='several modules to classify the JS files (--d, --f) with at once, '
+                             'e.g. tokens:ngrams:MODEL1 pdg:value:MODEL2, or model bundles; the '
+                             'PDGs have to be stored in the folder Analysis/PDG of the JS files')
+    parser.add_argument('--cascade', metavar='LEVEL:FEATURES:MODEL', type=str, nargs='+',
+                        help='modules (or model bundles) to classify the JS files (--d, --f) with '
+                             'in an early-exit cascade, the cheapest first, e.g. '
+                             'tokens:ngrams:MODEL1 pdg:value:MODEL2: a module only classifies '
+                             'the files still uncertain after the previous ones')
+    parser.add_argument('--bands', metavar='LOW:HIGH', type=str, nargs='+', default=cascade.BANDS,
+                        help='uncertain band(s) of the cascade, for all modules or per module but '
+                             'the last: the files with a probability in ]LOW, HIGH[ go on to the '
+                             'next module')
+    parser.add_argument('--combine', metavar='COMBINE', type=str, nargs=1, default=['last'],
+                        choices=cascade.COMBINE,
+                        help='probability of the files in the cascade: the one of the last module '
+                             'run (last), or the mean or max over the modules run')
+    parser.add_argument('--ensemble', metavar='LEVEL:FEATURES:MODEL', type=str, nargs='+',
+                        help='modules (or model bundles) voting on each JS file (--d, --f), e.g. '
+                             'tokens:ngrams:MODEL1 ast:value:MODEL2 pdg:ngrams:MODEL3: the '
+                             'tokens, PDG and traversals of a file are computed once for all '
+                             'modules')
+    parser.add_argument('--vote', metavar='VOTE', type=str, nargs=1, default=['mean'],
+                        choices=ensemble.VOTES,
+                        help='vote of the ensemble: mean probability over the threshold (per '
+                             'default, the mean of the modules\' ones), or majority, any or all '
+                             'of the modules considering the file malicious')
+    parser.add_argument('--out', metavar='FILE', type=str, nargs=1, default=[None],
+                        help='CSV file (or JSON Lines file if FILE ends with .jsonl) to write the '
+                             'predictions in, instead of printing them')
     utility.parsing_commands(parser)
 
     return vars(parser.parse_args())
 
 
-arg_obj = parsing_commands()
-utility.control_logger(arg_obj['v'][0])
-
-
-def main_classification(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=arg_obj['lf'],
-                        labels_d=arg_obj['l'], model=arg_obj['m'], threshold=arg_obj['th'],
-                        level=arg_obj['level'], features_choice=arg_obj['features'],
-                        n=arg_obj['n'][0], analysis_path=arg_obj['analysis_path'][0]):
+def main_classification(js_dirs=None, js_files=None, labels_f=None, labels_d=None, model=None,
+                        threshold=None, level=None, features_choice=None, n=4,
+                        analysis_path=os.path.join(utility.SRC_PATH, 'Analysis'), modules=None,
+                        results_path=None, cascade_modules=None, bands=tuple(cascade.BANDS),
+                        combine='last', ensemble_modules=None, vote='mean'):
     """
         Main function, performs a static analysis (syntactic) of JavaScript files given as input
         before predicting if the executables are benign or malicious.
@@ -153,8 +209,25 @@ def main_classification(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=ar
             Folder to store the features' analysis results in.
         - features_choice: str
             Either 'ngrams' or 'value' depending on the features you want.
-        Default values are the ones given in the command lines or in the
-        ArgumentParser object (function parsingCommands()).
+        - modules: list of str
+            'level:features_choice:model' of several modules to classify the files with at once,
+            instead of level, features_choice and model.
+        - results_path: str
+            CSV or JSON Lines file to write the predictions in, None to print them.
+        - cascade_modules: list of str
+            'level:features_choice:model' of the modules of an early-exit cascade, the cheapest
+            first, instead of level, features_choice and model.
+        - bands: list of str
+            'low:high' uncertain band(s) of the cascade.
+        - combine: str
+            How to combine the probabilities of the modules of the cascade.
+        - ensemble_modules: list of str
+            'level:features_choice:model' of the modules of an ensemble, instead of level,
+            features_choice and model.
+        - vote: str
+            How the modules of the ensemble vote.
+        Default values are the ones of the ArgumentParser object (function parsing_commands()),
+        the command line being handled by main().
 
         -------
         Returns:
@@ -174,21 +247,28 @@ def main_classification(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=ar
         logging.error('Please, indicate as many file labels (--lf option) as the number %s '
                       'of files to analyze', str(len(js_files)))
 
+    elif cascade_modules is not None:
+        main_classification_cascade(js_dirs, js_files, labels_f, labels_d, cascade_modules, bands,
+                                    combine, threshold, n, analysis_path, results_path)
+
+    elif ensemble_modules is not None:
+        main_classification_ensemble(js_dirs, js_files, labels_f, labels_d, ensemble_modules,
+                                     vote, threshold, n, analysis_path, results_path)
+
+    elif modules is not None:
+        main_classification_modules(js_dirs, js_files, labels_f, labels_d, modules, threshold,
+                                    n, analysis_path, results_path)
+
     elif model is None:
         logging.error('Please, indicate a model (--m option) to be used to classify new files.\n'
                       '(see >$ python3 <path-of-clustering/learner.py> -help) to build a model)')
 
-    elif utility.check_params(level, features_choice) == 0:
-        return
-
     else:
-        features2int_dict_path = os.path.join(analysis_path, 'Features', features_choice[0],
-                                              level[0] + '_selected_features_99')
-
-        names, attributes, labels = static_analysis.main_analysis\
-            (js_dirs=js_dirs, labels_dirs=labels_d, js_files=js_files, labels_files=labels_f,
-             n=n, level=level[0], features_choice=features_choice[0],
-             features2int_dict_path=features2int_dict_path)
+        res = analyze_model_files(js_dirs, js_files, labels_f, labels_d, model, level,
+                                  features_choice, n, analysis_path)
+        if res is None:
+            return
+        names, attributes, labels = res
 
         if names:
             # Uncomment to save the analysis results in pickle objects.
@@ -197,14 +277,188 @@ def main_classification(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=ar
                                                    names, attributes, labels)
             """
 
-            test_model(names, labels, attributes, model=model[0], threshold=threshold[0])
+            test_model(names, labels, attributes, model=model,
+                       threshold=model_bundle.get_threshold(threshold, model),
+                       results_path=results_path)
 
         else:
             logging.warning('No valid JS file found for the analysis')
 
 
+def analyze_model_files(js_dirs, js_files, labels_f, labels_d, model, level, features_choice, n,
+                        analysis_path):
+    """
+        Static analysis of the JS files for a model, in its features space.
+
+        -------
+        Parameters:
+        - js_dirs, js_files, labels_f, labels_d:
+            See main_classification.
+        - model: str
+            Path of a model bundle, which comes with its module and features, or of a model
+            built by learner.py for the module (level, features_choice, n), its features being
+            in analysis_path.
+
+        -------
+        Returns:
+        - list: [names, attributes, labels], see static_analysis.main_analysis;
+        - or None if the model is not valid.
+    """
+
+    if model_bundle.is_bundle(model):
+        module_spec = model
+    elif utility.check_params(level, features_choice) == 0:
+        return None
+    else:
+        module_spec = level + ':' + features_choice + ':' + model
+    modules_models = model_bundle.get_modules_models([module_spec], n, analysis_path)
+    if modules_models is None:
+        return None
+    [((level, features_choice, n), [_, features2int_dict_path])] = modules_models.items()
+
+    return static_analysis.main_analysis(
+        js_dirs=js_dirs, labels_dirs=labels_d, js_files=js_files, labels_files=labels_f,
+        n=n, level=level, features_choice=features_choice,
+        features2int_dict_path=features2int_dict_path)
+
+
+def main_classification_modules(js_dirs, js_files, labels_f, labels_d, modules, threshold, n,
+                                analysis_path, results_path=None):
+    """ Classifies the JS files with several modules, their features being extracted all at
+    once, see static_analysis.main_analysis_modules. The predictions of each module are
+    written in results_path suffixed with _<level>_<features_choice>, if given. """
+
+    modules_models = model_bundle.get_modules_models(modules, n, analysis_path)
+    if modules_models is None:
+        return
+
+    modules_list = list(modules_models.keys())
+    features2int_dict_paths = [modules_models[module][1] for module in modules_list]
+
+    res = static_analysis.main_analysis_modules(js_dirs=js_dirs, js_files=js_files,
+                                                labels_files=labels_f, labels_dirs=labels_d,
+                                                modules=modules_list,
+                                                features2int_dict_paths=features2int_dict_paths)
+    if res is None:
+        return
+
+    for module in modules_list:
+        names, attributes, labels = res[module]
+        print('> Module: ' + module[0] + ' ' + module[1])
+        if names:
+            module_results_path = None
+            if results_path is not None:
+                root, ext = os.path.splitext(results_path)
+                module_results_path = root + '_' + module[0] + '_' + module[1] + ext
+            model = modules_models[module][0]
+            test_model(names, labels, attributes, model=model,
+                       threshold=model_bundle.get_threshold(threshold, model),
+                       results_path=module_results_path)
+        else:
+            logging.warning('No valid JS file found for the analysis')
+
+
+def main_classification_cascade(js_dirs, js_files, labels_f, labels_d, modules, bands, combine,
+                                threshold, n, analysis_path, results_path=None):
+    """ Classifies the JS files with an early-exit cascade of modules, see cascade.py, and
+    prints the time and PDGs the cascade saved. """
+
+    modules_models = model_bundle.get_modules_models(modules, n, analysis_path)
+    if modules_models is None:
+        return
+    bands = cascade.get_bands(bands, len(modules_models))
+    if bands is None:
+        return
+    threshold = model_bundle.get_threshold(threshold, list(modules_models.values())[-1][0])
+
+    files2do, labels = static_analysis.get_files2do(js_dirs, js_files, labels_f, labels_d,
+                                                    skip_dirs=True)
+    res = cascade.run_cascade(files2do, modules_models, bands, combine)
+    if res is None:
+        return
+    stages_proba, proba, report = res
+
+    valid = np.flatnonzero(~np.isnan(proba))  # Files at least one module could classify
+    names = [files2do[i] for i in valid]
+    labels = [labels[i] for i in valid]
+    proba = proba[valid]
+    labels_predicted_proba = np.stack([1 - proba, proba], axis=1)
+    labels_predicted = machine_learning.predict_labels_using_threshold(
+        len(names), labels_predicted_proba, threshold)
+
+    if results_path is not None:
+        machine_learning.write_results(results_path, names, labels, labels_predicted,
+                                       labels_predicted_proba)
+    else:
+        nb_stages = (~np.isnan(stages_proba[:, valid])).sum(axis=0).tolist()
+        cascade.print_cascade_results(names, labels, labels_predicted, proba, nb_stages)
+    if names:
+        machine_learning.get_score(labels, labels_predicted)
+    else:
+        logging.warning('No valid JS file found for the analysis')
+    cascade.print_report(report)
+
+
+def main_classification_ensemble(js_dirs, js_files, labels_f, labels_d, modules, vote,
+                                 threshold, n, analysis_path, results_path=None):
+    """ Classifies the JS files with an ensemble of modules voting on each file, see
+    ensemble.py. threshold, if given, is the one of all modules (and of the mean vote). """
+
+    modules_models = model_bundle.get_modules_models(modules, n, analysis_path)
+    if modules_models is None:
+        return
+    thresholds = [model_bundle.get_threshold(threshold, model)
+                  for [model, _] in modules_models.values()]
+
+    files2do, labels = static_analysis.get_files2do(js_dirs, js_files, labels_f, labels_d,
+                                                    skip_dirs=True)
+    res = ensemble.run_ensemble(files2do, modules_models, thresholds, vote, threshold)
+    if res is None:
+        return
+    modules_proba, proba, malicious, report = res
+
+    valid = np.flatnonzero(~np.isnan(proba))  # Files at least one module could classify
+    names = [files2do[i] for i in valid]
+    labels = [labels[i] for i in valid]
+    proba = proba[valid]
+    labels_predicted = machine_learning.LABELS[malicious[valid].view(np.int8)]
+
+    if results_path is not None:
+        machine_learning.write_results(results_path, names, labels, labels_predicted,
+                                       np.stack([1 - proba, proba], axis=1))
+    else:
+        ensemble.print_ensemble_results(names, labels, labels_predicted, proba,
+                                        modules_proba[:, valid])
+    if names:
+        machine_learning.get_score(labels, labels_predicted)
+    else:
+        logging.warning('No valid JS file found for the analysis')
+    ensemble.print_report(report)
+
+
+def main():
+    """ Command line of main_classification. """
+
+    arg_obj = parsing_commands()
+    utility.control_logger(arg_obj['v'][0])
+    utility.control_parallelism(arg_obj['workers'][0], arg_obj['backend'][0])
+    utility.control_cache(arg_obj['cache'][0])
+    utility.control_hashing(arg_obj['hash_bits'][0])
+    utility.control_vectorizer(arg_obj['vectorizer_bits'][0])
+
+    main_classification(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=arg_obj['lf'],
+                        labels_d=arg_obj['l'], model=(arg_obj['m'] or [None])[0],
+                        threshold=arg_obj['th'][0], level=(arg_obj['level'] or [None])[0],
+                        features_choice=(arg_obj['features'] or [None])[0],
+                        n=arg_obj['n'][0], analysis_path=arg_obj['analysis_path'][0],
+                        modules=arg_obj['modules'], results_path=arg_obj['out'][0],
+                        cascade_modules=arg_obj['cascade'], bands=arg_obj['bands'],
+                        combine=arg_obj['combine'][0], ensemble_modules=arg_obj['ensemble'],
+                        vote=arg_obj['vote'][0])
+
+
 if __name__ == "__main__":  # Executed only if run as a script
-    main_classification()
+    main()
 
 
 def classify_analysis_results(save_dir, model, threshold):
@@ -0,0 +1,248 @@
+#!/usr/bin/python
+
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    Compiled RandomForest: the trees of a trained forest are flattened into NumPy node arrays,
+    stored as .npy files and memory-mapped, and evaluated level by level on batches of
+    samples for all trees at once.
+"""
+
+import os
+import json
+import pickle
+import shutil
+import logging
+import argparse
+import numpy as np
+from scipy import sparse
+
+import features_hashing
+
+
+COMPILED_BATCH_SIZE = 1024  # Samples evaluated at once
+NODE_DTYPE = np.dtype([('feature', '<i4'), ('threshold', '<f4'), ('left', '<i4'),
+                       ('right', '<i4')])
+ARRAYS = ['nodes', 'value', 'roots', 'used_features']
+
+
+class CompiledForest:
+    """
+        Forest stored as flat arrays over the nodes of all trees:
+            * nodes: NODE_DTYPE records, gathered at once for each step of the traversal:
+                - feature: column (among used_features) tested by the node;
+                - threshold: float32, the sample goes left if its value <= threshold;
+                - left, right: children of the node, ~child (i.e. < 0) if the child is a leaf;
+            * value: float64, (n_nodes, n_classes) class probabilities of the node;
+            * roots: root node of each tree, ~root if the tree is a single leaf;
+            * used_features: columns of the input tested by at least one node.
+        Its predict_proba matches the one of the forest it was compiled from. Each step of the
+        traversal costs a few NumPy calls for all (tree, sample) pairs, which makes it faster
+        than sklearn for small batches (e.g. the service's), but slower for large batches.
+    """
+
+    def __init__(self, arrays, classes, n_features_in):
+        for name in ARRAYS:
+            setattr(self, name, np.asarray(arrays[name]))  # Memory-mapped arrays stay so
+        self.classes_ = np.array(classes, dtype=object)
+        self.n_features_in_ = n_features_in
+        self.n_estimators = len(self.roots)
+
+    def get_dense(self, attributes):
+        """ Values of the used features of the samples, as a dense float32 array. """
+
+        attributes = sparse.csr_matrix(attributes)
+        return attributes[:, self.used_features].toarray().astype(np.float32)
+
+    def get_leaves(self, dense):
+        """ Leaf reached by each sample in each tree, as a (n_trees, n_samples) array. """
+
+        nb_samples, nb_cols = dense.shape
+        dense = dense.ravel()
+        nodes = np.repeat(self.roots, nb_samples)
+        offsets = np.tile(np.arange(nb_samples) * nb_cols, len(self.roots))
+        active = np.flatnonzero(nodes >= 0)  # (tree, sample) not in a leaf yet
+        while active.size:
+            records = self.nodes[nodes[active]]
+            children = np.where(dense[offsets[active] + records['feature']]
+                                <= records['threshold'], records['left'], records['right'])
+            nodes[active] = children
+            active = active[children >= 0]
+        return (~nodes).reshape(len(self.roots), nb_samples)
+
+    def iter_trees_proba(self, attributes):
+        """ Yields the probabilities of each tree for batches of COMPILED_BATCH_SIZE samples,
+        as (n_trees, n_samples_batch, n_classes) arrays. """
+
+        attributes = sparse.csr_matrix(attributes)
+        for start in range(0, attributes.shape[0], COMPILED_BATCH_SIZE):
+            leaves = self.get_leaves(self.get_dense(attributes[start:start
+                                                               + COMPILED_BATCH_SIZE]))
+            yield self.value[leaves]
+
+    def predict_proba(self, attributes):
+        """ Probabilities of the samples for each class, averaged over the trees. """
+
+        res = [trees_proba.sum(axis=0) / self.n_estimators
+               for trees_proba in self.iter_trees_proba(attributes)]
+        if not res:
+            return np.zeros((0, len(self.classes_)))
+        return np.concatenate(res)
+
+    def predict(self, attributes):
+        return self.classes_[np.argmax(self.predict_proba(attributes), axis=1)]
+
+    def save(self, path):
+        """ Stores the arrays in the folder path, one .npy file each. """
+
+        os.makedirs(path, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'forest.json'), 'w') as meta_file:
+            json.dump({'classes': self.classes_.tolist(), 'n_features_in': self.n_features_in_,
+                       'n_estimators': self.n_estimators}, meta_file)
+
+
+def get_threshold32(threshold):
+    """ float32 thresholds t32 such that x <= t32 if and only if x <= threshold for all float32
+    x, i.e. the largest float32 not above each threshold. """
+
+    threshold32 = threshold.astype(np.float32)
+    above = threshold32.astype(np.float64) > threshold
+    threshold32[above] = np.nextafter(threshold32[above], np.float32(-np.inf))
+    return threshold32
+
+
+def compile_forest(model):
+    """
+        Compiles a trained sklearn RandomForestClassifier into a CompiledForest.
+
+        -------
+        Parameter:
+        - model: RandomForestClassifier
+            Trained forest.
+
+        -------
+        Returns:
+        - CompiledForest
+    """
+
+    features, thresholds, lefts, rights, values, roots, leaves = [], [], [], [], [], [], []
+    offset = 0
+    for tree in model.estimators_:
+        tree_ = tree.tree_
+        is_leaf = tree_.children_left < 0
+        leaves.append(is_leaf)
+        roots.append(~offset if is_leaf[0] else offset)
+        features.append(tree_.feature)
+        thresholds.append(tree_.threshold)
+        for children, children_compiled in [(tree_.children_left, lefts),
+                                            (tree_.children_right, rights)]:
+            children = np.where(is_leaf, 0, children)
+            children_compiled.append(np.where(is_leaf, -1, np.where(
+                is_leaf[children], ~(children + offset), children + offset)))
+        value = tree_.value[:, 0, :]
+        normalizer = value.sum(axis=1, keepdims=True)
+        normalizer[normalizer == 0] = 1
+        values.append(value / normalizer)
+        offset += tree_.node_count
+
+    feature, is_leaf = np.concatenate(features), np.concatenate(leaves)
+    used_features = np.unique(feature[~is_leaf])  # The inputs only need these columns
+    nodes = np.zeros(len(feature), dtype=NODE_DTYPE)
+    nodes['feature'] = np.where(is_leaf, 0, np.searchsorted(used_features, feature))
+    nodes['threshold'] = get_threshold32(np.concatenate(thresholds))
+    nodes['left'] = np.concatenate(lefts)
+    nodes['right'] = np.concatenate(rights)
+    arrays = {'nodes': nodes, 'value': np.concatenate(values).astype(np.float64),
+              'roots': np.array(roots, dtype=np.int32),
+              'used_features': used_features.astype(np.int32)}
+    return CompiledForest(arrays, model.classes_.tolist(), model.n_features_in_)
+
+
+def merge_compiled_forests(forests):
+    """
+        Merges CompiledForests trained on the same features (e.g. on different samples) into
+        one, whose predict_proba averages the ones of all their trees.
+
+        -------
+        Parameter:
+        - forests: list of CompiledForest
+            With the same classes and n_features_in_.
+
+        -------
+        Returns:
+        - CompiledForest
+    """
+
+    used_features = np.unique(np.concatenate([forest.used_features for forest in forests]))
+    nodes, values, roots = list(), list(), list()
+    offset = 0
+    for forest in forests:
+        forest_nodes = np.array(forest.nodes)
+        if len(forest.used_features):  # Otherwise only leaves, whose feature is not used
+            forest_nodes['feature'] = np.searchsorted(
+                used_features, forest.used_features[forest_nodes['feature']])
+        for child in ('left', 'right'):  # ~child for a leaf, hence - offset
+            forest_nodes[child] = np.where(forest_nodes[child] >= 0, forest_nodes[child] + offset,
+                                           forest_nodes[child] - offset)
+        nodes.append(forest_nodes)
+        values.append(forest.value)
+        roots.append(np.where(forest.roots >= 0, forest.roots + offset, forest.roots - offset))
+        offset += len(forest_nodes)
+    arrays = {'nodes': np.concatenate(nodes), 'value': np.concatenate(values),
+              'roots': np.concatenate(roots).astype(np.int32),
+              'used_features': used_features.astype(np.int32)}
+    return CompiledForest(arrays, forests[0].classes_.tolist(), forests[0].n_features_in_)
+
+
+def load_compiled_forest(path, mmap_mode='r'):
+    """ Loads a CompiledForest stored in the folder path, its arrays being memory-mapped. """
+
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+              for name in ARRAYS}
+    with open(os.path.join(path, 'forest.json')) as meta_file:
+        meta = json.load(meta_file)
+    return CompiledForest(arrays, meta['classes'], meta['n_features_in'])
+
+
+def export_model(model_path, compiled_path):
+    """ Compiles the pickled forest of model_path and stores it in the folder compiled_path;
+    TO CALL. """
+
+    model = pickle.load(open(model_path, 'rb'))
+    compile_forest(model).save(compiled_path)
+    if os.path.isfile(features_hashing.get_model_config_path(model_path)):
+        shutil.copyfile(features_hashing.get_model_config_path(model_path),
+                        features_hashing.get_model_config_path(compiled_path))
+    logging.info('The compiled model has been successfully stored in %s', compiled_path)
+
+
+def main_export():
+    """ Command line of export_model. """
+
+    parser = argparse.ArgumentParser(description='Compiles a model built by learner.py into '
+                                                 'NumPy arrays, to classify with it faster.')
+    parser.add_argument('--m', metavar='MODEL', type=str, nargs=1, required=True,
+                        help='path of the model to compile')
+    parser.add_argument('--out', metavar='DIR', type=str, nargs=1, required=True,
+                        help='folder to store the compiled model in')
+    arg_obj = vars(parser.parse_args())
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    export_model(arg_obj['m'][0], arg_obj['out'][0])
+
+
+if __name__ == "__main__":  # Executed only if run as a script
+    main_export()
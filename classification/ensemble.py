@@ -0,0 +1,197 @@
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    Ensemble of several modules voting on each JS file. The intermediate artifacts of a file
+    are computed once for all modules: it is tokenized at most once, its PDG is loaded (or
+    built) at most once, each level is traversed once, and the ngrams and value units of a
+    level come from the same traversal when possible (see features_counting.get_units_modules).
+    The cost of a file is thus close to the one of the most expensive module.
+"""
+
+import sys
+import shutil
+import timeit
+from functools import partial
+import numpy as np
+
+import parallel
+import features_space
+import static_analysis
+import machine_learning
+
+
+VOTES = ['mean', 'majority', 'any', 'all']
+
+
+def vote_proba(modules_proba, thresholds, vote='mean', threshold=None):
+    """
+        Combines the probabilities of being malicious given by the modules.
+
+        -------
+        Parameters:
+        - modules_proba: np.array
+            (n_modules, n_samples) probabilities, nan for the modules which could not score a
+            sample.
+        - thresholds: list of float
+            Threshold of each module, over which it considers a sample malicious.
+        - vote: str
+            'mean': the mean probability is over threshold (per default, the mean of the
+            thresholds); 'majority', 'any' or 'all': more than half, at least one or all of the
+            modules which scored the sample consider it malicious.
+        - threshold: float
+            Threshold of the 'mean' vote.
+
+        -------
+        Returns:
+        - np.array
+            Combined probability per sample: the mean probability, or the fraction of the
+            modules voting malicious; nan if no module scored the sample.
+        - np.array
+            Boolean, True for the samples predicted malicious.
+    """
+
+    scored = ~np.isnan(modules_proba)
+    nb_scored = scored.sum(axis=0)
+    if vote == 'mean':
+        proba = np.where(scored, modules_proba, 0).sum(axis=0) / np.maximum(nb_scored, 1)
+        if threshold is None:
+            threshold = float(np.mean(thresholds))
+        malicious = proba >= threshold
+    else:
+        votes = scored & (np.nan_to_num(modules_proba, nan=-1)
+                          >= np.asarray(thresholds, dtype=float)[:, None])
+        nb_votes = votes.sum(axis=0)
+        proba = nb_votes / np.maximum(nb_scored, 1)
+        if vote == 'majority':
+            malicious = 2 * nb_votes > nb_scored
+        elif vote == 'any':
+            malicious = nb_votes > 0
+        else:
+            malicious = nb_votes == nb_scored
+    proba = np.where(nb_scored > 0, proba, np.nan)
+    return proba, malicious & (nb_scored > 0)
+
+
+def get_features_file(item, modules, pdg_dir):
+    """ Features vectors of a JS file for all modules, its PDG being built in pdg_dir (and
+    deleted afterwards) if a module needs it and it was not stored. Returns [file id, PDG built
+    (None if not built, False if it could not be), dict of (indices, data) or None per module,
+    time spent]. Run by the workers, whose features2int_dicts are set once. """
+
+    start = timeit.default_timer()
+    [file_id, js_path] = item
+    pdg_built, rows = static_analysis.get_features_file_modules(js_path, modules, pdg_dir)
+    return [file_id, pdg_built, rows, timeit.default_timer() - start]
+
+
+def run_ensemble(files2do, modules_models, thresholds, vote='mean', threshold=None):
+    """
+        Classifies JS files with an ensemble of modules.
+
+        -------
+        Parameters:
+        - files2do: list of str
+            JS files; their PDGs are read from Analysis/PDG in their folder (see
+            static_analysis.get_pdg_path), or built if a module needs them.
+        - modules_models: dict
+            Key: module (level, features_choice, n);
+            Value: [model path, features dictionary path], see model_bundle.get_modules_models.
+        - thresholds: list of float
+            Threshold of each module, in the order of modules_models.
+        - vote, threshold:
+            How to combine the probabilities of the modules, see vote_proba.
+
+        -------
+        Returns:
+        - np.array
+            (n_modules, n_files) probabilities of being malicious, nan if not scored.
+        - np.array
+            Combined probability of each file, nan if no module could score it.
+        - np.array
+            Boolean, True for the files predicted malicious.
+        - dict
+            Report on the time spent on the files by the workers (work), on each model, and
+            on the PDGs built.
+        - or None if a features dictionary could not be used.
+    """
+
+    start = timeit.default_timer()
+    modules = list(modules_models.keys())
+    features2int_dicts = static_analysis.load_features2int_dicts(
+        modules, [modules_models[module][1] for module in modules])
+    if features2int_dicts is None:
+        return None
+    csr_builders = {module: features_space.CsrBuilder(len(features2int_dicts[module]))
+                    for module in modules}
+    scored = {module: list() for module in modules}
+    report = {'nb_files': len(files2do), 'work': 0, 'pdgs_built': 0, 'pdgs_failed': 0,
+              'modules': list()}
+    pdg_dir = static_analysis.get_tmp_dir('jstap_ensemble_')
+
+    try:
+        for [file_id, pdg_built, rows, file_time] in parallel.parallel_imap(
+                partial(get_features_file, modules=modules, pdg_dir=pdg_dir),
+                list(enumerate(files2do)), initializer=static_analysis.set_features2int_dicts,
+                initargs=(features2int_dicts,)):
+            report['work'] += file_time
+            if pdg_built is not None:
+                report['pdgs_built' if pdg_built else 'pdgs_failed'] += 1
+            for module, row in rows.items():
+                if row is not None:
+                    scored[module].append(file_id)
+                    csr_builders[module].add_row(*row)
+    finally:
+        shutil.rmtree(pdg_dir, ignore_errors=True)
+
+    modules_proba = np.full((len(modules), len(files2do)), np.nan)
+    for i, module in enumerate(modules):
+        module_start = timeit.default_timer()
+        if scored[module]:
+            model = machine_learning.load_model(modules_models[module][0])
+            modules_proba[i, scored[module]] = model.predict_proba(
+                csr_builders[module].get_csr())[:, 1]
+        report['modules'].append({'module': module[0] + ':' + module[1],
+                                  'scored': len(scored[module]),
+                                  'time': timeit.default_timer() - module_start})
+
+    proba, malicious = vote_proba(modules_proba, thresholds, vote, threshold)
+    report['time'] = timeit.default_timer() - start
+    return modules_proba, proba, malicious, report
+
+
+def print_ensemble_results(names, labels, labels_predicted, proba, modules_proba):
+    """ Prints the predictions with the combined probability and the one of each module (nan
+    if it could not score the file). """
+
+    sys.stdout.write(''.join(
+        '%s: %s (%s) Proba: %s Modules: %s\n' % (name, label_predicted, label, round(p, 3),
+                                                 ' '.join(str(round(p_module, 3))
+                                                          for p_module in p_modules))
+        for name, label_predicted, label, p, p_modules in zip(
+            names, labels_predicted, labels, proba.tolist(), modules_proba.T.tolist())))
+
+
+def print_report(report):
+    """ Prints the files scored by each module and the time spent. """
+
+    print('> Ensemble: ' + str(report['nb_files']) + ' files')
+    for module_report in report['modules']:
+        print(module_report['module'] + ': ' + str(module_report['scored']) + ' files scored, '
+              + 'model in ' + str(round(module_report['time'], 3)) + 's')
+    print('PDGs built: ' + str(report['pdgs_built']) + ', failed: '
+          + str(report['pdgs_failed']))
+    print('Time: ' + str(round(report['time'], 3)) + 's; files analysis: '
+          + str(round(report['work'], 3)) + 's for all modules, i.e. '
+          + str(round(1000 * report['work'] / max(report['nb_files'], 1), 3)) + 'ms per file')
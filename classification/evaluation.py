@@ -0,0 +1,350 @@
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    Evaluation of a module by k-fold cross-validation, to choose the number of trees (--nt)
+    and the threshold (--th) without training and classifying again for each value: the
+    features are extracted once into a training set (see training_set.py), the folds are
+    trained in parallel, and the out-of-fold probabilities are stored, then swept over all
+    thresholds at once.
+"""
+
+import os
+import csv
+import logging
+import argparse
+from functools import partial
+import numpy as np
+
+import utility
+import parallel
+import training_set
+import static_analysis
+import machine_learning
+import features_selection
+import features_preselection
+
+
+FOLDS = 5
+SWEEP_COLUMNS = ['trees', 'threshold', 'detection', 'tp', 'fp', 'fn', 'tn', 'tpr', 'tnr', 'fpr',
+                 'precision', 'recall']
+training_samples = None  # (attributes, labels) of the training set, set once per worker
+
+
+def set_training_samples(store_path):
+    """ Memory-maps the samples of the training set store_path in a worker. """
+
+    global training_samples
+    _, attributes, labels = training_set.load_training_set(store_path)
+    training_samples = attributes, np.array(labels, dtype=object)
+
+
+def get_fold_proba(fold, estimators_list, n_jobs):
+    """ Trains a forest of max(estimators_list) trees on the training rows of a fold. Returns
+    [test rows, (len(estimators_list), n_test_rows) probabilities of being malicious given by
+    the first estimators trees of the forest, for each estimators of estimators_list]: the
+    first trees of a forest are the ones of a smaller forest with the same random_state.
+    Run by the workers. """
+
+    train_rows, test_rows = fold
+    attributes, labels = training_samples
+    clf = machine_learning.classifier_choice(estimators=max(estimators_list))
+    clf.set_params(n_jobs=n_jobs)
+    clf.fit(attributes[train_rows], labels[train_rows])
+
+    fold_proba = list()
+    for trees_proba in machine_learning.iter_trees_proba(clf, attributes[test_rows]):
+        cumulated = np.cumsum(trees_proba[:, :, 1], axis=0)  # Summed in the trees' order
+        fold_proba.append(np.stack([cumulated[estimators - 1] / estimators
+                                    for estimators in estimators_list]))
+    return [test_rows, np.concatenate(fold_proba, axis=1)]
+
+
+def cross_validate(store_path, estimators_list, folds=FOLDS, seed=0):
+    """
+        Out-of-fold probabilities of the samples of the training set store_path, by stratified
+        k-fold cross-validation, the folds being trained in parallel.
+
+        -------
+        Parameters:
+        - store_path: str
+            Folder of the training set.
+        - estimators_list: list of int
+            Numbers of trees to evaluate; one forest of max(estimators_list) trees is trained
+            per fold.
+        - folds: int
+            Number of folds.
+        - seed: int
+            Seed of the split into folds.
+
+        -------
+        Returns:
+        - list: names of the samples;
+        - np.array: their labels;
+        - np.array: (len(estimators_list), n_samples) out-of-fold probabilities of being
+        malicious;
+        - or None if a label has less than folds samples.
+    """
+
+    from sklearn.model_selection import StratifiedKFold  # Slow to import, only to train
+
+    set_training_samples(store_path)  # In this process, for the split and the serial backend
+    names = [name for name, _ in training_set.iter_samples(store_path)][:len(training_samples[1])]
+    labels = training_samples[1]
+    for label in ('benign', 'malicious'):
+        if np.count_nonzero(labels == label) < folds:
+            logging.error('Expected at least %s %s samples in %s, got %s', str(folds), label,
+                          store_path, str(np.count_nonzero(labels == label)))
+            return None
+
+    splits = list(StratifiedKFold(n_splits=folds, shuffle=True, random_state=seed).split(
+        np.zeros(len(labels)), labels))
+    # The folds run in parallel, their trees share the remaining cores
+    n_jobs = -1 if utility.BACKEND == 'serial' or utility.NUM_WORKERS < 1\
+        else max(1, (os.cpu_count() or 1) // utility.NUM_WORKERS)
+    proba = np.full((len(estimators_list), len(labels)), np.nan)
+    fold_results, errors = parallel.parallel_map(
+        partial(get_fold_proba, estimators_list=estimators_list, n_jobs=n_jobs), splits,
+        chunksize=1, initializer=set_training_samples, initargs=(store_path,))
+    if errors:
+        logging.error('%s folds could not be evaluated', str(len(errors)))
+        return None
+    for test_rows, fold_proba in fold_results:
+        proba[:, test_rows] = fold_proba
+    return names, labels, proba
+
+
+def sweep_thresholds(labels, proba, thresholds=None):
+    """
+        get_score metrics for every threshold at once, from the probabilities of the samples.
+
+        -------
+        Parameters:
+        - labels: np.array
+            True labels (benign or malicious) of the samples.
+        - proba: np.array
+            Probabilities of the samples of being malicious.
+        - thresholds: np.array
+            Thresholds to evaluate, a sample being predicted malicious if its probability is
+            over it. Default: all the probabilities, i.e. all the ROC and PR points.
+
+        -------
+        Returns:
+        - dict
+            Key: column of SWEEP_COLUMNS but trees; Value: np.array, one value per threshold.
+    """
+
+    is_malicious = np.asarray(labels) == 'malicious'
+    thresholds = np.unique(proba) if thresholds is None else np.asarray(thresholds, dtype=float)
+    nb_malicious, nb_benign = int(is_malicious.sum()), int((~is_malicious).sum())
+    # Samples whose probability is over each threshold, counted on the sorted probabilities
+    tp = nb_malicious - np.searchsorted(np.sort(proba[is_malicious]), thresholds, 'left')
+    fp = nb_benign - np.searchsorted(np.sort(proba[~is_malicious]), thresholds, 'left')
+    fn, tn = nb_malicious - tp, nb_benign - fp
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sweep = {'threshold': thresholds, 'detection': (tp + tn) / len(proba), 'tp': tp,
+                 'fp': fp, 'fn': fn, 'tn': tn, 'tpr': tp / nb_malicious, 'tnr': tn / nb_benign,
+                 'fpr': fp / nb_benign, 'precision': np.where(tp + fp > 0, tp / (tp + fp), 1.),
+                 'recall': tp / nb_malicious}
+    return sweep
+
+
+def write_sweeps(sweep_path, estimators_list, sweeps):
+    """ Stores the sweep of each number of trees in the CSV file sweep_path, one row per number
+    of trees and threshold (SWEEP_COLUMNS). """
+
+    with open(sweep_path, 'w', newline='') as sweep_file:
+        writer = csv.writer(sweep_file)
+        writer.writerow(SWEEP_COLUMNS)
+        for estimators, sweep in zip(estimators_list, sweeps):
+            writer.writerows(zip(*([[estimators] * len(sweep['threshold'])]
+                                   + [sweep[column].tolist() for column in SWEEP_COLUMNS[1:]])))
+    logging.info('The ROC and PR points have been stored in %s', sweep_path)
+
+
+def print_score(sweep, i):
+    """ Prints the metrics of the i-th threshold of a sweep, as machine_learning.get_score. """
+
+    print("Detection: " + str(sweep['detection'][i]))
+    print("TP: " + str(sweep['tp'][i]) + ", FP: " + str(sweep['fp'][i]) + ", FN: "
+          + str(sweep['fn'][i]) + ", TN: " + str(sweep['tn'][i]))
+    print("TPR: " + str(sweep['tpr'][i]) + ", TNR: " + str(sweep['tnr'][i]))
+
+
+def print_sweeps(labels, proba, estimators_list, thresholds):
+    """ Prints, for each number of trees, the ROC AUC, the average precision, and the metrics at
+    the thresholds given and at the threshold with the best detection rate. """
+
+    from sklearn.metrics import roc_auc_score, average_precision_score  # Slow to import
+
+    is_malicious = np.asarray(labels) == 'malicious'
+    for estimators, estimators_proba in zip(estimators_list, proba):
+        print('> ' + str(estimators) + ' trees: ROC AUC: '
+              + str(round(roc_auc_score(is_malicious, estimators_proba), 4))
+              + ', average precision: '
+              + str(round(average_precision_score(is_malicious, estimators_proba), 4)))
+        sweep = sweep_thresholds(labels, estimators_proba, thresholds)
+        for i, threshold in enumerate(thresholds):
+            print('Threshold ' + str(threshold) + ':')
+            print_score(sweep, i)
+        sweep = sweep_thresholds(labels, estimators_proba)
+        best = int(np.argmax(sweep['detection']))
+        print('Best threshold ' + str(round(sweep['threshold'][best], 4)) + ':')
+        print_score(sweep, best)
+
+
+def save_proba(proba_path, names, labels, estimators_list, proba):
+    """ Stores the out-of-fold probabilities, to sweep other thresholds later (--proba). """
+
+    np.savez(proba_path, names=np.array(names), labels=np.array(labels, dtype=str),
+             trees=np.array(estimators_list), proba=proba)
+    logging.info('The out-of-fold probabilities have been stored in %s', proba_path)
+
+
+def load_proba(proba_path):
+    """ Loads the names, labels, numbers of trees and probabilities stored by save_proba. """
+
+    with np.load(proba_path) as arrays:
+        return arrays['names'].tolist(), arrays['labels'].astype(object),\
+            arrays['trees'].tolist(), arrays['proba']
+
+
+def evaluate(js_dirs, labels_d, level, features_choice, n, features2int_dict_path, store_path,
+             out_dir, estimators_list, thresholds, folds=FOLDS):
+    """
+        Extracts the features of the JS files into the training set store_path (only the files
+        not in it yet), cross-validates forests of each number of trees of estimators_list on
+        it, and sweeps the thresholds over the out-of-fold probabilities. The probabilities
+        (cv_proba.npz) and the sweeps (cv_sweep.csv) are stored in out_dir.
+
+        -------
+        Returns:
+        - np.array: (len(estimators_list), n_samples) out-of-fold probabilities, or None.
+    """
+
+    if js_dirs is not None:
+        static_analysis.main_analysis_store(js_dirs, labels_d, level, features_choice, n,
+                                            features2int_dict_path, store_path)
+    if training_set.load_store_meta(store_path) is None:
+        logging.error('No training set in %s', store_path)
+        return None
+
+    res = cross_validate(store_path, estimators_list, folds)
+    if res is None:
+        return None
+    names, labels, proba = res
+    os.makedirs(out_dir, exist_ok=True)
+    save_proba(os.path.join(out_dir, 'cv_proba.npz'), names, labels, estimators_list, proba)
+    write_sweeps(os.path.join(out_dir, 'cv_sweep.csv'), estimators_list,
+                 [sweep_thresholds(labels, estimators_proba) for estimators_proba in proba])
+    print_sweeps(labels, proba, estimators_list, thresholds)
+    return proba
+
+
+def parsing_commands():
+    """
+        Creation of an ArgumentParser object, holding all the information necessary to parse
+        the command line into Python data types.
+    """
+
+    parser = argparse.ArgumentParser(description='Evaluates a module by k-fold cross-validation '
+                                                 'for several numbers of trees and all the '
+                                                 'thresholds, extracting the features once.')
+
+    parser.add_argument('--d', metavar='DIR', type=str, nargs='+',
+                        help='directories whose JS files are added to the training set')
+    parser.add_argument('--l', metavar='LABEL', type=str, nargs='+',
+                        choices=['benign', 'malicious'],
+                        help='labels of the JS directories')
+    parser.add_argument('--vd', metavar='DIR-VALIDATE', type=str, nargs='+',
+                        help='2 JS dir (1 benign, 1 malicious) to select the features with; per '
+                             'default, the features already selected in --analysis_path are used')
+    parser.add_argument('--vl', metavar='LABEL', type=str, nargs='+',
+                        choices=['benign', 'malicious'],
+                        help='labels of the 2 JS dir for the features selection process')
+    parser.add_argument('--store', metavar='DIR', type=str, nargs=1, default=[None],
+                        help='training set the features are extracted into, once per file; per '
+                             'default, in the Evaluation folder of --analysis_path')
+    parser.add_argument('--out', metavar='DIR', type=str, nargs=1, default=[None],
+                        help='folder to store the out-of-fold probabilities and the ROC and PR '
+                             'points in; per default, the Evaluation folder of --analysis_path')
+    parser.add_argument('--folds', metavar='INTEGER', type=int, nargs=1, default=[FOLDS],
+                        help='number of folds of the cross-validation')
+    parser.add_argument('--nt', metavar='NB_TREES', type=int, nargs='+', default=[500],
+                        help='numbers of trees to evaluate, with one forest per fold')
+    parser.add_argument('--th', metavar='THRESHOLD', type=float, nargs='+', default=[0.5],
+                        help='thresholds whose detection rates are printed (all the thresholds '
+                             'are stored)')
+    parser.add_argument('--proba', metavar='FILE', type=str, nargs=1, default=[None],
+                        help='cv_proba.npz file of a previous evaluation, to sweep its '
+                             'probabilities again without cross-validation')
+    utility.parsing_commands(parser)
+
+    return vars(parser.parse_args())
+
+
+def main_evaluation():
+    """ Command line of evaluate. """
+
+    arg_obj = parsing_commands()
+    utility.control_logger(arg_obj['v'][0])
+    utility.control_parallelism(arg_obj['workers'][0], arg_obj['backend'][0])
+    utility.control_cache(arg_obj['cache'][0])
+    utility.control_hashing(arg_obj['hash_bits'][0])
+    utility.control_vectorizer(arg_obj['vectorizer_bits'][0])
+    js_dirs, labels_d, n = arg_obj['d'], arg_obj['l'], arg_obj['n'][0]
+    analysis_path = arg_obj['analysis_path'][0]
+
+    if arg_obj['proba'][0] is not None:
+        names, labels, estimators_list, proba = load_proba(arg_obj['proba'][0])
+        print_sweeps(labels, proba, estimators_list, arg_obj['th'])
+        return
+
+    if utility.check_params(arg_obj['level'], arg_obj['features']) == 0:
+        return
+    level, features_choice = arg_obj['level'][0], arg_obj['features'][0]
+    if js_dirs is not None and (labels_d is None or len(js_dirs) != len(labels_d)):
+        logging.error('Please, indicate as many directory labels (--l option) as the number %s of '
+                      'directories to analyze', str(len(js_dirs)))
+        return
+
+    features_path = os.path.join(analysis_path, 'Features')
+    utility.check_folder_exists(features_path)
+    features2int_dict_path = os.path.join(features_path, features_choice,
+                                          level + '_selected_features_99')
+    if arg_obj['vd'] is not None:
+        if js_dirs is None:
+            logging.error('Please, indicate the directories (--d option) to preselect the '
+                          'features from')
+            return
+        features_preselection.handle_features_all(js_dirs, labels_d, level, features_choice,
+                                                  features_path, n)
+        features_selection.store_features_all(arg_obj['vd'], arg_obj['vl'], level,
+                                              features_choice, features_path, n)
+    elif not os.path.isfile(features2int_dict_path):
+        logging.error('No features selected in %s, please indicate the 2 JS directories (--vd '
+                      'option) with corresponding labels (--vl option) to select them',
+                      features2int_dict_path)
+        return
+
+    evaluation_path = os.path.join(analysis_path, 'Evaluation')
+    store_path = arg_obj['store'][0] or os.path.join(evaluation_path, features_choice + '_'
+                                                     + level + '_n' + str(n))
+    evaluate(js_dirs, labels_d, level, features_choice, n, features2int_dict_path, store_path,
+             arg_obj['out'][0] or evaluation_path, sorted(set(arg_obj['nt'])), arg_obj['th'],
+             folds=arg_obj['folds'][0])
+
+
+if __name__ == "__main__":  # Executed only if run as a script
+    main_evaluation()
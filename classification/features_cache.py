@@ -0,0 +1,171 @@
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    On-disk cache of the raw features counts of each file, so that the features of a given file
+    are extracted only once per (level, features_choice, n). The cache directory is given by
+    CACHE_DIR in utility.py.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import numpy as np
+
+import utility
+from features_hashing import feature_id
+
+
+EXTRACTOR_VERSION = 1  # To increase each time the features extraction changes
+
+
+def encode_features(features):
+    """ Encodes a list of features (tuples of JSON scalars or tuples) as a JSON string, so that
+    decode_features returns them unchanged. Raises TypeError for any other type, instead of
+    storing a lossy representation of it. """
+
+    return json.dumps(features)
+
+
+def list2tuple(feature):
+    """ JSON decodes tuples as lists; features only contain tuples. """
+
+    if isinstance(feature, list):
+        return tuple(list2tuple(el) for el in feature)
+    return feature
+
+
+def decode_features(features_json):
+    """ Inverse of encode_features. """
+
+    return [list2tuple(feature) for feature in json.loads(features_json)]
+
+
+def file_digest(file_path):
+    """ Hash of a file content. """
+
+    with open(file_path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+class FeaturesCache:
+    """
+        Raw features counts of files, for a given (level, features_choice, n, hash_bits).
+        One .npz file per file content, storing the columns:
+            * ids: int64, feature_id of each feature;
+            * counts: int32, number of occurrences of each feature;
+            * meta: [valid, total_features, pdg_size] (valid being 0 if no feature was extracted);
+            * features: the features themselves, JSON-encoded (UTF-8 bytes), only read when needed.
+    """
+
+    def __init__(self, cache_dir, level, features_choice, n, hash_bits=None):
+        self.path = os.path.join(cache_dir, level + '_' + features_choice + '_' + str(n)
+                                 + ('' if hash_bits is None else '_h' + str(hash_bits))
+                                 + '_v' + str(EXTRACTOR_VERSION))
+        self.projection_dict = None
+        self.projection = None
+
+    def get_entry_path(self, file_path, digest=None):
+        """ Path of the cache entry of file_path, depending on its content (digest being
+        file_digest(file_path) if already computed). """
+        digest = file_digest(file_path) if digest is None else digest
+        return os.path.join(self.path, digest[:2], digest + '.npz')
+
+    @staticmethod
+    def load(entry_path, with_features=True):
+        """ Returns the cached [ids, counts, total_features, pdg_size, features] of an entry,
+        where features is None if not with_features, or None if the entry does not exist. """
+
+        if not os.path.isfile(entry_path):
+            return None
+        try:
+            with np.load(entry_path) as entry:
+                valid, total_features, pdg_size = entry['meta'].tolist()
+                pdg_size = pdg_size if pdg_size >= 0 else None
+                if not valid:
+                    return [None, None, None, pdg_size, None]
+                features = None
+                if with_features:
+                    features = decode_features(entry['features'].tobytes().decode('utf-8'))
+                return [entry['ids'], entry['counts'], total_features, pdg_size, features]
+        except Exception as e:
+            logging.error('Could not load %s from the cache: %s', entry_path, e)
+        return None
+
+    @staticmethod
+    def store(entry_path, features_dict, total_features, pdg_size):
+        """ Stores features counts in an entry (features_dict may be None). Features which
+        cannot be stored losslessly are not cached, i.e. extracted again each time. """
+
+        utility.check_folder_exists(entry_path)
+        pdg_size = -1 if pdg_size is None else pdg_size
+        if features_dict is None:
+            features, counts, meta = [], [], [0, 0, pdg_size]
+        else:
+            features, counts = list(features_dict.keys()), list(features_dict.values())
+            meta = [1, total_features, pdg_size]
+        try:
+            features_json = encode_features(features).encode('utf-8')
+        except (TypeError, ValueError) as e:
+            logging.warning('Could not cache %s: %s', entry_path, e)
+            return
+        tmp_path = (entry_path + '.' + str(os.getpid()) + '_' + str(threading.get_ident())
+                    + '.tmp.npz')
+        np.savez(tmp_path, ids=np.array([feature_id(f) for f in features], dtype=np.int64),
+                 counts=np.array(counts, dtype=np.int32), meta=np.array(meta, dtype=np.int64),
+                 features=np.frombuffer(features_json, dtype=np.uint8))
+        os.replace(tmp_path, entry_path)  # Atomic, several workers may handle the same content
+
+    def get_projection(self, features2int_dict):
+        """ Sorted feature ids of features2int_dict with their position in the vector space.
+        Computed once per dictionary. """
+
+        if self.projection_dict is not features2int_dict:
+            dict_ids = np.array([feature_id(f) for f in features2int_dict], dtype=np.int64)
+            cols = np.array(list(features2int_dict.values()), dtype=np.int32)
+            order = np.argsort(dict_ids)
+            self.projection_dict = features2int_dict
+            self.projection = (dict_ids[order], cols[order])
+        return self.projection
+
+    def project(self, ids, counts, total_features, features2int_dict):
+        """ Maps cached features counts to their (indices, data) representation in the vector
+        space of features2int_dict. """
+
+        dict_ids, cols = self.get_projection(features2int_dict)
+        if dict_ids.size == 0 or ids.size == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float64)
+        pos = np.minimum(np.searchsorted(dict_ids, ids), dict_ids.size - 1)
+        known = dict_ids[pos] == ids
+        indices = cols[pos[known]]
+        order = np.argsort(indices, kind='stable')
+        return indices[order], (counts[known] / total_features)[order]
+
+
+CACHES = dict()
+
+
+def get_cache(level, features_choice, n):
+    """ Returns the FeaturesCache for (level, features_choice, n) and the current hashing mode,
+    or None if utility.CACHE_DIR is None. """
+
+    if utility.CACHE_DIR is None:
+        return None
+    hash_bits = utility.HASH_BITS if features_choice == 'value' else None
+    key = (utility.CACHE_DIR, level, features_choice, n, hash_bits)
+    if key not in CACHES:
+        CACHES[key] = FeaturesCache(utility.CACHE_DIR, level, features_choice, n, hash_bits)
+    return CACHES[key]
@@ -0,0 +1,251 @@
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    Exact features counters stored on disk, sharded by feature_id, so that the number of files
+    each feature appears in can be counted on a corpus whose features do not fit in memory.
+    Counters built on several machines are merged by gathering their chunks.
+"""
+
+import os
+import json
+import uuid
+import shutil
+import logging
+import numpy as np
+
+import utility
+import features_cache
+from features_hashing import feature_id
+
+
+NB_SHARDS = 64
+MAX_ENTRIES = 2 ** 20  # Features buffered in memory before being written to disk
+
+
+class ShardedCounter:
+    """
+        Number of samples each feature appears in, with the total number of samples.
+        Directory layout:
+            * config.json: {"nb_shards": NB_SHARDS};
+            * <shard>/<chunk>.npz: features (JSON-encoded, UTF-8 bytes) and counts of a flush,
+            with its origins;
+            * totals/<chunk>.json: {"nb_samples": number of samples added in the flush,
+            "origins": its origins}.
+        The origins of a chunk are the names of the flushes whose counts it holds: the chunk's
+        own name when flushed, the union of the compacted chunks' origins when compacted. They
+        tell which counts a counter already holds, so that merging the chunks of several
+        counters never counts a flush twice, whatever the compactions in between.
+    """
+
+    def __init__(self, path, nb_shards=NB_SHARDS, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.buffer = dict()
+        self.nb_samples = 0
+        config_path = os.path.join(path, 'config.json')
+        if os.path.isfile(config_path):
+            with open(config_path) as config_file:
+                nb_shards = json.load(config_file)['nb_shards']
+        else:
+            utility.check_folder_exists(config_path)
+            with open(config_path, 'w') as config_file:
+                json.dump({'nb_shards': nb_shards}, config_file)
+        self.nb_shards = nb_shards
+
+    def add(self, features):
+        """ Counts the features of a sample (each feature once). """
+
+        for feature in features:
+            self.buffer[feature] = self.buffer.get(feature, 0) + 1
+        self.nb_samples += 1
+        if len(self.buffer) >= self.max_entries:
+            self.flush()
+
+    def flush(self):
+        """ Writes the buffered counts to disk, one chunk per shard. """
+
+        if not self.buffer and not self.nb_samples:
+            return
+        chunk_name = uuid.uuid4().hex
+        shards = [[] for _ in range(self.nb_shards)]
+        for feature, count in self.buffer.items():
+            shards[feature_id(feature) % self.nb_shards].append((feature, count))
+        for shard, shard_counts in enumerate(shards):
+            if shard_counts:
+                self.write_chunk(shard, chunk_name, dict(shard_counts), [chunk_name])
+        self.write_totals(chunk_name, self.nb_samples, [chunk_name])
+        self.buffer = dict()
+        self.nb_samples = 0
+
+    def write_chunk(self, shard, chunk_name, counts_dict, origins):
+        """ Writes the dict feature: count of a chunk of shard. """
+
+        features_json = features_cache.encode_features(list(counts_dict)).encode('utf-8')
+        write_atomic(os.path.join(self.path, str(shard), chunk_name + '.npz'),
+                     lambda f: np.savez(f, counts=np.array(list(counts_dict.values()),
+                                                           dtype=np.int64),
+                                        features=np.frombuffer(features_json, dtype=np.uint8),
+                                        origins=np.array(sorted(origins))))
+
+    def write_totals(self, chunk_name, nb_samples, origins):
+        """ Writes the number of samples of a chunk. """
+
+        write_atomic(os.path.join(self.path, 'totals', chunk_name + '.json'),
+                     lambda f: f.write(json.dumps({'nb_samples': nb_samples,
+                                                   'origins': sorted(origins)}).encode('utf-8')))
+
+    def get_chunks(self, folder):
+        folder = os.path.join(self.path, folder)
+        if not os.path.isdir(folder):
+            return []
+        return sorted(os.path.join(folder, chunk) for chunk in os.listdir(folder)
+                      if not chunk.endswith('.tmp'))
+
+    @staticmethod
+    def get_origins(chunk_path):
+        """ Origins of a chunk; a chunk written before the origins were stored is its own. """
+
+        if chunk_path.endswith('.json'):
+            with open(chunk_path) as chunk_file:
+                origins = json.load(chunk_file).get('origins')
+        else:
+            with np.load(chunk_path) as chunk:
+                origins = chunk['origins'].tolist() if 'origins' in chunk.files else None
+        if origins is None:
+            origins = [os.path.splitext(os.path.basename(chunk_path))[0]]
+        return set(origins)
+
+    def get_nb_samples(self):
+        """ Total number of samples counted (flushed ones). """
+
+        nb_samples = 0
+        for chunk_path in self.get_chunks('totals'):
+            with open(chunk_path) as chunk_file:
+                nb_samples += json.load(chunk_file)['nb_samples']
+        return nb_samples
+
+    def get_shard(self, shard):
+        """ Returns the dict feature: count of a shard, summing its chunks. The features are
+        sorted, as the chunks' order depends on the order the samples were counted in. """
+
+        counts_dict = dict()
+        for chunk_path in self.get_chunks(str(shard)):
+            with np.load(chunk_path) as chunk:
+                features = features_cache.decode_features(
+                    chunk['features'].tobytes().decode('utf-8'))
+                counts = chunk['counts'].tolist()
+            for feature, count in zip(features, counts):
+                counts_dict[feature] = counts_dict.get(feature, 0) + count
+        return {feature: counts_dict[feature] for feature in sorted(counts_dict, key=repr)}
+
+    def iter_shards(self):
+        """ Yields the dict feature: count of each shard; one shard in memory at a time. """
+
+        self.flush()
+        for shard in range(self.nb_shards):
+            yield self.get_shard(shard)
+
+    def get_features(self, min_count=0):
+        """ dict feature: count of the features counted more than min_count times. """
+
+        return {feature: count for counts_dict in self.iter_shards()
+                for feature, count in counts_dict.items() if count > min_count}
+
+    def compact(self):
+        """ Rewrites each shard as a single chunk, keeping the origins of its chunks. """
+
+        self.flush()
+        for shard in range(self.nb_shards):
+            chunks = self.get_chunks(str(shard))
+            if len(chunks) > 1:
+                origins = set().union(*[self.get_origins(chunk) for chunk in chunks])
+                self.write_chunk(shard, uuid.uuid4().hex, self.get_shard(shard), origins)
+                for chunk_path in chunks:
+                    os.remove(chunk_path)
+        totals = self.get_chunks('totals')
+        if len(totals) > 1:
+            origins = set().union(*[self.get_origins(chunk) for chunk in totals])
+            self.write_totals(uuid.uuid4().hex, self.get_nb_samples(), origins)
+            for chunk_path in totals:
+                os.remove(chunk_path)
+
+    def merge(self, counter_path):
+        """ Adds the counts of the counter stored in counter_path (e.g. built on another
+        machine), by copying its chunks whose origins are not in this counter yet. Nothing is
+        merged if a chunk holds both counts already merged and new ones, i.e. if the counter
+        counted more samples then was compacted since it was last merged. """
+
+        other = ShardedCounter(counter_path)
+        if other.nb_shards != self.nb_shards:
+            logging.error('Cannot merge %s (%s shards) into %s (%s shards)', counter_path,
+                          str(other.nb_shards), self.path, str(self.nb_shards))
+            return
+        chunks2copy = list()
+        for folder in [str(shard) for shard in range(self.nb_shards)] + ['totals']:
+            merged = set().union(*[self.get_origins(chunk) for chunk in self.get_chunks(folder)])
+            for chunk_path in other.get_chunks(folder):
+                origins = self.get_origins(chunk_path)
+                if origins & merged and not origins <= merged:
+                    logging.error('Cannot merge %s into %s: its chunk %s holds counts already '
+                                  'merged and new ones (it was compacted since it was last '
+                                  'merged)', counter_path, self.path, chunk_path)
+                    return
+                if not origins & merged:
+                    chunks2copy.append(os.path.join(folder, os.path.basename(chunk_path)))
+        for chunk_name in chunks2copy:
+            dst_path = os.path.join(self.path, chunk_name)
+            utility.check_folder_exists(dst_path)
+            shutil.copyfile(os.path.join(counter_path, chunk_name), dst_path + '.tmp')
+            os.replace(dst_path + '.tmp', dst_path)
+
+
+def write_atomic(path, write):
+    """ Calls write on a temporary file then renames it to path. """
+
+    utility.check_folder_exists(path)
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def get_counter_path(features_dict_path):
+    """ Path of the counter corresponding to a (pickled) features dictionary path. """
+
+    return features_dict_path + '_counts'
+
+
+def replace_counter(counter_path, new_counter_path):
+    """ Replaces the counter counter_path (if any) by the counter new_counter_path, e.g. built
+    from scratch next to it. """
+
+    old_counter_path = counter_path + '.' + uuid.uuid4().hex + '.old'
+    if os.path.isdir(counter_path):
+        os.rename(counter_path, old_counter_path)
+    os.rename(new_counter_path, counter_path)
+    shutil.rmtree(old_counter_path, ignore_errors=True)
+
+
+def merge_counters(counter_path, counters_path_list):
+    """ Merges the counters of counters_path_list into counter_path; TO CALL, e.g. with the
+    counters of the same directory analyzed on several machines. """
+
+    nb_shards = NB_SHARDS
+    if counters_path_list and not os.path.isfile(os.path.join(counter_path, 'config.json')):
+        nb_shards = ShardedCounter(counters_path_list[0]).nb_shards
+    counter = ShardedCounter(counter_path, nb_shards)
+    for other_path in counters_path_list:
+        counter.merge(other_path)
+    counter.compact()
@@ -17,8 +17,10 @@
 
 import logging
 
+import utility
 import features_ngrams
 import features_value
+import features_hashing
 
 
 def n_grams_list(numbers_list, n):
@@ -69,6 +71,13 @@ def count_ngrams(file_repr, level, n):
     """
 
     features_list, pdg_size = features_ngrams.extract_features(file_repr, level)
+    dico_of_n_grams, nb_n_grams = count_ngrams_list(features_list, n)
+    return dico_of_n_grams, nb_n_grams, pdg_size
+
+
+def count_ngrams_list(features_list, n):
+    """ count_ngrams for a list of units already extracted. """
+
     matrix_all_n_grams = n_grams_list(features_list, n)
     # Each row: tuple representing an n-gram.
 
@@ -81,14 +90,22 @@ def count_ngrams(file_repr, level, n):
             else:
                 dico_of_n_grams[matrix_all_n_grams[j]] = 1
 
-        return dico_of_n_grams, len(matrix_all_n_grams), pdg_size
-    return None, None, pdg_size
+        return dico_of_n_grams, len(matrix_all_n_grams)
+    return None, None
 
 
 def count_value(file_repr, level):
     """ Returns (context, value) features + the total number of features. """
 
     features_list, pdg_size = features_value.extract_features(file_repr, level)
+    unique_features_dict, nb_features = count_value_list(features_list)
+    return unique_features_dict, nb_features, pdg_size
+
+
+def count_value_list(features_list):
+    """ count_value for a list of (context, value) features already extracted. The features are
+    replaced by their hash in the hashing mode (see features_hashing.py). """
+
     if features_list is not None:
         unique_features_dict = dict()
         for feature in features_list:
@@ -96,8 +113,105 @@ def count_value(file_repr, level):
                 unique_features_dict[feature] = 1
             else:
                 unique_features_dict[feature] += 1
-        return unique_features_dict, len(features_list), pdg_size
-    return None, None, pdg_size
+        if utility.HASH_BITS is not None:
+            unique_features_dict = features_hashing.hash_features_dict(unique_features_dict)
+        return unique_features_dict, len(features_list)
+    return None, None
+
+
+def get_units_modules(js_path, pdg_path, units_modules):
+    """
+        Extracts the units of several (level, features_choice) at once. The JS file is tokenized
+        at most once and the PDG is loaded at most once. The ngrams and value units of a level
+        come from the same traversal when possible (see features_value.NAMES_LEVELS).
+
+        -------
+        Parameters:
+        - js_path: str
+            Path of the JS file, for the 'tokens' level.
+        - pdg_path: str
+            Path of the PDG of the JS file, for the other levels.
+        - units_modules: list of (level, features_choice)
+
+        -------
+        Returns:
+        - dict
+            Key: (level, features_choice);
+            Value: [units converted into numbers or None, pdg_size].
+    """
+
+    res = dict()
+
+    tokens_choices = [choice for (level, choice) in units_modules if level == 'tokens']
+    if tokens_choices:
+        if 'value' in tokens_choices:  # The tokens with their value also give the tokens alone
+            tokens_value = features_value.get_tokens_features(js_path)
+            tokens = None if tokens_value is None else [token for token, _ in tokens_value]
+        else:
+            tokens_value, tokens = None, features_ngrams.get_tokens_features(js_path)
+        units = {'ngrams': tokens, 'value': tokens_value}
+        for choice in tokens_choices:
+            extract = features_ngrams if choice == 'ngrams' else features_value
+            res[('tokens', choice)] = [extract.units2int(units[choice], 'tokens'), None]
+
+    pdg_modules = [(level, choice) for (level, choice) in units_modules if level != 'tokens']
+    if pdg_modules:
+        pdg, pdg_size = None, None
+        try:
+            pdg, pdg_size = features_ngrams.load_pdg(pdg_path)  # Loaded once for all levels
+        except:
+            logging.error('The PDG of %s could not be loaded', pdg_path)
+        # The value traversals of features_value.NAMES_LEVELS also give the ngrams units
+        names_levels = dict() if any(choice == 'ngrams' for (_, choice) in pdg_modules)\
+            else None
+        for choice in ('value', 'ngrams'):
+            levels = [level for (level, choice2) in pdg_modules if choice2 == choice]
+            if not levels:
+                continue
+            features_levels = dict()
+            if pdg is not None:
+                try:
+                    if choice == 'value':
+                        features_levels = features_value.get_syntactic_features_levels(
+                            pdg, levels, pdg_path, names_levels)
+                    else:
+                        features_levels = features_ngrams.get_syntactic_features_levels(
+                            pdg, levels, pdg_path, names_levels)
+                except:
+                    logging.error('The PDG of %s could not be traversed', pdg_path)
+                    if names_levels is not None:
+                        names_levels.clear()  # Possibly incomplete
+            extract = features_ngrams if choice == 'ngrams' else features_value
+            for level in levels:
+                res[(level, choice)] = [extract.units2int(features_levels.get(level), level),
+                                        pdg_size]
+
+    return res
+
+
+def count_modules(js_path, pdg_path, modules):
+    """
+        Features of several modules (level, features_choice, n) for the same file.
+
+        -------
+        Returns:
+        - dict
+            Key: (level, features_choice, n);
+            Value: (features_dict, total_features, pdg_size) as returned by count_ngrams or
+            count_value.
+    """
+
+    units_modules = list(dict.fromkeys((level, choice) for (level, choice, _) in modules))
+    units = get_units_modules(js_path, pdg_path, units_modules)
+
+    res = dict()
+    for (level, choice, n) in modules:
+        features_list, pdg_size = units[(level, choice)]
+        if choice == 'ngrams':
+            res[(level, choice, n)] = count_ngrams_list(features_list, n) + (pdg_size,)
+        else:
+            res[(level, choice, n)] = count_value_list(features_list) + (pdg_size,)
+    return res
 
 
 def count_ngram_value(file_repr, level, n):
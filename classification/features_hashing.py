@@ -0,0 +1,360 @@
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    Hashing of the features: stable 64-bit ids, and hashing mode of the (context, value)
+    features, where each feature is replaced by its id truncated to HASH_BITS bits (HASH_BITS
+    defined in utility.py, None to disable the hashing mode). The features are then fixed-width
+    ints in all the features dictionaries, whatever the size of their value.
+    Hashing vectorizer, mapping the features to 2^VECTORIZER_BITS signed buckets instead of
+    looking them up in a features dictionary (VECTORIZER_BITS defined in utility.py, None to
+    use the features dictionary).
+"""
+
+import os
+import json
+import math
+import hashlib
+import logging
+import numpy as np
+
+import utility
+
+
+REPORT_HASH_BITS = (16, 24, 32)  # Numbers of bits whose collisions the selection report gives
+
+
+def feature_id(feature):
+    """ Stable 64-bit id of a feature, identical across processes and runs. """
+
+    digest = hashlib.blake2b(repr(feature).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+def hash_feature(feature, hash_bits=64):
+    """ feature_id of a feature, truncated to its hash_bits lowest bits if hash_bits < 64. """
+
+    if hash_bits >= 64:
+        return feature_id(feature)
+    return feature_id(feature) & ((1 << hash_bits) - 1)
+
+
+def hash_features_dict(features_dict, hash_bits=None):
+    """
+        Replaces the features of a file by their hash, summing the occurrences of the features
+        colliding.
+
+        -------
+        Parameters:
+        - features_dict: dict
+            Key: feature;
+            Value: number of occurrences of the feature.
+        - hash_bits: int
+            Number of bits of the hashes. Default: utility.HASH_BITS.
+
+        -------
+        Returns:
+        - dict
+            Key: hash of a feature;
+            Value: number of occurrences of the features with this hash.
+    """
+
+    hash_bits = utility.HASH_BITS if hash_bits is None else hash_bits
+    hashed_dict = dict()
+    for feature, nb_occurrences in features_dict.items():
+        feature_hash = hash_feature(feature, hash_bits)
+        hashed_dict[feature_hash] = hashed_dict.get(feature_hash, 0) + nb_occurrences
+    if len(hashed_dict) != len(features_dict):
+        logging.debug('%s hash collisions with %s bits',
+                      str(len(features_dict) - len(hashed_dict)), str(hash_bits))
+    return hashed_dict
+
+
+def get_collision_stats(features, hash_bits):
+    """
+        Collision statistics of the hashes of distinct features, e.g. of all the features
+        found in a corpus, to choose hash_bits.
+
+        -------
+        Returns:
+        - dict
+            * features: number of distinct features;
+            * hashes: number of distinct hashes;
+            * collisions: number of features sharing their hash with a previous one;
+            * expected_collisions: expected number of collisions for random hashes.
+    """
+
+    features = set(features)
+    hashes = set(hash_feature(feature, hash_bits) for feature in features)
+    nb_buckets = 2 ** hash_bits
+    nb_features = len(features)
+    if nb_features < nb_buckets / 1000:  # Birthday approximation, n^2 / 2m
+        expected_collisions = nb_features * (nb_features - 1) / (2 * nb_buckets)
+    else:  # n - expected number of occupied buckets, i.e. n - m * (1 - (1 - 1/m)^n)
+        expected_collisions = nb_features + nb_buckets * math.expm1(
+            nb_features * math.log1p(-1 / nb_buckets))
+    return {'features': nb_features, 'hashes': len(hashes),
+            'collisions': nb_features - len(hashes), 'expected_collisions': expected_collisions}
+
+
+def get_collision_report(features, hash_bits_list=REPORT_HASH_BITS):
+    """ get_collision_stats of features for each number of bits of hash_bits_list (key: str of
+    the number of bits), logged to help choosing --hash_bits. """
+
+    report = dict()
+    for hash_bits in hash_bits_list:
+        report[str(hash_bits)] = get_collision_stats(features, hash_bits)
+        logging.info('--hash_bits %s: %s collisions among %s features (%s expected)',
+                     str(hash_bits), str(report[str(hash_bits)]['collisions']),
+                     str(report[str(hash_bits)]['features']),
+                     str(round(report[str(hash_bits)]['expected_collisions'], 1)))
+    return report
+
+
+def check_features2int_dict(features2int_dict, features_choice):
+    """ Logs an error if features2int_dict was not built with the current hashing mode (then
+    no feature would be found in the vector space). """
+
+    if features_choice != 'value' or not features2int_dict:
+        return True
+    hashed = isinstance(next(iter(features2int_dict)), int)
+    if hashed != (utility.HASH_BITS is not None):
+        logging.error('The features dictionary was built %s the hashing mode, please %s the '
+                      '--hash_bits option', 'with' if hashed else 'without',
+                      'set' if hashed else 'unset')
+        return False
+    return True
+
+
+class HashingVectorizer:
+    """
+        Maps the features straight to the columns of the vector space: the feature_id of a
+        feature gives its bucket (VECTORIZER_BITS lowest bits) and its sign (next bit), and
+        bucket2col the column of the bucket (-1 if no selected feature falls in the bucket).
+        Replaces features2int_dict, i.e. len() is the number of columns, nb_features (computed
+        from bucket2col if not given).
+    """
+
+    def __init__(self, bucket2col, path=None, nb_features=None):
+        self.bucket2col = bucket2col
+        self.vectorizer_bits = int(len(bucket2col)).bit_length() - 1
+        if nb_features is None:
+            nb_features = int(bucket2col.max()) + 1 if len(bucket2col) else 0
+        self.nb_features = nb_features
+        self.path = path  # If stored, only the path is pickled (e.g. to the workers)
+
+    def __len__(self):
+        return self.nb_features
+
+    def __getstate__(self):
+        if self.path is not None:
+            return {'path': self.path, 'nb_features': self.nb_features}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'bucket2col' in state:
+            self.__dict__.update(state)
+        else:
+            self.__init__(np.load(state['path'], mmap_mode='r'), state['path'],
+                          state['nb_features'])
+
+    def get_buckets(self, ids):
+        """ Buckets and signs (+1 or -1) of features given by their feature_id. """
+
+        ids = np.asarray(ids, dtype=np.int64)
+        buckets = ids & ((1 << self.vectorizer_bits) - 1)
+        signs = 1 - 2 * ((ids >> self.vectorizer_bits) & 1)
+        return buckets, signs
+
+    def transform_ids(self, ids, counts, total_features):
+        """ Maps features counts, the features being given by their feature_id, to their
+        (indices, data) representation in the vector space. """
+
+        buckets, signs = self.get_buckets(ids)
+        cols = self.bucket2col[buckets]
+        known = cols >= 0
+        indices, inverse = np.unique(cols[known], return_inverse=True)
+        data = np.bincount(inverse, weights=signs[known] * np.asarray(counts)[known],
+                           minlength=len(indices)) / total_features
+        return indices.astype(np.int32), data
+
+    def transform_dict(self, features_dict, total_features):
+        """ transform_ids for a dict of features counts. """
+
+        ids = [feature_id(feature) for feature in features_dict]
+        return self.transform_ids(ids, list(features_dict.values()), total_features)
+
+
+def build_bucket2col(features2int_dict, vectorizer_bits):
+    """ Buckets mask of the selected features of features2int_dict: the buckets get their column
+    in the order of the features' position, the other buckets -1. Also returns the number of
+    columns. """
+
+    bucket2col = np.full(1 << vectorizer_bits, -1, dtype=np.int32)
+    vectorizer = HashingVectorizer(bucket2col, nb_features=0)
+    features = sorted(features2int_dict, key=features2int_dict.get)
+    buckets, _ = vectorizer.get_buckets([feature_id(feature) for feature in features])
+    col = 0
+    for bucket in buckets:
+        if bucket2col[bucket] < 0:
+            bucket2col[bucket] = col
+            col += 1
+    return bucket2col, col
+
+
+def get_bucket2col_path(features2int_dict_path, vectorizer_bits):
+    """ Path of the buckets mask of the features dictionary stored in features2int_dict_path
+    (next to it, or in it if it is a model bundle). Its metadata are in the same path, with the
+    extension .json instead of .npy. """
+
+    if os.path.isdir(features2int_dict_path):
+        return os.path.join(features2int_dict_path, 'buckets' + str(vectorizer_bits) + '.npy')
+    return features2int_dict_path + '_buckets' + str(vectorizer_bits) + '.npy'
+
+
+def store_vectorizer(features2int_dict_path, features2int_dict, vectorizer_bits=None):
+    """
+        Stores the buckets mask of features2int_dict, with its metadata (vectorizer_bits,
+        hash_bits and number of columns), for get_vectorizer. Called when the features are
+        selected (or the model bundle stored), i.e. at training time only.
+
+        -------
+        Parameters:
+        - features2int_dict_path: str
+            Path of the features dictionary, or of the model bundle.
+        - features2int_dict: dict
+            Selected features, key: feature, value: its column.
+        - vectorizer_bits: int
+            The vectorizer has 2^vectorizer_bits buckets. Default: utility.VECTORIZER_BITS.
+    """
+
+    vectorizer_bits = utility.VECTORIZER_BITS if vectorizer_bits is None else vectorizer_bits
+    bucket2col, nb_features = build_bucket2col(features2int_dict, vectorizer_bits)
+    bucket2col_path = get_bucket2col_path(features2int_dict_path, vectorizer_bits)
+    meta_path = bucket2col_path[:-len('.npy')] + '.json'
+    tmp_path = bucket2col_path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_path + '.json', 'w') as meta_file:
+        json.dump({'vectorizer_bits': vectorizer_bits, 'hash_bits': utility.HASH_BITS,
+                   'nb_features': nb_features}, meta_file)
+    os.replace(tmp_path + '.json', meta_path)
+    np.save(tmp_path + '.npy', bucket2col)
+    os.replace(tmp_path + '.npy', bucket2col_path)  # Last, get_vectorizer checks its date
+
+
+def get_vectorizer(features2int_dict_path, vectorizer_bits=None):
+    """
+        HashingVectorizer corresponding to the features dictionary stored in
+        features2int_dict_path, whose buckets mask was stored by store_vectorizer. The mask is
+        memory-mapped, and the dictionary is not loaded.
+
+        -------
+        Parameters:
+        - features2int_dict_path: str
+            Path of the features dictionary, or of the model bundle.
+        - vectorizer_bits: int
+            The vectorizer has 2^vectorizer_bits buckets. Default: utility.VECTORIZER_BITS.
+
+        -------
+        Returns:
+        - HashingVectorizer
+        - or None if the features were not selected with this vectorizer.
+    """
+
+    vectorizer_bits = utility.VECTORIZER_BITS if vectorizer_bits is None else vectorizer_bits
+    bucket2col_path = get_bucket2col_path(features2int_dict_path, vectorizer_bits)
+    meta_path = bucket2col_path[:-len('.npy')] + '.json'
+    if not os.path.isfile(bucket2col_path) or not os.path.isfile(meta_path):
+        logging.error('The features %s were not selected with --vectorizer_bits %s, please train '
+                      'the model with this option', features2int_dict_path, str(vectorizer_bits))
+        return None
+    if os.path.isfile(features2int_dict_path)\
+            and os.path.getmtime(features2int_dict_path) > os.path.getmtime(bucket2col_path):
+        logging.error('The features %s were selected again without --vectorizer_bits %s, please '
+                      'train the model with this option', features2int_dict_path,
+                      str(vectorizer_bits))
+        return None
+    with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+    if not check_hashing_config(meta, bucket2col_path, ('hash_bits',)):
+        return None
+    return HashingVectorizer(np.load(bucket2col_path, mmap_mode='r'), bucket2col_path,
+                             meta['nb_features'])
+
+
+def get_hashing_config():
+    """ Current hashing options, recorded with the models. """
+
+    return {'hash_bits': utility.HASH_BITS, 'vectorizer_bits': utility.VECTORIZER_BITS}
+
+
+def check_hashing_config(config, path, options=('hash_bits', 'vectorizer_bits')):
+    """ Logs an error and returns False if the options recorded in config (for the model or
+    features path) differ from the current ones. """
+
+    current_config = get_hashing_config()
+    for option in options:
+        if config.get(option) != current_config[option]:
+            logging.error('%s was built with --%s %s, got %s', path, option,
+                          str(config.get(option)), str(current_config[option]))
+            return False
+    return True
+
+
+def get_model_config_path(model_path):
+    """ Path of the hashing options of a model: in its folder if compiled, next to it if
+    pickled. Model bundles store them in their bundle.json instead. """
+
+    if os.path.isdir(model_path):
+        return os.path.join(model_path, 'hashing.json')
+    return model_path + '_hashing.json'
+
+
+def get_features_digest(features2int_dict_path):
+    """ Digest of the features dictionary a model was trained with, see
+    features_cache.file_digest. """
+
+    import features_cache  # Imports features_hashing
+
+    return features_cache.file_digest(features2int_dict_path)
+
+
+def store_model_config(model_path, features2int_dict_path=None):
+    """ Records the current hashing options with the model stored in model_path, and the
+    digest of its features dictionary features2int_dict_path if given. """
+
+    config = get_hashing_config()
+    if features2int_dict_path is not None:
+        config['features_digest'] = get_features_digest(features2int_dict_path)
+    with open(get_model_config_path(model_path), 'w') as config_file:
+        json.dump(config, config_file)
+
+
+def check_model_config(model_path, features2int_dict_path=None):
+    """ check_hashing_config for a pickled or compiled model and, if features2int_dict_path is
+    given, checks that the model was trained with this features dictionary. The models stored
+    before their options (or the digest of their features) were recorded are not checked. """
+
+    config_path = get_model_config_path(model_path)
+    if not os.path.isfile(config_path):
+        return True
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+    if not check_hashing_config(config, model_path):
+        return False
+    if features2int_dict_path is not None and 'features_digest' in config\
+            and config['features_digest'] != get_features_digest(features2int_dict_path):
+        logging.error('%s was trained with other features than the ones of %s, which were '
+                      'selected again', model_path, features2int_dict_path)
+        return False
+    return True
@@ -20,7 +20,7 @@ sys.path.insert(0, os.path.join(SRC_PATH, '..', 'pdg_generation'))
 import node as _node
 
 
-sys.setrecursionlimit(400000)  # Probably need it to unpickle BIG PDGs ;)
+PDG_RECURSION_LIMIT = 400000  # Probably need it to unpickle BIG PDGs ;)
 
 
 def get_tokens_features(input_file):
@@ -55,6 +55,7 @@ def get_ast_features(pdg, features_list, handled_set):
         units.
         The order of the units stored in the previous list resembles a tree traversal using
         the depth-first pre order.
+        Iterative version, with an explicit stack of children iterators.
 
         -------
         Parameters:
@@ -66,28 +67,50 @@ def get_ast_features(pdg, features_list, handled_set):
             Contains the nodes id handled so far.
     """
 
-    for child in pdg.children:
-        if child.id not in handled_set:
-            handled_set.add(child.id)
-            features_list.append(child.name)
-            get_ast_features(child, features_list, handled_set)
+    stack = [iter(pdg.children)]
+    while stack:
+        for child in stack[-1]:
+            if child.id not in handled_set:
+                handled_set.add(child.id)
+                features_list.append(child.name)
+                stack.append(iter(child.children))  # Goes down before the next sibling
+                break
+        else:
+            stack.pop()
 
 
 def get_size_subgraph(node, size=0):
     """ Gets a subtree size."""
-    for child in node.children:
-        size += 1
-        size = get_size_subgraph(child, size)
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        size += len(node.children)
+        stack.extend(node.children)
     return size
 
 
 def get_cfg_features(pdg, features_list, handled_set, handled_features_set):
     """ To provide complete code coverage while following only the CF. """
 
-    for child in pdg.children:
-        if child.id not in handled_set:
-            traverse_cfg(child, features_list, handled_set, handled_features_set)
-        get_cfg_features(child, features_list, handled_set, handled_features_set)
+    stack = [iter(pdg.children)]
+    while stack:
+        for child in stack[-1]:
+            if child.id not in handled_set:
+                traverse_cfg(child, features_list, handled_set, handled_features_set)
+            stack.append(iter(child.children))
+            break
+        else:
+            stack.pop()
+
+
+def enter_cfg(pdg, features_list, handled_features_set):
+    """ Handles pdg when traverse_cfg reaches it, returns an iterator on its CF. """
+
+    if pdg.control_dep_children:
+        features_list.append(pdg.name)
+        handled_features_set.add(pdg.id)  # Store id from features handled
+        get_ast_features(pdg, features_list, handled_features_set)  # Handled only once
+    return iter(pdg.control_dep_children)
 
 
 def traverse_cfg(pdg, features_list, handled_set, handled_features_set):
@@ -96,6 +119,7 @@ def traverse_cfg(pdg, features_list, handled_set, handled_features_set):
         units with a Control dependency.
         The order of the units stored in the previous list resembles a tree traversal using
         the depth-first pre order.
+        Iterative version, with an explicit stack of CF iterators.
 
         -------
         Parameters:
@@ -107,30 +131,46 @@ def traverse_cfg(pdg, features_list, handled_set, handled_features_set):
             Contains the nodes id handled so far.
     """
 
-    if pdg.control_dep_children:
-        features_list.append(pdg.name)
-        handled_features_set.add(pdg.id)  # Store id from features handled
-        get_ast_features(pdg, features_list, handled_features_set)  # Handled only once
-    for control_dep in pdg.control_dep_children:
-        control_flow = control_dep.extremity
-        # Otherwise missing CF pointing to a node already analyzed
-        if not control_flow.control_dep_children or control_flow.id in handled_set:
-            features_list.append(control_flow.name)
-        # else: the node name will be added while calling traverse_cfg
-        if control_flow.id not in handled_set:
-            handled_set.add(control_flow.id)
-            handled_features_set.add(control_flow.id)  # Store id from features
-            get_ast_features(control_flow, features_list, handled_features_set)  # Once
-            traverse_cfg(control_flow, features_list, handled_set, handled_features_set)
+    stack = [enter_cfg(pdg, features_list, handled_features_set)]
+    while stack:
+        for control_dep in stack[-1]:
+            control_flow = control_dep.extremity
+            # Otherwise missing CF pointing to a node already analyzed
+            if not control_flow.control_dep_children or control_flow.id in handled_set:
+                features_list.append(control_flow.name)
+            # else: the node name will be added while calling enter_cfg
+            if control_flow.id not in handled_set:
+                handled_set.add(control_flow.id)
+                handled_features_set.add(control_flow.id)  # Store id from features
+                get_ast_features(control_flow, features_list, handled_features_set)  # Once
+                stack.append(enter_cfg(control_flow, features_list, handled_features_set))
+                break
+        else:
+            stack.pop()
 
 
 def get_pdg_features(pdg, features_list, handled_set, handled_features_set):
     """ To provide complete code coverage while following only the CF. """
 
-    for child in pdg.children:
-        if child.id not in handled_set:
-            traverse_pdg(child, features_list, handled_set, handled_features_set)
-        get_pdg_features(child, features_list, handled_set, handled_features_set)
+    stack = [iter(pdg.children)]
+    while stack:
+        for child in stack[-1]:
+            if child.id not in handled_set:
+                traverse_pdg(child, features_list, handled_set, handled_features_set)
+            stack.append(iter(child.children))
+            break
+        else:
+            stack.pop()
+
+
+def enter_pdg(pdg, features_list, handled_features_set):
+    """ Handles pdg when traverse_pdg reaches it, returns an iterator on its DF. """
+
+    if pdg.data_dep_children:
+        features_list.append(pdg.name)
+        handled_features_set.add(pdg.id)  # Store id from features handled
+        get_ast_features(pdg, features_list, handled_features_set)  # Handled only once
+    return iter(pdg.data_dep_children)
 
 
 def traverse_pdg(pdg, features_list, handled_set, handled_features_set):
@@ -139,6 +179,7 @@ def traverse_pdg(pdg, features_list, handled_set, handled_features_set):
         units with a Data dependency.
         The order of the units stored in the previous list resembles a tree traversal using
         the depth-first pre order.
+        Iterative version, with an explicit stack of DF iterators.
 
         -------
         Parameters:
@@ -150,21 +191,22 @@ def traverse_pdg(pdg, features_list, handled_set, handled_features_set):
             Contains the nodes id handled so far.
     """
 
-    if pdg.data_dep_children:
-        features_list.append(pdg.name)
-        handled_features_set.add(pdg.id)  # Store id from features handled
-        get_ast_features(pdg, features_list, handled_features_set)  # Handled only once
-    for data_dep in pdg.data_dep_children:
-        data_flow = data_dep.extremity
-        # Otherwise missing CF pointing to a node already analyzed
-        if not data_flow.data_dep_children or data_flow.id in handled_set:
-            features_list.append(data_flow.name)
-        # else: the node name will be added while calling traverse_pdg
-        if data_flow.id not in handled_set:
-            handled_set.add(data_flow.id)
-            handled_features_set.add(data_flow.id)  # Store id from features
-            get_ast_features(data_flow, features_list, handled_features_set)  # Once
-            traverse_pdg(data_flow, features_list, handled_set, handled_features_set)
+    stack = [enter_pdg(pdg, features_list, handled_features_set)]
+    while stack:
+        for data_dep in stack[-1]:
+            data_flow = data_dep.extremity
+            # Otherwise missing CF pointing to a node already analyzed
+            if not data_flow.data_dep_children or data_flow.id in handled_set:
+                features_list.append(data_flow.name)
+            # else: the node name will be added while calling enter_pdg
+            if data_flow.id not in handled_set:
+                handled_set.add(data_flow.id)
+                handled_features_set.add(data_flow.id)  # Store id from features
+                get_ast_features(data_flow, features_list, handled_features_set)  # Once
+                stack.append(enter_pdg(data_flow, features_list, handled_features_set))
+                break
+        else:
+            stack.pop()
 
 
 def get_pdg_features_with_cfg(pdg, features_list, handled_set_pdg, handled_features_pdg_set,
@@ -194,6 +236,74 @@ def get_pdg_features_with_ast(pdg, features_list):
     get_ast_features(pdg, features_list, handled_features_pdg_set)  # Only nodes not handled yet
 
 
+def load_pdg(pdg_path):
+    """ Returns the PDG stored in pdg_path, or None if it is over 10MB, along with its size.
+    Raises an exception if the PDG could not be loaded. """
+
+    pdg_size = os.stat(pdg_path).st_size
+    if pdg_size < 10000000:  # Avoids handling PDGs over 10MB for perf reasons
+        # Set when a PDG is loaded rather than at import, also covers the traversals
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), PDG_RECURSION_LIMIT))
+        return pickle.load(open(pdg_path, 'rb')), pdg_size
+    return None, pdg_size
+
+
+def get_syntactic_features(pdg, level, pdg_path=None):
+    """ Dispatches the traversal of pdg corresponding to level. pdg_path is only for logging. """
+
+    features_list = list()
+    if level == 'ast':
+        if not pdg.children:
+            logging.warning('%s: benign (benign) _ EMPTY AST', pdg_path)
+        else:
+            get_ast_features(pdg, features_list=features_list, handled_set=set())
+    elif level == 'cfg':
+        get_cfg_features(pdg, features_list=features_list, handled_set=set(),
+                         handled_features_set=set())
+    elif level == 'pdg-dfg':
+        get_pdg_features(pdg, features_list=features_list, handled_set=set(),
+                         handled_features_set=set())
+    elif level == 'pdg':
+        get_pdg_features_with_cfg(pdg, features_list=features_list,
+                                  handled_set_pdg=set(), handled_set_cfg=set(),
+                                  handled_features_pdg_set=set(),
+                                  handled_features_cfg_set=set())
+    elif level == 'pdg-cfg-ast':
+        get_pdg_features_with_cfg_ast(pdg, features_list=features_list)
+    elif level == 'pdg-ast':
+        get_pdg_features_with_ast(pdg, features_list=features_list)
+    else:
+        logging.error('Expected \'ast\' or \'cfg\' or \'pdg-dfg\' or \'pdg\', '
+                      'got %s instead', level)
+    return features_list
+
+
+def get_syntactic_features_levels(pdg, levels, pdg_path=None, features_levels=None):
+    """
+        get_syntactic_features for several levels of the same PDG. The 'pdg' traversal being
+        the 'pdg-dfg' traversal followed by the 'cfg' one, they are only run once. The levels
+        in features_levels (key: level, value: its units) are not traversed again, see
+        features_value.get_syntactic_features_levels.
+
+        -------
+        Returns:
+        - dict
+            Key: level;
+            Value: list of the esprima syntactic units of the level.
+    """
+
+    features_levels = dict(features_levels or {})
+    for level in ('pdg-dfg', 'cfg'):
+        if (level in levels or 'pdg' in levels) and level not in features_levels:
+            features_levels[level] = get_syntactic_features(pdg, level, pdg_path)
+    if 'pdg' in levels:
+        features_levels['pdg'] = features_levels['pdg-dfg'] + features_levels['cfg']
+    for level in levels:
+        if level not in features_levels:
+            features_levels[level] = get_syntactic_features(pdg, level, pdg_path)
+    return {level: features_levels[level] for level in levels}
+
+
 def extract_syntactic_features(pdg_path, level):
     """
         Given an input JavaScript file, create a list containing the esprima syntactic
@@ -218,35 +328,10 @@ def extract_syntactic_features(pdg_path, level):
 
     logging.debug('Analysis of %s', pdg_path)
     try:
-        if os.stat(pdg_path).st_size < 10000000:  # Avoids handling PDGs over 10MB for perf reasons
-            pdg = pickle.load(open(pdg_path, 'rb'))
-            if pdg is not None:  # Not sure if it can be None
-                features_list = list()
-                if level == 'ast':
-                    if not pdg.children:
-                        print(pdg_path + ': ' + 'benign (benign) _ EMPTY AST')
-                    else:
-                        get_ast_features(pdg, features_list=features_list, handled_set=set())
-                elif level == 'cfg':
-                    get_cfg_features(pdg, features_list=features_list, handled_set=set(),
-                                     handled_features_set=set())
-                elif level == 'pdg-dfg':
-                    get_pdg_features(pdg, features_list=features_list, handled_set=set(),
-                                     handled_features_set=set())
-                elif level == 'pdg':
-                    get_pdg_features_with_cfg(pdg, features_list=features_list,
-                                              handled_set_pdg=set(), handled_set_cfg=set(),
-                                              handled_features_pdg_set=set(),
-                                              handled_features_cfg_set=set())
-                elif level == 'pdg-cfg-ast':
-                    get_pdg_features_with_cfg_ast(pdg, features_list=features_list)
-                elif level == 'pdg-ast':
-                    get_pdg_features_with_ast(pdg, features_list=features_list)
-                else:
-                    logging.error('Expected \'ast\' or \'cfg\' or \'pdg-dfg\' or \'pdg\', '
-                                  'got %s instead', level)
-                return features_list, os.stat(pdg_path).st_size
-        return None, os.stat(pdg_path).st_size
+        pdg, pdg_size = load_pdg(pdg_path)
+        if pdg is not None:  # Not sure if it can be None
+            return get_syntactic_features(pdg, level, pdg_path), pdg_size
+        return None, pdg_size
     except:
         logging.error('The PDG of %s could not be loaded', pdg_path)
     return None, None
@@ -277,11 +362,9 @@ def extract_features(file_repr, level):
     pdg_size = None
 
     if level in ('ast', 'cfg', 'pdg-dfg', 'pdg'):
-        dico_features = parser_esprima.AST_UNITS_DICO
         # List of syntactic units linked by parents, control or data flow
         features_list, pdg_size = extract_syntactic_features(file_repr, level)
     elif level == 'tokens':
-        dico_features = tokenizer_esprima.TOKENS_DICO
         features_list = get_tokens_features(file_repr)  # List of lexical units (tokens)
     else:
         features_list = None
@@ -289,6 +372,18 @@ def extract_features(file_repr, level):
                       'got %s instead', level)
     # print(features_list)
 
+    return units2int(features_list, level), pdg_size
+
+
+def units2int(features_list, level):
+    """ Converts units into their corresponding numbers, or returns None if features_list is
+    empty. """
+
+    if level == 'tokens':
+        dico_features = tokenizer_esprima.TOKENS_DICO
+    else:
+        dico_features = parser_esprima.AST_UNITS_DICO
+
     if features_list is not None and features_list != []:
-        return list(map(lambda x: dico_features[x], features_list)), pdg_size
-    return None, pdg_size
+        return list(map(lambda x: dico_features[x], features_list))
+    return None
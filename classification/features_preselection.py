@@ -17,57 +17,58 @@
 """
 
 import os
+import uuid
 import pickle
+import shutil
 import logging
 import timeit
-from multiprocessing import Process, Queue
-import queue  # For the exception queue.Empty which is not in the multiprocessing package
+from functools import partial
 
 import features_space
+import features_counters
 import static_analysis
-import utility
+import parallel
 
 
 SRC_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
 
-def handle_features_1file(unique_features_dict, all_features_dict):
-    """ Fills a dict with the encountered features + the number of files they have been seen in.
-    Case one file. """
-
-    for feature in unique_features_dict:
-        if feature not in all_features_dict:
-            all_features_dict[feature] = 1
-        else:
-            all_features_dict[feature] += 1
-
-
 def handle_features_1dir(samples_dir, label, level, features_choice, n, analysis_path):
-    """ handle_features_1file for ALL files from a directory.
+    """ Counts the number of files ALL features from a directory appear in, as they are
+    extracted, in an on-disk counter (see features_counters.py). The counter is built from
+    scratch, then replaces the one of a former analysis.
     Case one folder. """
 
     if not os.path.exists(analysis_path):
         os.makedirs(analysis_path)
 
     pickle_path = os.path.join(analysis_path, features_choice, level + '_all_features_' + label)
-    utility.check_folder_exists(pickle_path)
-
-    if os.path.isfile(pickle_path):
-        all_features_dict = pickle.load(open(pickle_path, 'rb'))
-    else:
-        all_features_dict = dict()
-
-    analyses = get_features_all_files_multiproc(samples_dir, level, features_choice, n)
-
-    for analysis in analyses:
-        features_dict = analysis.features
-        if features_dict is not None:
-            try:
-                handle_features_1file(features_dict, all_features_dict)
-            except:
-                logging.exception('Something went wrong with %s', analysis.file_path)
-
-    pickle.dump(all_features_dict, open(pickle_path, 'wb'))
+    counter_path = features_counters.get_counter_path(pickle_path)
+    tmp_counter_path = counter_path + '.' + uuid.uuid4().hex + '.tmp'
+    try:
+        counter = features_counters.ShardedCounter(tmp_counter_path)
+        for analysis in get_features_all_files_multiproc(samples_dir, level, features_choice, n):
+            features_dict = analysis.features
+            if features_dict is not None:
+                try:
+                    counter.add(features_dict)
+                except:
+                    logging.exception('Something went wrong with %s', analysis.pdg_path)
+        counter.flush()
+        features_counters.replace_counter(counter_path, tmp_counter_path)
+    finally:
+        shutil.rmtree(tmp_counter_path, ignore_errors=True)
+
+
+def load_all_features(all_features_dict_path, min_count=0):
+    """ Loads the features of all_features_dict_path appearing in more than min_count files,
+    from its counter, or from the pickled dict of a former analysis. """
+
+    counter_path = features_counters.get_counter_path(all_features_dict_path)
+    if os.path.isdir(counter_path):
+        return features_counters.ShardedCounter(counter_path).get_features(min_count)
+    all_features_dict = pickle.load(open(all_features_dict_path, 'rb'))
+    return {feature: count for feature, count in all_features_dict.items() if count > min_count}
 
 
 def handle_features_all(js_dirs, labels, level, features_choice, analysis_path, n=4):
@@ -83,64 +84,25 @@ def handle_features_all(js_dirs, labels, level, features_choice, analysis_path,
                       'got %s instead', level)
 
 
-def worker_get_features(my_queue, out_queue, except_queue):
-    """ Worker to get the features."""
+def get_features_analysis(analysis, level, features_choice, n):
+    """ Returns analysis with its features attribute filled. """
 
-    while True:
-        try:
-            [analysis, level, features_choice, n] = my_queue.get(timeout=2)
-            try:
-                features, _, _ = features_space.get_features(analysis.pdg_path,
-                                                             level, features_choice, n)
-                analysis.set_features(features)
-                out_queue.put(analysis)  # To share modified analysis object between processes
-            except Exception as e:  # Handle exception occurring in the processes spawned
-                logging.error('Something went wrong with %s', analysis.pdg_path)
-                print(e)
-                except_queue.put([analysis.pdg_path, e])
-        except queue.Empty:  # Empty queue exception
-            break
+    features, _, _ = features_space.get_features(analysis.pdg_path, level, features_choice, n)
+    analysis.set_features(features)
+    return analysis
 
 
 def get_features_all_files_multiproc(samples_dir, level, features_choice, n):
     """
-        Gets the features of all files from samples_dir.
+        Yields the analyses of all files from samples_dir, with their features, as they are
+        extracted.
     """
 
-    my_queue = Queue()
-    out_queue = Queue()
-    except_queue = Queue()
-    workers = list()
-
-    for sample in os.listdir(samples_dir):
-        sample_path = os.path.join(samples_dir, sample)
-        analysis = static_analysis.Analysis(pdg_path=sample_path)
-        my_queue.put([analysis, level, features_choice, n])
-
-    for _ in range(utility.NUM_WORKERS):
-        p = Process(target=worker_get_features, args=(my_queue, out_queue, except_queue))
-        p.start()
-        workers.append(p)
-
-    analyses = list()
-
-    while True:
-        try:
-            analysis = out_queue.get(timeout=0.01)
-            analyses.append(analysis)
-        except queue.Empty:
-            pass
-        all_exited = True
-        for w in workers:  # Instead of join, as the worker cannot be joined when elements
-            # are still in except_queue or out_queue, so it deadlocks. But they must be
-            # joined before the elements are taken out of the queue
-            if w.exitcode is None:
-                all_exited = False
-                break
-        if all_exited & out_queue.empty():
-            break
-
-    return analyses
+    analyses = [static_analysis.Analysis(pdg_path=os.path.join(samples_dir, sample))
+                for sample in os.listdir(samples_dir)]
+    return parallel.parallel_imap(partial(get_features_analysis, level=level,
+                                          features_choice=features_choice, n=n), analyses,
+                                  ordered=False)
 
 
 def get_top_dict_entries(top, my_dict):
@@ -17,38 +17,46 @@
 """
 
 import os
+import json
 import pickle
 import logging
 import timeit
-from multiprocessing import Process, Queue
-import queue  # For the exception queue.Empty which is not in the multiprocessing package
-from scipy.stats import chi2_contingency, chi2
+from functools import partial
+import numpy as np
 
 import features_preselection
+import features_hashing
+import features_space
 import static_analysis
 import utility
+import parallel
 
 
 SRC_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MIN_SUPPORT = 10  # Only the features found in more files are analyzed
+BATCH_SIZE = 4096  # Number of validation files whose presence matrix is in memory at once
+CRITERIA = ['chi2', 'mi']  # Scores of the features, see get_scores
 
 
-def get_popular_features(all_features_dict):
-    """ Gets the features used more than one time. """
+def get_popular_features(all_features_dict, min_support=MIN_SUPPORT):
+    """ Gets the features used more than min_support times. """
     popular_features = dict()
     for k, v in all_features_dict.items():
-        if v > 10:  # Tested with chi2, to ensure that feature and classification are dependent
+        if v > min_support:  # Tested with chi2, to ensure that feature and classification
+            # are dependent
             popular_features[k] = v
     return popular_features
 
 
-def initialize_analyzed_features_dict(all_features_dict1, all_features_dict2):
+def initialize_analyzed_features_dict(all_features_dict1, all_features_dict2,
+                                      min_support=MIN_SUPPORT):
     """ Create the analyzed_features_dict with all expected features (from all_features_dict_path)
     as key and [0, 0, 0, 0] as value. """
 
     # all_features_dict = pickle.load(open(all_features_dict_path, 'rb'))
     analyzed_features_dict = dict()
-    popular_features1 = get_popular_features(all_features_dict1)
-    popular_features2 = get_popular_features(all_features_dict2)
+    popular_features1 = get_popular_features(all_features_dict1, min_support)
+    popular_features2 = get_popular_features(all_features_dict2, min_support)
 
     for feature in popular_features1:
         analyzed_features_dict[feature] = [0]*4
@@ -58,48 +66,79 @@ def initialize_analyzed_features_dict(all_features_dict1, all_features_dict2):
     return analyzed_features_dict
 
 
-def analyze_features(analyzed_features_dict, features_sample, label):
+def get_presence_matrix(analyses, features2int_dict):
+    """
+        Sparse binary document-feature matrix: one row per analysis with a 1 in the column of
+        each feature of features2int_dict present in the sample.
+
+        -------
+        Parameters:
+        - analyses: list of Analysis
+            Samples with their features and label.
+        - features2int_dict: dict
+            Features to analyze, with their column.
+
+        -------
+        Returns:
+        - csr_matrix
+            Presence of the features per sample.
+        - list
+            Labels of the samples.
+    """
+
+    csr_builder = features_space.CsrBuilder(len(features2int_dict))
+    labels = list()
+    for analysis in analyses:
+        if analysis.features is not None:
+            indices = [features2int_dict[feature] for feature in analysis.features
+                       if feature in features2int_dict]
+            csr_builder.add_row(np.array(sorted(indices), dtype=np.int32),
+                                np.ones(len(indices), dtype=np.float64))
+            labels.append(analysis.label)
+    return csr_builder.get_csr(), labels
+
+
+def analyze_features(presence, labels):
     """
         Features' analysis before selection process. We count the number of times a given feature:
             * appear in a benign sample;
             * don't appear in a benign sample;
             * appear in a malicious sample;
             * don't appear in a malicious sample.
-        We do that by analyzing the features per sample.
+        We do that per class on the presence matrix, the absent counts being the number of
+        samples of the class minus the present counts.
 
         -------
         Parameters:
-        - analyzed_features_dict: dict
-            * Key: features to analyze;
-            * Value: [ben_with_f, ben_wo_f, mal_with_f, mal_wo_f].
-        - features_sample: dict
-            Features present in the considered sample.
-        - label: string
-            Label of the sample: 'benign' or 'malicious'.
+        - presence: csr_matrix
+            Output of get_presence_matrix, e.g. for a batch of samples.
+        - labels: list
+            Label of the samples: 'benign' or 'malicious'.
+
+        -------
+        Returns:
+        - np.array
+            One row [ben_with_f, ben_wo_f, mal_with_f, mal_wo_f] per column of presence, to be
+            summed over the batches.
     """
 
-    # Set of features that were not found in the current sample
-    features_not_sample = set(analyzed_features_dict.keys()) - set(features_sample.keys())
+    labels = np.array(labels)
+    if not np.isin(labels, ['benign', 'malicious']).all():
+        logging.error("The label should be 'benign' or 'malicious, got %s",
+                      set(labels.tolist()) - {'benign', 'malicious'})
 
-    if label == 'benign':
-        i = 0
-    elif label == 'malicious':
-        i = 2
-    else:
-        i = -1
-        logging.error("The label should be 'benign' or 'malicious, got %s", label)
+    counts = list()
+    for label in ('benign', 'malicious'):
+        presence_label = presence[np.flatnonzero(labels == label)]
+        with_f = np.bincount(presence_label.indices, minlength=presence.shape[1])
+        counts.extend([with_f, presence_label.shape[0] - with_f])
 
-    for feature in features_sample:
-        try:
-            analyzed_features_dict[feature][i] += 1  # Increase the feature is present counter
-        except KeyError as err:
-            logging.debug(err)
-    for feature in features_not_sample:
-        analyzed_features_dict[feature][i + 1] += 1  # Increase the feature not present counter
+    return np.stack(counts, axis=1)
 
 
 def analyze_features_all(all_features_dict1, all_features_dict2, samples_dir_list,
-                         labels_list, path_info, level, features_choice, n, analysis_path):
+                         labels_list, path_info, level, features_choice, n, analysis_path,
+                         min_support=MIN_SUPPORT):
     """ Produces a dict containing the number of occurrences (or not) of each expected feature
     with a distinction between benign and malicious files. """
 
@@ -118,16 +157,18 @@ def analyze_features_all(all_features_dict1, all_features_dict2, samples_dir_lis
     utility.check_folder_exists(pickle_path)
 
     analyzed_features_dict = initialize_analyzed_features_dict(all_features_dict1,
-                                                               all_features_dict2)
+                                                               all_features_dict2, min_support)
 
     analyses = get_features_all_files_multiproc(samples_dir_list, labels_list, level,
                                                 features_choice, n)
 
-    for analysis in analyses:
-        features_dict = analysis.features
-        label = analysis.label
-        if features_dict is not None:
-            analyze_features(analyzed_features_dict, features_dict, label)
+    # The analyses are consumed by batches as they are extracted, only the counts are kept
+    features2int_dict = {feature: i for i, feature in enumerate(analyzed_features_dict)}
+    counts = np.zeros((len(features2int_dict), 4), dtype=np.int64)
+    for batch in parallel.get_chunks(analyses, BATCH_SIZE):
+        presence, labels = get_presence_matrix(batch, features2int_dict)
+        counts += analyze_features(presence, labels)
+    analyzed_features_dict = dict(zip(analyzed_features_dict, counts.tolist()))
 
     pickle.dump(analyzed_features_dict, open(pickle_path, 'wb'))
 
@@ -136,65 +177,219 @@ def analyze_features_all(all_features_dict1, all_features_dict2, samples_dir_lis
 
 def get_chi(confidence):
     """ Gets the chi value for 1 degree of freedom and for a confidence in PERCENT. """
+    from scipy.stats import chi2  # Slow to import, only for the features selection
+
     return round(chi2.isf(q=1-confidence/100, df=1), 2)  # With 2 decimals
 
 
-def select_features(analyzed_features_dict, confidence):
-    """ chi2 test, based on the presence/absence of a given feature and depending on the sample's
-    ground truth. The confidence has to be given in percent. """
+def get_chi2_yates(contingency):
+    """
+        chi2 statistic with Yates' correction of 2x2 contingency tables, as computed by
+        scipy.stats.chi2_contingency, for all tables at once. The statistic is 0 for the tables
+        with an expected frequency of 0 (chi2_contingency raises a ValueError).
+
+        -------
+        Parameter:
+        - contingency: np.array
+            One row [ben_with_f, ben_wo_f, mal_with_f, mal_wo_f] per table.
+
+        -------
+        Returns:
+        - np.array
+            chi2 statistic of each table.
+    """
+
+    observed = np.asarray(contingency, dtype=np.float64).reshape(-1, 2, 2)
+    rows_sum = observed.sum(axis=2, keepdims=True)
+    cols_sum = observed.sum(axis=1, keepdims=True)
+    total = rows_sum.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = rows_sum * cols_sum / total
+        diff = expected - observed  # Yates' correction, no bigger than the difference
+        observed = observed + np.minimum(0.5, np.abs(diff)) * np.sign(diff)
+        terms = ((observed - expected) ** 2 / expected).reshape(-1, 4)
+    chi_square = ((terms[:, 0] + terms[:, 1]) + terms[:, 2]) + terms[:, 3]
+    chi_square[(expected.reshape(-1, 4) == 0).any(axis=1)] = 0
+    return chi_square
+
+
+def get_mutual_information(contingency):
+    """
+        Mutual information (in nats) between the presence of a feature and the label, from 2x2
+        contingency tables, for all tables at once. 2 * nb_samples * mutual information is the
+        G statistic of the table, following a chi2 distribution with 1 degree of freedom.
+
+        -------
+        Parameter:
+        - contingency: np.array
+            One row [ben_with_f, ben_wo_f, mal_with_f, mal_wo_f] per table.
+
+        -------
+        Returns:
+        - np.array
+            Mutual information of each table.
+    """
+
+    observed = np.asarray(contingency, dtype=np.float64).reshape(-1, 2, 2)
+    rows_sum = observed.sum(axis=2, keepdims=True)
+    cols_sum = observed.sum(axis=1, keepdims=True)
+    total = rows_sum.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = observed / total * np.log(observed * total / (rows_sum * cols_sum))
+    terms[observed == 0] = 0  # 0 log 0 = 0
+    return terms.reshape(-1, 4).sum(axis=1)
+
+
+def get_scores(contingency, criterion):
+    """ Scores of the features given by their contingency tables: chi2 statistic with Yates'
+    correction ('chi2') or mutual information ('mi'). """
+
+    if criterion == 'chi2':
+        return get_chi2_yates(contingency)
+    if criterion == 'mi':
+        return get_mutual_information(contingency)
+    logging.error('Unknown features selection criterion %s, expected one of %s', criterion,
+                  CRITERIA)
+    return np.full(len(contingency), np.nan)
+
+
+def select_features(analyzed_features_dict, confidence, criterion='chi2', top_k=None):
+    """
+        Selection of the features whose presence and the sample's ground truth are not
+        independent, given a confidence in percent:
+            * 'chi2': chi2 test with Yates' correction;
+            * 'mi': G-test, i.e. on the mutual information between presence and label.
+        If top_k is given, only the top_k dependent features with the highest scores are kept.
+        The selected features keep their order in analyzed_features_dict.
+
+        -------
+        Parameters:
+        - analyzed_features_dict: dict
+            Key: feature;
+            Value: [ben_with_f, ben_wo_f, mal_with_f, mal_wo_f].
+        - confidence: float
+            Confidence of the test, in percent.
+        - criterion: str
+            Either 'chi2' or 'mi'.
+        - top_k: int
+            Maximum number of features to select. Default: no maximum.
+
+        -------
+        Returns:
+        - dict
+            Key: selected feature;
+            Value: its position in the vector space.
+    """
 
     selected_features_dict = dict()
     pos = 0
     chi_critical = get_chi(confidence)
 
-    for feature in analyzed_features_dict:
-        ben_with_f, ben_wo_f, mal_with_f, mal_wo_f = analyzed_features_dict[feature]
+    if not analyzed_features_dict:
+        return selected_features_dict
+    contingency = np.array(list(analyzed_features_dict.values()), dtype=np.int64).reshape(-1, 4)
+    scores = get_scores(contingency, criterion)
 
-        try:
-            chi_square, _, _, _ = chi2_contingency([[ben_with_f, ben_wo_f], [mal_with_f, mal_wo_f]])
+    if criterion == 'mi':
+        statistics = 2 * contingency.sum(axis=1) * scores  # G statistic
+    else:
+        statistics = scores
+    selected = statistics >= chi_critical  # 'confidence'% confidence
+    if top_k is not None and np.count_nonzero(selected) > top_k:
+        candidates = np.flatnonzero(selected)
+        best = candidates[np.argsort(-scores[candidates], kind='stable')[:top_k]]
+        selected = np.zeros(len(scores), dtype=bool)
+        selected[best] = True
+
+    features = list(analyzed_features_dict)
+    for i in np.flatnonzero(selected).tolist():
+        selected_features_dict[features[i]] = pos
+        pos += 1
+    logging.debug('%s features whose presence and classification are not independent with %s',
+                  str(pos), criterion)
 
-        except ValueError:
-            chi_square = 0
+    return selected_features_dict
 
-        if chi_square >= chi_critical:  # 'confidence'% confidence
-            logging.debug('Feature presence and classification are not independent, chi2 = %s',
-                          str(chi_square))
-            selected_features_dict[feature] = pos
-            pos += 1
 
-    return selected_features_dict
+def get_selection_report(analyzed_features_dict, confidence, top_k=None, criteria=CRITERIA):
+    """
+        select_features with each criterion of criteria, with the number of features selected
+        and the selection time per criterion.
+
+        -------
+        Returns:
+        - dict
+            * analyzed: number of features analyzed;
+            * one entry per criterion: {'selected': number of features, 'time': seconds}.
+        - dict
+            Key: criterion;
+            Value: features selected with the criterion, see select_features.
+    """
+
+    report = {'analyzed': len(analyzed_features_dict), 'confidence': confidence, 'top_k': top_k}
+    selected_features_dicts = dict()
+    for criterion in criteria:
+        start = timeit.default_timer()
+        selected_features_dict = select_features(analyzed_features_dict, confidence, criterion,
+                                                 top_k)
+        report[criterion] = {'selected': len(selected_features_dict),
+                             'time': timeit.default_timer() - start}
+        selected_features_dicts[criterion] = selected_features_dict
+        logging.info('%s: %s features selected out of %s in %ss', criterion,
+                     str(len(selected_features_dict)), str(len(analyzed_features_dict)),
+                     str(round(report[criterion]['time'], 3)))
+    return report, selected_features_dicts
 
 
 def store_features(all_features_dict_path1, all_features_dict_path2, samples_dir_list,
                    labels_list, path_info, level, features_choice, analysis_path, n=4,
-                   analyzed_features_path=None, chi_confidence=99):
-    """ Stores the features selected by chi2 in a dict.
-        The confidence has to be given in percent. """
+                   analyzed_features_path=None, chi_confidence=99, criterion='chi2', top_k=None,
+                   min_support=MIN_SUPPORT, compare_criteria=False):
+    """ Stores the features selected by chi2 (or criterion, see select_features) in a dict,
+        and the selection report in a JSON file next to it, comparing all criteria if
+        compare_criteria. The confidence has to be given in percent. """
 
     pickle_path = os.path.join(analysis_path, features_choice,
                                level + '_selected_features_' + str(chi_confidence))
     utility.check_folder_exists(pickle_path)
 
     if analyzed_features_path is None:
-        all_features_dict1 = pickle.load(open(all_features_dict_path1, 'rb'))
-        all_features_dict2 = pickle.load(open(all_features_dict_path2, 'rb'))
+        # Only the popular features are loaded, one counter shard at a time
+        all_features_dict1 = features_preselection.load_all_features(all_features_dict_path1,
+                                                                     min_support)
+        all_features_dict2 = features_preselection.load_all_features(all_features_dict_path2,
+                                                                     min_support)
 
         analyzed_features_dict = analyze_features_all(all_features_dict1, all_features_dict2,
                                                       samples_dir_list, labels_list,
                                                       path_info, level, features_choice,
-                                                      n, analysis_path)
+                                                      n, analysis_path, min_support)
 
     else:
         analyzed_features_dict = pickle.load(open(analyzed_features_path, 'rb'))
 
-    selected_features_dict = select_features(analyzed_features_dict, chi_confidence)
+    report, selected_features_dicts = get_selection_report(
+        analyzed_features_dict, chi_confidence, top_k,
+        CRITERIA if compare_criteria else [criterion])
+    report['min_support'] = min_support
+    report['criterion'] = criterion
+    if features_choice == 'value' and utility.HASH_BITS is None:
+        report['hash_collisions'] = features_hashing.get_collision_report(analyzed_features_dict)
+    with open(pickle_path + '_report.json', 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+    selected_features_dict = selected_features_dicts[criterion]
     pickle.dump(selected_features_dict, open(pickle_path, 'wb'))
+    if utility.VECTORIZER_BITS is not None:  # The classifier only memory-maps its mask
+        features_hashing.store_vectorizer(pickle_path, selected_features_dict)
 
     return selected_features_dict
 
 
 def store_features_all(js_dirs_validate, labels_validate, level, features_choice,
-                       analysis_path, n=4, analyzed_features_path=None, chi_confidence=99):
+                       analysis_path, n=4, analyzed_features_path=None, chi_confidence=99,
+                       criterion='chi2', top_k=None, min_support=MIN_SUPPORT,
+                       compare_criteria=False):
     """ store_features for the 2 validation directories; TO CALL """
 
     features_path = os.path.join(analysis_path, features_choice, level + '_all_features_')
@@ -210,53 +405,24 @@ def store_features_all(js_dirs_validate, labels_validate, level, features_choice
                       '(--vl option), one has to be \'benign\' and the other \'malicious\', the '
                       'order should correspond to the folder order, got %s', labels_validate)
 
-    logging.debug('Currently selecting the features with chi2')
+    logging.debug('Currently selecting the features with %s', criterion)
     path_info = str('')
     store_features(all_features_dict_path_good, all_features_dict_path_bad, js_dirs_validate,
                    labels_validate, path_info, level, features_choice, analysis_path, n,
-                   analyzed_features_path, chi_confidence)
+                   analyzed_features_path, chi_confidence, criterion, top_k, min_support,
+                   compare_criteria)
 
 
 def get_features_all_files_multiproc(samples_dir_list, labels_list, level, features_choice, n):
     """
-        Gets the features of all files from samples_dir_list.
+        Yields the analyses of all files from samples_dir_list, with their features, as they are
+        extracted.
     """
 
-    my_queue = Queue()
-    out_queue = Queue()
-    except_queue = Queue()
-    workers = list()
-
-    for i, _ in enumerate(samples_dir_list):
-        samples_dir = samples_dir_list[i]
-        label = labels_list[i]
-        for sample in os.listdir(samples_dir):
-            sample_path = os.path.join(samples_dir, sample)
-            analysis = static_analysis.Analysis(pdg_path=sample_path, label=label)
-            my_queue.put([analysis, level, features_choice, n])
-
-    for i in range(utility.NUM_WORKERS):
-        p = Process(target=features_preselection.worker_get_features, args=(my_queue, out_queue,
-                                                                            except_queue))
-        p.start()
-        workers.append(p)
-
-    analyses = list()
-
-    while True:
-        try:
-            analysis = out_queue.get(timeout=0.01)
-            analyses.append(analysis)
-        except queue.Empty:
-            pass
-        all_exited = True
-        for w in workers:  # Instead of join, as the worker cannot be joined when elements
-            # are still in except_queue or out_queue, so it deadlocks. But they must be
-            # joined before the elements are taken out of the queue
-            if w.exitcode is None:
-                all_exited = False
-                break
-        if all_exited & out_queue.empty():
-            break
-
-    return analyses
+    analyses = [static_analysis.Analysis(pdg_path=os.path.join(samples_dir_list[i], sample),
+                                         label=labels_list[i])
+                for i, _ in enumerate(samples_dir_list)
+                for sample in os.listdir(samples_dir_list[i])]
+    return parallel.parallel_imap(partial(features_preselection.get_features_analysis,
+                                          level=level, features_choice=features_choice, n=n),
+                                  analyses, ordered=False)
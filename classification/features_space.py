@@ -21,6 +21,8 @@ import numpy as np
 from scipy.sparse import csr_matrix
 
 import features_counting
+import features_cache
+import features_hashing
 
 
 def features2int(features2int_dict, feature):
@@ -46,7 +48,29 @@ def int2features(int2features_dict, i):
 
 
 def get_features(file_repr, level, features_choice, n):
-    """ Returns the sort of features chosen for the analysis. """
+    """ Returns the sort of features chosen for the analysis, from the features cache if
+    enabled. """
+
+    cache = features_cache.get_cache(level, features_choice, n)
+    if cache is None:
+        return extract_features(file_repr, level, features_choice, n)
+
+    entry_path = cache.get_entry_path(file_repr)
+    entry = cache.load(entry_path)
+    if entry is None:
+        features_dict, total_features, pdg_size = extract_features(file_repr, level,
+                                                                   features_choice, n)
+        cache.store(entry_path, features_dict, total_features, pdg_size)
+        return features_dict, total_features, pdg_size
+
+    _, counts, total_features, pdg_size, features = entry
+    if features is None:
+        return None, None, pdg_size
+    return dict(zip(features, counts.tolist())), total_features, pdg_size
+
+
+def extract_features(file_repr, level, features_choice, n):
+    """ Extracts the sort of features chosen for the analysis. """
 
     if features_choice == 'ngrams':
         features_dict, total_features, pdg_size = features_counting.\
@@ -61,24 +85,200 @@ def get_features(file_repr, level, features_choice, n):
 
 
 def features_vector(file_repr, level, features_choice, n, features2int_dict):
-    """ Builds a vector so that the probability of occurrences of a feature is stored at the
-    corresponding position in the vector space. """
-
-    features_dict, total_features, pdg_size = get_features(file_repr, level, features_choice, n)
-    csr = None
-    nb_features = len(features2int_dict)
-
-    if features_dict is not None:
-        features_vect = np.zeros(nb_features + 1)
-        for feature in features_dict:
-            map_feature2int = features2int(features2int_dict, feature)
-            if map_feature2int is not None:
-                features_vect[map_feature2int] = features_dict[feature] / total_features
-                # Features appear only once in "features", so done only once per feature
-        # features_vect[nb_features] = pdg_size
-        csr = csr_matrix(features_vect)
-        if csr.nnz == 0:  # Empty matrix, no known features
-            features_vect[nb_features] = 1  # Because cannot concatenate empty CSR matrices
-            csr = csr_matrix(features_vect)
-
-    return csr
+    """
+        Builds the sparse vector of a file, so that the probability of occurrences of a feature
+        is stored at the corresponding position in the vector space.
+
+        -------
+        Returns:
+        - tuple (np.array, np.array)
+            Sorted positions of the known features in the vector space and their probability of
+            occurrences. Both arrays are empty if no known feature was found.
+        - or None if the features could not be extracted.
+    """
+
+    cache = features_cache.get_cache(level, features_choice, n)
+    if cache is not None:
+        entry = cache.load(cache.get_entry_path(file_repr), with_features=False)
+        if entry is not None:  # Cheap re-projection of the cached counts
+            ids, counts, total_features, _, _ = entry
+            if ids is None:
+                return None
+            return ids2row(cache, ids, counts, total_features, features2int_dict)
+
+    features_dict, total_features, _ = get_features(file_repr, level, features_choice, n)
+
+    if features_dict is None:
+        return None
+    return features_dict2row(features_dict, total_features, features2int_dict)
+
+
+def get_file_repr(js_path, pdg_path, level):
+    """ File representation for level: the JS file for 'tokens', its PDG otherwise. """
+
+    return js_path if level == 'tokens' else pdg_path
+
+
+def get_entry_path_modules(cache, file_repr, digests):
+    """ cache.get_entry_path, computing the digest of each file only once for all modules.
+    Returns None if file_repr could not be read. """
+
+    if file_repr not in digests:
+        try:
+            digests[file_repr] = features_cache.file_digest(file_repr)
+        except (OSError, TypeError):
+            digests[file_repr] = None
+    if digests[file_repr] is None:
+        return None
+    return cache.get_entry_path(file_repr, digests[file_repr])
+
+
+def get_features_modules(js_path, pdg_path, modules, digests=None):
+    """
+        get_features for several modules (level, features_choice, n) of the same file. The
+        modules not in the features cache are extracted together, so that the JS file is
+        tokenized at most once and its PDG loaded at most once.
+
+        -------
+        Returns:
+        - dict
+            Key: (level, features_choice, n);
+            Value: (features_dict, total_features, pdg_size).
+    """
+
+    res, entries_path, modules2do = dict(), dict(), list()
+    digests = dict() if digests is None else digests
+
+    for module in modules:
+        cache = features_cache.get_cache(*module)
+        entry = None
+        if cache is not None:
+            entries_path[module] = get_entry_path_modules(
+                cache, get_file_repr(js_path, pdg_path, module[0]), digests)
+            if entries_path[module] is not None:
+                entry = cache.load(entries_path[module])
+        if entry is None:
+            modules2do.append(module)
+        else:
+            _, counts, total_features, pdg_size, features = entry
+            if features is None:
+                res[module] = (None, None, pdg_size)
+            else:
+                res[module] = (dict(zip(features, counts.tolist())), total_features, pdg_size)
+
+    if modules2do:
+        for module, features in features_counting.count_modules(js_path, pdg_path,
+                                                                modules2do).items():
+            res[module] = features
+            if entries_path.get(module) is not None:
+                features_cache.FeaturesCache.store(entries_path[module], *features)
+
+    return res
+
+
+def features_vector_modules(js_path, pdg_path, modules, features2int_dicts):
+    """ features_vector for several modules of the same file, see get_features_modules.
+    Returns a dict, with key: module, value: (indices, data) or None. """
+
+    res, modules2do, digests = dict(), list(), dict()
+
+    for module in modules:
+        cache = features_cache.get_cache(*module)
+        entry = None
+        if cache is not None:
+            entry_path = get_entry_path_modules(cache, get_file_repr(js_path, pdg_path,
+                                                                     module[0]), digests)
+            if entry_path is not None:
+                entry = cache.load(entry_path, with_features=False)
+        if entry is None:
+            modules2do.append(module)
+        elif entry[0] is None:
+            res[module] = None
+        else:  # Cheap re-projection of the cached counts
+            ids, counts, total_features, _, _ = entry
+            res[module] = ids2row(cache, ids, counts, total_features, features2int_dicts[module])
+
+    for module, [features_dict, total_features, _] in \
+            get_features_modules(js_path, pdg_path, modules2do, digests).items():
+        if features_dict is None:
+            res[module] = None
+        else:
+            res[module] = features_dict2row(features_dict, total_features,
+                                            features2int_dicts[module])
+    return res
+
+
+def ids2row(cache, ids, counts, total_features, features2int_dict):
+    """ Maps the features counts of a cache entry to their (indices, data) representation in
+    the vector space of features2int_dict (possibly a HashingVectorizer). """
+
+    if isinstance(features2int_dict, features_hashing.HashingVectorizer):
+        return features2int_dict.transform_ids(ids, counts, total_features)
+    return cache.project(ids, counts, total_features, features2int_dict)
+
+
+def features_dict2row(features_dict, total_features, features2int_dict):
+    """ Maps the features of a file to their (indices, data) representation in the vector
+    space of features2int_dict (possibly a HashingVectorizer). Unknown features are ignored. """
+
+    if isinstance(features2int_dict, features_hashing.HashingVectorizer):
+        return features2int_dict.transform_dict(features_dict, total_features)
+
+    indices, data = list(), list()
+    for feature, nb_occurrences in features_dict.items():
+        map_feature2int = features2int_dict.get(feature)
+        if map_feature2int is not None:
+            indices.append(map_feature2int)
+            data.append(nb_occurrences / total_features)
+            # Features appear only once in "features", so done only once per feature
+
+    indices = np.array(indices, dtype=np.int32)
+    order = np.argsort(indices, kind='stable')
+    return indices[order], np.array(data, dtype=np.float64)[order]
+
+
+class CsrBuilder:
+    """ Assembles a CSR matrix from (indices, data) rows or from (indptr, indices, data) chunks,
+    with one final concatenation. Empty rows are allowed. """
+
+    def __init__(self, nb_features):
+        self.nb_features = nb_features
+        self.indptr = [np.zeros(1, dtype=np.int64)]
+        self.nnz = 0
+        self.rows_nnz = list()  # Rows added one by one, not yet in indptr
+        self.indices = list()
+        self.data = list()
+
+    def flush_rows(self):
+        """ Moves the rows added one by one into indptr. """
+        if self.rows_nnz:
+            indptr = np.cumsum(self.rows_nnz, dtype=np.int64) + self.nnz
+            self.indptr.append(indptr)
+            self.nnz = int(indptr[-1])
+            self.rows_nnz = list()
+
+    def add_row(self, indices, data):
+        self.indices.append(indices)
+        self.data.append(data)
+        self.rows_nnz.append(len(indices))
+
+    def add_chunk(self, indptr, indices, data):
+        self.flush_rows()
+        self.indptr.append(np.asarray(indptr[1:], dtype=np.int64) + self.nnz)
+        self.nnz += int(indptr[-1])
+        self.indices.append(indices)
+        self.data.append(data)
+
+    def get_arrays(self):
+        """ Returns the (indptr, indices, data) arrays of the rows added so far. """
+        self.flush_rows()
+        if self.indices:
+            indices = np.concatenate(self.indices).astype(np.int32, copy=False)
+            data = np.concatenate(self.data).astype(np.float64, copy=False)
+        else:
+            indices, data = np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float64)
+        return np.concatenate(self.indptr), indices, data
+
+    def get_csr(self):
+        indptr, indices, data = self.get_arrays()
+        return csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, self.nb_features))
@@ -18,7 +18,6 @@
 
 import sys
 import os
-import pickle
 import logging
 from subprocess import run, PIPE
 
@@ -33,8 +32,11 @@ import tokenizer_esprima
 sys.path.insert(0, os.path.join(SRC_PATH, '..', 'pdg_generation'))
 import node as _node
 
+import features_ngrams
 
-sys.setrecursionlimit(400000)  # Probably need it to unpickle BIG PDGs ;)
+
+# Levels whose traversal visits the same nodes as features_ngrams', which it can then also give
+NAMES_LEVELS = ('ast', 'pdg-dfg', 'pdg-ast')
 
 
 def get_tokens_features(input_file):
@@ -64,22 +66,27 @@ def get_tokens_features(input_file):
             features_list.append((output[2*i], output[2*i+1]))
         return features_list
     except Exception as e:
-        logging.error('Something went wrong with %s', input_file)
-        print(e)
+        logging.error('Something went wrong with %s: %s', input_file, e)
     return None
 
 
 def search_identifier(node, tab_id):
-    """ Search and return the Identifier Nodes found in node. """
+    """ Search and return the Identifier Nodes found in node (depth-first pre order, without
+    going down an Identifier). """
 
     if node.name == 'Identifier':
         tab_id.append(node)
 
-    for child in node.children:
-        if child.name == 'Identifier':
-            tab_id.append(child)
+    stack = [iter(node.children)]
+    while stack:
+        for child in stack[-1]:
+            if child.name == 'Identifier':
+                tab_id.append(child)
+            else:
+                stack.append(iter(child.children))
+                break
         else:
-            search_identifier(child, tab_id)
+            stack.pop()
 
 
 def get_context_value(node):
@@ -94,6 +101,53 @@ def get_context_value(node):
     return None
 
 
+def get_first_identifiers(pdg):
+    """
+        Name of the first Identifier found by search_identifier in each node of pdg, computed
+        in a single bottom-up pass (each node's from its children's).
+
+        -------
+        Parameters:
+        - pdg: node
+            PDG of the JS file to analyze.
+
+        -------
+        Returns:
+        - dict
+            Key: node id;
+            Value: name of the first Identifier of the node, or None if it has none.
+    """
+
+    nodes = list()  # Depth-first pre order, i.e. parents before their children
+    stack = [pdg]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.children)
+
+    first_identifiers = dict()
+    for node in reversed(nodes):
+        if node.name == 'Identifier':
+            first_identifiers[node.id] = node.attributes['name']
+        else:
+            first_identifiers[node.id] = next((first_identifiers[child.id]
+                                               for child in node.children
+                                               if first_identifiers[child.id] is not None), None)
+    return first_identifiers
+
+
+def get_context(node, first_identifiers):
+    """ get_context_value, using the first Identifiers precomputed by get_first_identifiers.
+    Nodes outside of the PDG it was computed on are added to first_identifiers. """
+
+    if node.id not in first_identifiers:
+        first_identifiers.update(get_first_identifiers(node))
+    value = first_identifiers[node.id]
+    if value is not None:
+        return (node.name, value)
+    return None
+
+
 def get_leaf_attr(leaf_node_attribute):
     """ Get the attribute value or name of a leaf. """
 
@@ -104,12 +158,14 @@ def get_leaf_attr(leaf_node_attribute):
     return None
 
 
-def get_ast_features(pdg, features_list, handled_set):
+def get_ast_features(pdg, features_list, handled_set, first_identifiers=None,
+                     names_list=None):
     """
         Given the PDG of a JavaScript file, create a list containing the esprima syntactic
         units with their associated node value.
         The order of the units stored in the previous list resembles a tree traversal using
         the depth-first pre order.
+        Iterative version, with an explicit stack of children iterators.
 
         -------
         Parameters:
@@ -119,38 +175,80 @@ def get_ast_features(pdg, features_list, handled_set):
             Contains the units found so far.
         - handled_set: set
             Contains the nodes id handled so far.
+        - first_identifiers: dict
+            Output of get_first_identifiers, computed on pdg if None.
+        - names_list: list
+            If given, also contains the units alone (i.e. features_ngrams.get_ast_features'),
+            the nodes being the same.
     """
 
-    for child in pdg.children:
-        if child.id not in handled_set:
-            handled_set.add(child.id)
+    if first_identifiers is None:
+        first_identifiers = get_first_identifiers(pdg)
 
-            if child.name == 'Literal':  # Case Literal (String, Int, Regex etc.)
-                context = child.literal_type()
-                if 'value' in child.attributes:
-                    value = child.attributes['value']
-                    features_list.append((context, value))
+    stack = [iter(pdg.children)]
+    while stack:
+        for child in stack[-1]:
+            if child.id not in handled_set:
+                handled_set.add(child.id)
+                if names_list is not None:
+                    names_list.append(child.name)
 
-            elif get_context_value(child) is not None:
-                features_list.append(get_context_value(child))
-            get_ast_features(child, features_list, handled_set)
+                if child.name == 'Literal':  # Case Literal (String, Int, Regex etc.)
+                    context = child.literal_type()
+                    if 'value' in child.attributes:
+                        value = child.attributes['value']
+                        features_list.append((context, value))
 
+                else:
+                    context_value = get_context(child, first_identifiers)
+                    if context_value is not None:
+                        features_list.append(context_value)
+                stack.append(iter(child.children))  # Goes down before the next sibling
+                break
+        else:
+            stack.pop()
 
-def get_cfg_features(pdg, features_list, handled_set, handled_features_set):
+
+def get_cfg_features(pdg, features_list, handled_set, handled_features_set,
+                     first_identifiers=None):
     """ To provide complete code coverage while following only the CF. """
 
-    for child in pdg.children:
-        if child.id not in handled_set:
-            traverse_cfg(child, features_list, handled_set, handled_features_set)
-        get_cfg_features(child, features_list, handled_set, handled_features_set)
+    if first_identifiers is None:
+        first_identifiers = get_first_identifiers(pdg)
+
+    stack = [iter(pdg.children)]
+    while stack:
+        for child in stack[-1]:
+            if child.id not in handled_set:
+                traverse_cfg(child, features_list, handled_set, handled_features_set,
+                             first_identifiers)
+            stack.append(iter(child.children))
+            break
+        else:
+            stack.pop()
+
+
+def enter_cfg(pdg, features_list, handled_features_set, first_identifiers):
+    """ Handles pdg when traverse_cfg reaches it, returns an iterator on its CF. """
+
+    if pdg.control_dep_children:
+        context_value = get_context(pdg, first_identifiers)
+        if context_value is not None:
+            features_list.append(context_value)
+            handled_features_set.add(pdg.id)  # Store id from features handled
+            get_ast_features(pdg, features_list, handled_features_set,
+                             first_identifiers)  # Handled only once
+    return iter(pdg.control_dep_children)
 
 
-def traverse_cfg(pdg, features_list, handled_set, handled_features_set):
+def traverse_cfg(pdg, features_list, handled_set, handled_features_set,
+                 first_identifiers=None):
     """
         Given the PDG of a JavaScript file, create a list containing the esprima syntactic
         units with a Control dependency with their associated node value.
         The order of the units stored in the previous list resembles a tree traversal using
         the depth-first pre order.
+        Iterative version, with an explicit stack of CF iterators.
 
         -------
         Parameters:
@@ -160,42 +258,76 @@ def traverse_cfg(pdg, features_list, handled_set, handled_features_set):
             Contains the units found so far.
         - handled_list: list
             Contains the nodes id handled so far.
+        - first_identifiers: dict
+            Output of get_first_identifiers, computed on pdg if None.
     """
 
-    if pdg.control_dep_children:
-        if get_context_value(pdg) is not None:
-            features_list.append(get_context_value(pdg))
-            handled_features_set.add(pdg.id)  # Store id from features handled
-            get_ast_features(pdg, features_list, handled_features_set)  # Handled only once
-    for control_dep in pdg.control_dep_children:
-        control_flow = control_dep.extremity
-        # Otherwise missing CF pointing to a node already analyzed
-        if get_context_value(control_flow) is not None and (not control_flow.control_dep_children
-                                                            or control_flow.id in handled_set):
-            features_list.append(get_context_value(control_flow))
-        # else: the node name will be added while calling traverse_cfg
-        if control_flow.id not in handled_set:
-            handled_set.add(control_flow.id)
-            handled_features_set.add(control_flow.id)  # Store id from features
-            get_ast_features(control_flow, features_list, handled_features_set)  # Once
-            traverse_cfg(control_flow, features_list, handled_set, handled_features_set)
-
-
-def get_pdg_features(pdg, features_list, handled_set, handled_features_set):
+    if first_identifiers is None:
+        first_identifiers = get_first_identifiers(pdg)
+
+    stack = [enter_cfg(pdg, features_list, handled_features_set, first_identifiers)]
+    while stack:
+        for control_dep in stack[-1]:
+            control_flow = control_dep.extremity
+            # Otherwise missing CF pointing to a node already analyzed
+            context_value = get_context(control_flow, first_identifiers)
+            if context_value is not None and\
+                    (not control_flow.control_dep_children or control_flow.id in handled_set):
+                features_list.append(context_value)
+            # else: the node name will be added while calling enter_cfg
+            if control_flow.id not in handled_set:
+                handled_set.add(control_flow.id)
+                handled_features_set.add(control_flow.id)  # Store id from features
+                get_ast_features(control_flow, features_list, handled_features_set,
+                                 first_identifiers)  # Once
+                stack.append(enter_cfg(control_flow, features_list, handled_features_set,
+                                       first_identifiers))
+                break
+        else:
+            stack.pop()
+
+
+def get_pdg_features(pdg, features_list, handled_set, handled_features_set,
+                     first_identifiers=None, names_list=None):
     """ To provide complete code coverage while following only the CF. """
 
-    for child in pdg.children:
-        if child.id not in handled_set:
-            traverse_pdg(child, features_list, handled_set, handled_features_set)
-        get_pdg_features(child, features_list, handled_set, handled_features_set)
+    if first_identifiers is None:
+        first_identifiers = get_first_identifiers(pdg)
+
+    stack = [iter(pdg.children)]
+    while stack:
+        for child in stack[-1]:
+            if child.id not in handled_set:
+                traverse_pdg(child, features_list, handled_set, handled_features_set,
+                             first_identifiers, names_list)
+            stack.append(iter(child.children))
+            break
+        else:
+            stack.pop()
+
 
+def enter_pdg(pdg, features_list, handled_features_set, first_identifiers, names_list=None):
+    """ Handles pdg when traverse_pdg reaches it, returns an iterator on its DF. """
 
-def traverse_pdg(pdg, features_list, handled_set, handled_features_set):
+    if pdg.data_dep_children:
+        child_df = pdg.data_dep_children[0].id_begin
+        features_list.append((pdg.name, get_leaf_attr(child_df.attributes)))
+        if names_list is not None:
+            names_list.append(pdg.name)
+        handled_features_set.add(pdg.id)  # Store id from features handled
+        get_ast_features(pdg, features_list, handled_features_set,
+                         first_identifiers, names_list)  # Handled only once
+    return iter(pdg.data_dep_children)
+
+
+def traverse_pdg(pdg, features_list, handled_set, handled_features_set,
+                 first_identifiers=None, names_list=None):
     """
         Given the PDG of a JavaScript file, create a list containing the esprima syntactic
         units with a Data dependency with their associated node value.
         The order of the units stored in the previous list resembles a tree traversal using
         the depth-first pre order.
+        Iterative version, with an explicit stack of DF iterators.
 
         -------
         Parameters:
@@ -205,51 +337,144 @@ def traverse_pdg(pdg, features_list, handled_set, handled_features_set):
             Contains the units found so far.
         - handled_list: list
             Contains the nodes id handled so far.
+        - first_identifiers: dict
+            Output of get_first_identifiers, computed on pdg if None.
+        - names_list: list
+            If given, also contains the units alone, see get_ast_features.
     """
 
-    if pdg.data_dep_children:
-        child_df = pdg.data_dep_children[0].id_begin
-        features_list.append((pdg.name, get_leaf_attr(child_df.attributes)))
-        handled_features_set.add(pdg.id)  # Store id from features handled
-        get_ast_features(pdg, features_list, handled_features_set)  # Handled only once
-    for data_dep in pdg.data_dep_children:
-        data_flow = data_dep.extremity
-        # Otherwise missing CF pointing to a node already analyzed
-        if not data_flow.data_dep_children or data_flow.id in handled_set:
-            features_list.append((data_flow.name, get_leaf_attr(data_dep.id_end.attributes)))
-        # else: the node name will be added while calling traverse_pdg
-        if data_flow.id not in handled_set:
-            handled_set.add(data_flow.id)
-            handled_features_set.add(data_flow.id)  # Store id from features
-            get_ast_features(data_flow, features_list, handled_features_set)  # Once
-            traverse_pdg(data_flow, features_list, handled_set, handled_features_set)
+    if first_identifiers is None:
+        first_identifiers = get_first_identifiers(pdg)
+
+    stack = [enter_pdg(pdg, features_list, handled_features_set, first_identifiers, names_list)]
+    while stack:
+        for data_dep in stack[-1]:
+            data_flow = data_dep.extremity
+            # Otherwise missing CF pointing to a node already analyzed
+            if not data_flow.data_dep_children or data_flow.id in handled_set:
+                features_list.append((data_flow.name,
+                                      get_leaf_attr(data_dep.id_end.attributes)))
+                if names_list is not None:
+                    names_list.append(data_flow.name)
+            # else: the node name will be added while calling enter_pdg
+            if data_flow.id not in handled_set:
+                handled_set.add(data_flow.id)
+                handled_features_set.add(data_flow.id)  # Store id from features
+                get_ast_features(data_flow, features_list, handled_features_set,
+                                 first_identifiers, names_list)  # Once
+                stack.append(enter_pdg(data_flow, features_list, handled_features_set,
+                                       first_identifiers, names_list))
+                break
+        else:
+            stack.pop()
 
 
 def get_pdg_features_with_cfg(pdg, features_list, handled_set_pdg, handled_features_pdg_set,
-                              handled_set_cfg, handled_features_cfg_set):
+                              handled_set_cfg, handled_features_cfg_set, first_identifiers=None):
     """ Follows both data and control flow, alternative traaversal. """
 
-    get_pdg_features(pdg, features_list, handled_set_pdg, handled_features_pdg_set)
-    get_cfg_features(pdg, features_list, handled_set_cfg, handled_features_cfg_set)
+    if first_identifiers is None:
+        first_identifiers = get_first_identifiers(pdg)
+    get_pdg_features(pdg, features_list, handled_set_pdg, handled_features_pdg_set,
+                     first_identifiers)
+    get_cfg_features(pdg, features_list, handled_set_cfg, handled_features_cfg_set,
+                     first_identifiers)
 
 
-def get_pdg_features_with_cfg_ast(pdg, features_list):
+def get_pdg_features_with_cfg_ast(pdg, features_list, first_identifiers=None):
     """ Follows both data and control flow and AST nodes not handled yet. """
 
+    if first_identifiers is None:
+        first_identifiers = get_first_identifiers(pdg)
     handled_features_pdg_set, handled_features_cfg_set = set(), set()
     get_pdg_features_with_cfg(pdg, features_list, set(), handled_features_pdg_set,
-                              set(), handled_features_cfg_set)
+                              set(), handled_features_cfg_set, first_identifiers)
 
     handled_set = set(list(handled_features_pdg_set) + list(handled_features_cfg_set))
-    get_ast_features(pdg, features_list, handled_set)  # Only nodes not handled yet
+    get_ast_features(pdg, features_list, handled_set,
+                     first_identifiers)  # Only nodes not handled yet
 
 
-def get_pdg_features_with_ast(pdg, features_list):
+def get_pdg_features_with_ast(pdg, features_list, first_identifiers=None, names_list=None):
     """ Follows both data flow and AST nodes not handled yet. """
 
+    if first_identifiers is None:
+        first_identifiers = get_first_identifiers(pdg)
     handled_features_pdg_set = set()
-    get_pdg_features(pdg, features_list, set(), handled_features_pdg_set)
-    get_ast_features(pdg, features_list, handled_features_pdg_set)  # Only nodes not handled yet
+    get_pdg_features(pdg, features_list, set(), handled_features_pdg_set, first_identifiers,
+                     names_list)
+    get_ast_features(pdg, features_list, handled_features_pdg_set,
+                     first_identifiers, names_list)  # Only nodes not handled yet
+
+
+def get_syntactic_features(pdg, level, pdg_path=None, first_identifiers=None, names_list=None):
+    """ Dispatches the traversal of pdg corresponding to level. pdg_path is only for logging,
+    first_identifiers is the output of get_first_identifiers(pdg) if already computed. For the
+    NAMES_LEVELS, names_list (if given) is filled with the units alone, as returned by
+    features_ngrams.get_syntactic_features. """
+
+    if first_identifiers is None:
+        first_identifiers = get_first_identifiers(pdg)
+
+    features_list = list()
+    if level == 'ast':
+        if not pdg.children:
+            logging.warning('%s: benign (benign) _ EMPTY AST', pdg_path)
+        else:
+            get_ast_features(pdg, features_list=features_list, handled_set=set(),
+                             first_identifiers=first_identifiers, names_list=names_list)
+    elif level == 'cfg':
+        get_cfg_features(pdg, features_list=features_list, handled_set=set(),
+                         handled_features_set=set(), first_identifiers=first_identifiers)
+    elif level == 'pdg-dfg':
+        get_pdg_features(pdg, features_list=features_list, handled_set=set(),
+                         handled_features_set=set(), first_identifiers=first_identifiers,
+                         names_list=names_list)
+    elif level == 'pdg':
+        get_pdg_features_with_cfg(pdg, features_list=features_list,
+                                  handled_set_pdg=set(), handled_set_cfg=set(),
+                                  handled_features_pdg_set=set(),
+                                  handled_features_cfg_set=set(),
+                                  first_identifiers=first_identifiers)
+    elif level == 'pdg-cfg-ast':
+        get_pdg_features_with_cfg_ast(pdg, features_list=features_list,
+                                      first_identifiers=first_identifiers)
+    elif level == 'pdg-ast':
+        get_pdg_features_with_ast(pdg, features_list=features_list,
+                                  first_identifiers=first_identifiers, names_list=names_list)
+    else:
+        logging.error('Expected \'ast\' or \'cfg\' or \'pdg-dfg\' or \'pdg\' '
+                      'got %s instead', level)
+    return features_list
+
+
+def get_syntactic_features_levels(pdg, levels, pdg_path=None, names_levels=None):
+    """
+        get_syntactic_features for several levels of the same PDG. The 'pdg' traversal being
+        the 'pdg-dfg' traversal followed by the 'cfg' one, they are only run once.
+        If names_levels is a dict, it is filled with the units alone of the NAMES_LEVELS
+        traversed (key: level), so that features_ngrams does not traverse them again.
+
+        -------
+        Returns:
+        - dict
+            Key: level;
+            Value: list of the esprima syntactic units of the level.
+    """
+
+    first_identifiers = get_first_identifiers(pdg)  # Shared by all levels
+    traversals = [level for level in ('pdg-dfg', 'cfg') if level in levels or 'pdg' in levels]
+    traversals += [level for level in levels if level not in traversals + ['pdg']]
+    features_levels = dict()
+    for level in traversals:
+        names_list = None
+        if names_levels is not None and level in NAMES_LEVELS:
+            names_list = names_levels[level] = list()
+        features_levels[level] = get_syntactic_features(pdg, level, pdg_path,
+                                                        first_identifiers, names_list)
+    if 'pdg' in levels:
+        features_levels['pdg'] = features_levels['pdg-dfg'] + features_levels['cfg']
+    return {level: features_levels[level] for level in levels}
 
 
 def extract_syntactic_features(pdg_path, level):
@@ -276,35 +501,10 @@ def extract_syntactic_features(pdg_path, level):
 
     logging.debug('Analysis of %s', pdg_path)
     try:
-        if os.stat(pdg_path).st_size < 10000000:  # Avoids handling PDGs over 10MB for perf reasons
-            pdg = pickle.load(open(pdg_path, 'rb'))
-            if pdg is not None:  # Not sure if it can be None
-                features_list = list()
-                if level == 'ast':
-                    if not pdg.children:
-                        print(pdg_path + ': ' + 'benign (benign) _ EMPTY AST')
-                    else:
-                        get_ast_features(pdg, features_list=features_list, handled_set=set())
-                elif level == 'cfg':
-                    get_cfg_features(pdg, features_list=features_list, handled_set=set(),
-                                     handled_features_set=set())
-                elif level == 'pdg-dfg':
-                    get_pdg_features(pdg, features_list=features_list, handled_set=set(),
-                                     handled_features_set=set())
-                elif level == 'pdg':
-                    get_pdg_features_with_cfg(pdg, features_list=features_list,
-                                              handled_set_pdg=set(), handled_set_cfg=set(),
-                                              handled_features_pdg_set=set(),
-                                              handled_features_cfg_set=set())
-                elif level == 'pdg-cfg-ast':
-                    get_pdg_features_with_cfg_ast(pdg, features_list=features_list)
-                elif level == 'pdg-ast':
-                    get_pdg_features_with_ast(pdg, features_list=features_list)
-                else:
-                    logging.error('Expected \'ast\' or \'cfg\' or \'pdg-dfg\' or \'pdg\' '
-                                  'got %s instead', level)
-                return features_list, os.stat(pdg_path).st_size
-        return None, os.stat(pdg_path).st_size
+        pdg, pdg_size = features_ngrams.load_pdg(pdg_path)
+        if pdg is not None:  # Not sure if it can be None
+            return get_syntactic_features(pdg, level, pdg_path), pdg_size
+        return None, pdg_size
     except:
         logging.error('The PDG of %s could not be loaded', pdg_path)
     return None, None
@@ -335,11 +535,9 @@ def extract_features(file_repr, level):
     pdg_size = None
 
     if level in ('ast', 'cfg', 'pdg-dfg', 'pdg'):
-        dico_features = parser_esprima.AST_UNITS_DICO
         # List of syntactic units linked by parents, control or data flow
         features_list, pdg_size = extract_syntactic_features(file_repr, level)
     elif level == 'tokens':
-        dico_features = tokenizer_esprima.TOKENS_DICO
         features_list = get_tokens_features(file_repr)  # List of lexical units
     else:
         features_list = None
@@ -347,6 +545,18 @@ def extract_features(file_repr, level):
                       ', got %s instead', level)
     # print(features_list)
 
+    return units2int(features_list, level), pdg_size
+
+
+def units2int(features_list, level):
+    """ Converts the units of (unit, value) features into their corresponding numbers, or
+    returns None if features_list is empty. """
+
+    if level == 'tokens':
+        dico_features = tokenizer_esprima.TOKENS_DICO
+    else:
+        dico_features = parser_esprima.AST_UNITS_DICO
+
     if features_list is not None and features_list != []:
-        return list(map(lambda x: (dico_features[x[0]], x[1]), features_list)), pdg_size
-    return None, pdg_size
+        return list(map(lambda x: (dico_features[x[0]], x[1]), features_list))
+    return None
@@ -0,0 +1,156 @@
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    Library API of JStap, to build models and classify JS files from Python instead of running
+    learner.py and classifier.py. Importing it neither parses the command line nor configures
+    the logging, and the analysis modules (and their dependencies, e.g. scipy and sklearn) are
+    only imported when learn or classify is called. As the modules log with the logging
+    functions, which configure the root logger if it has no handler, the application should
+    configure its logging first.
+
+    >>> import jstap
+    >>> jstap.configure(workers=4)
+    >>> jstap.learn(['BENIGN', 'MALICIOUS'], ['benign', 'malicious'], 'ast', 'ngrams', 'MODEL',
+    ...             validate_dirs=['BENIGN-VALIDATE', 'MALICIOUS-VALIDATE'],
+    ...             validate_labels=['benign', 'malicious'])
+    >>> names, labels_predicted, proba = jstap.classify(['FILE.js', 'DIR'], 'MODEL', level='ast',
+    ...                                                 features_choice='ngrams')
+"""
+
+import os
+
+import utility
+
+
+UNCHANGED = object()  # Default of the options of configure which are kept
+
+
+def configure(workers=UNCHANGED, backend=UNCHANGED, cache=UNCHANGED, hash_bits=UNCHANGED,
+              vectorizer_bits=UNCHANGED):
+    """
+        Sets the configuration shared by learn and classify, as the command line options of the
+        same names (see utility.parsing_commands); the options not given are kept. Per default,
+        NUM_WORKERS workers and BACKEND backend, no features cache, hashing or vectorizer.
+
+        -------
+        Parameters:
+        - workers: int
+            Number of workers.
+        - backend: str
+            Either 'process', 'thread' or 'serial'.
+        - cache: str
+            Folder of the features cache, None to disable it.
+        - hash_bits: int
+            Size of the value features' hashes, None to disable the hashing.
+        - vectorizer_bits: int
+            Bits of the hashing vectorizer, None to use the features dictionary.
+    """
+
+    utility.control_parallelism(utility.NUM_WORKERS if workers is UNCHANGED else workers,
+                                utility.BACKEND if backend is UNCHANGED else backend)
+    if cache is not UNCHANGED:
+        utility.control_cache(cache)
+    if hash_bits is not UNCHANGED:
+        utility.control_hashing(hash_bits)
+    if vectorizer_bits is not UNCHANGED:
+        utility.control_vectorizer(vectorizer_bits)
+
+
+def learn(js_dirs, labels, level, features_choice, model_path, validate_dirs=None,
+          validate_labels=None, n=4, estimators=500,
+          analysis_path=os.path.join(utility.SRC_PATH, 'Analysis'), criterion='chi2', top_k=None,
+          min_support=None, model_format='pickle', warm_start=None, store=None, shard_size=None,
+          compare_selection=False):
+    """
+        Builds a model, see learner.main_learn.
+
+        -------
+        Parameters:
+        - js_dirs, labels: list of str
+            Directories of JS files to build the model from, and their labels (benign or
+            malicious).
+        - level, features_choice, n:
+            Module of the model, e.g. 'pdg', 'value' and 4.
+        - model_path: str
+            Path to store the model in.
+        - validate_dirs, validate_labels: list of str
+            2 directories (1 benign, 1 malicious) to select the features with, and their labels.
+        - estimators, analysis_path, criterion, top_k, min_support, model_format, warm_start,
+        store, shard_size, compare_selection:
+            As the learner.py options --nt, --analysis_path, --selection, --top_k,
+            --min_support, --format, --warm_start, --store, --shard_size and
+            --compare_selection.
+
+        -------
+        Returns:
+        - The model built, or None.
+    """
+
+    import learner
+    import features_selection
+
+    return learner.main_learn(
+        js_dirs=js_dirs, js_dirs_validate=validate_dirs, labels_validate=validate_labels,
+        labels_d=labels, model_dir=os.path.dirname(model_path) or '.',
+        model_name=os.path.basename(model_path), level=level, n=n, estimators=estimators,
+        features_choice=features_choice, analysis_path=analysis_path, criterion=criterion,
+        top_k=top_k, min_support=features_selection.MIN_SUPPORT if min_support is None
+        else min_support, model_format=model_format, warm_start=warm_start, store=store,
+        shard_size=shard_size, compare_selection=compare_selection)
+
+
+def classify(js_paths, model, level=None, features_choice=None, n=4,
+             analysis_path=os.path.join(utility.SRC_PATH, 'Analysis'), threshold=None):
+    """
+        Classifies JS files with a model, see classifier.main_classification.
+
+        -------
+        Parameters:
+        - js_paths: list of str
+            JS files, or directories of JS files.
+        - model: str
+            Path of a model bundle, or of a model built by learn for the module (level,
+            features_choice, n), its features being in analysis_path.
+        - threshold: float
+            Probability of being malicious over which a file is classified as malicious; per
+            default, the one of the model bundle, or 0.5.
+
+        -------
+        Returns:
+        - list: names of the files which could be analyzed;
+        - np.array: their predicted labels (benign or malicious);
+        - np.array: their probabilities of being malicious;
+        - or None if the model is not valid.
+    """
+
+    import numpy as np
+    import classifier
+    import model_bundle
+    import machine_learning
+
+    res = classifier.analyze_model_files(
+        js_dirs=[path for path in js_paths if os.path.isdir(path)] or None,
+        js_files=[path for path in js_paths if not os.path.isdir(path)] or None,
+        labels_f=None, labels_d=None, model=model, level=level, features_choice=features_choice,
+        n=n, analysis_path=analysis_path)
+    if res is None:
+        return None
+    names, attributes, _ = res
+    if not names:
+        return [], machine_learning.LABELS[:0], np.zeros(0)
+    proba = machine_learning.load_model(model).predict_proba(attributes)
+    labels_predicted = machine_learning.predict_labels_using_threshold(
+        len(names), proba, model_bundle.get_threshold(threshold, model))
+    return names, labels_predicted, proba[:, 1]
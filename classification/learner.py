@@ -18,20 +18,25 @@
 
 import os
 import pickle
+import timeit
 import logging
 import argparse
 
 import features_preselection
 import features_selection
+import features_hashing
 import static_analysis
 import machine_learning
+import model_bundle
+import training_set
 import utility
 
 SRC_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
 
 def classify(names, labels, attributes, model_dir, model_name, estimators,
-             print_score=False, print_res=False):
+             print_score=False, print_res=False, model_format='pickle', module=None,
+             features2int_dict_path=None, warm_start=None):
     """
         Training a classifier.
 
@@ -53,6 +58,15 @@ def classify(names, labels, attributes, model_dir, model_name, estimators,
             Indicates whether to print or not the classifier's performance. Default: False.
         - print_res: bool
             Indicates whether to print or not the classifier's predictions. Default: False.
+        - model_format: str
+            Either 'pickle' or 'bundle' (see model_bundle.py), format to store the model in.
+        - module: (level, features_choice, n)
+            Module the model is trained for, stored in the bundle.
+        - features2int_dict_path: str
+            Path of the features dictionary, stored in the bundle.
+        - warm_start: str
+            Path of a pickled model to add estimators trees to, trained on these samples,
+            instead of training a new forest. Its features have to be the same.
 
         -------
         Returns:
@@ -73,20 +87,96 @@ def classify(names, labels, attributes, model_dir, model_name, estimators,
     if not os.path.exists(model_dir):
         os.makedirs(model_dir)
 
-    clf = machine_learning.classifier_choice(estimators=estimators)
+    if warm_start is None:
+        clf = machine_learning.classifier_choice(estimators=estimators)
+    else:
+        clf = machine_learning.warm_start_classifier(warm_start, estimators,
+                                                     features2int_dict_path)
+        if clf is None:
+            return None
+        if clf.n_features_in_ != attributes.shape[1]:
+            logging.error('The model %s has %s features, got %s', warm_start,
+                          str(clf.n_features_in_), str(attributes.shape[1]))
+            return None
+    nb_trees_before = len(getattr(clf, 'estimators_', []))
+    memory_before = utility.get_peak_memory()
+    start = timeit.default_timer()
     trained = clf.fit(attributes, labels)  # Model
-    labels_predicted = clf.predict(attributes)  # Classification and class predictions
+    fit_time = timeit.default_timer() - start
+    peak_memory = utility.get_peak_memory()
+    attributes_size = sum(array.nbytes for array in (attributes.data, attributes.indices,
+                                                     attributes.indptr)) / 2 ** 20
+    logging.info('Fitted %s trees (%s in total) on %s samples in %ss; peak memory: %s MB '
+                 '(%s MB before the fit), training features: %s MB',
+                 str(len(trained.estimators_) - nb_trees_before), str(len(trained.estimators_)),
+                 str(len(labels)), str(round(fit_time, 3)), str(round(peak_memory or 0, 1)),
+                 str(round(memory_before or 0, 1)), str(round(attributes_size, 1)))
+
+    if print_score or print_res:  # Predicting the training samples is only needed there
+        labels_predicted = clf.predict(attributes)  # Classification and class predictions
 
-    if print_score:
-        machine_learning.get_score(labels, labels_predicted)
+        if print_score:
+            machine_learning.get_score(labels, labels_predicted)
 
-    if print_res:
-        machine_learning.get_classification_results(names, labels_predicted)
+        if print_res:
+            machine_learning.get_classification_results(names, labels_predicted)
 
     model_path = os.path.join(model_dir, model_name)
-    pickle.dump(trained, open(model_path, 'wb'))
-    logging.info('The model has been successfully stored in %s', model_path)
+    if model_format == 'bundle':
+        level, features_choice, n = module
+        stats = {'nb_samples': len(labels), 'nb_benign': labels.count('benign'),
+                 'nb_malicious': labels.count('malicious'), 'nb_features': attributes.shape[1],
+                 'estimators': len(trained.estimators_), 'warm_start_estimators': nb_trees_before,
+                 'fit_time': fit_time, 'peak_memory_mb': peak_memory}
+        model_bundle.save_bundle(model_path, trained,
+                                 static_analysis.read_features2int_dict(features2int_dict_path),
+                                 level, features_choice, n, stats=stats)
+    else:
+        pickle.dump(trained, open(model_path, 'wb'))
+        features_hashing.store_model_config(model_path, features2int_dict_path)
+        logging.info('The model has been successfully stored in %s', model_path)
+
+    return trained
+
+
+def classify_out_of_core(store_path, model_dir, model_name, estimators, shard_size, module,
+                         features2int_dict_path):
+    """
+        Out-of-core counterpart of classify: trains a forest on the samples of the training set
+        store_path by shards of at most shard_size samples (see
+        machine_learning.fit_out_of_core), and stores it as a model bundle.
+
+        -------
+        Returns:
+        - CompiledForest, or None.
+    """
+
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
 
+    memory_before = utility.get_peak_memory()
+    start = timeit.default_timer()
+    trained = machine_learning.fit_out_of_core(store_path, estimators, shard_size)
+    fit_time = timeit.default_timer() - start
+    peak_memory = utility.get_peak_memory()
+    if trained is None:
+        return None
+    meta = training_set.load_store_meta(store_path)
+    nb_shards = training_set.get_nb_shards(store_path, shard_size)
+    logging.info('Fitted %s trees on %s samples by %s shards in %ss; peak memory: %s MB '
+                 '(%s MB before the fit)', str(trained.n_estimators), str(meta['nb_rows']),
+                 str(nb_shards), str(round(fit_time, 3)), str(round(peak_memory or 0, 1)),
+                 str(round(memory_before or 0, 1)))
+
+    nb_malicious = int(training_set.load_labels(store_path).sum())
+    level, features_choice, n = module
+    stats = {'nb_samples': meta['nb_rows'], 'nb_benign': meta['nb_rows'] - nb_malicious,
+             'nb_malicious': nb_malicious, 'nb_features': meta['nb_features'],
+             'estimators': trained.n_estimators, 'shards': nb_shards, 'shard_size': shard_size,
+             'fit_time': fit_time, 'peak_memory_mb': peak_memory}
+    model_bundle.save_bundle(os.path.join(model_dir, model_name), trained,
+                             static_analysis.read_features2int_dict(features2int_dict_path),
+                             level, features_choice, n, stats=stats)
     return trained
 
 
@@ -122,21 +212,55 @@ def parsing_commands():
                         help='indicates whether to print or not the classifier\'s predictions')
     parser.add_argument('--nt', metavar='NB_TREES', type=int, nargs=1,
                         default=[500], help='number of trees in the forest')
-
+    parser.add_argument('--selection', metavar='CRITERION', type=str, nargs=1, default=['chi2'],
+                        choices=features_selection.CRITERIA,
+                        help='criterion to select the features with (chi2, or mi for the mutual '
+                             'information)')
+    parser.add_argument('--top_k', metavar='INTEGER', type=int, nargs=1, default=[None],
+                        help='maximum number of features to select, the ones with the highest '
+                             'scores; per default, all the dependent features are selected')
+    parser.add_argument('--min_support', metavar='INTEGER', type=int, nargs=1,
+                        default=[features_selection.MIN_SUPPORT],
+                        help='only the features found in more files are analyzed for the '
+                             'features selection')
+    parser.add_argument('--compare_selection', metavar='BOOL', type=bool, nargs=1,
+                        default=[False],
+                        help='indicates whether to select the features with every criterion '
+                             'too, to compare them in the selection report')
+
+    parser.add_argument('--format', metavar='FORMAT', type=str, nargs=1, default=['pickle'],
+                        choices=['pickle', 'bundle'],
+                        help='format to store the model in: pickle, or bundle (folder with the '
+                             'model\'s arrays, its features and metadata, loaded without pickle)')
+    parser.add_argument('--warm_start', metavar='MODEL', type=str, nargs=1, default=[None],
+                        help='pickled model to add NB_TREES trees to, trained on the samples of '
+                             '--d (or of the --store training set), instead of training a new '
+                             'forest; the features selected for the model are kept, --vd is not '
+                             'needed')
+    parser.add_argument('--store', metavar='DIR', type=str, nargs=1, default=[None],
+                        help='training set to append the samples of --d to as they are '
+                             'analyzed, the model being trained on all its samples, '
+                             'memory-mapped; it is emptied if the selected features change. The '
+                             'training still copies them in memory, see --shard_size')
+    parser.add_argument('--shard_size', metavar='INTEGER', type=int, nargs=1, default=[None],
+                        help='out-of-core training: the features are extracted into the --store '
+                             'training set batch by batch, and a forest is trained on each shard '
+                             'of at most SHARD_SIZE samples of it, with its share of the NB_TREES '
+                             'trees (at least one per shard, i.e. more than NB_TREES if there are '
+                             'more shards); the model is stored as a model bundle. Only this '
+                             'option bounds the memory of the training')
     utility.parsing_commands(parser)
 
     return vars(parser.parse_args())
 
 
-arg_obj = parsing_commands()
-utility.control_logger(arg_obj['v'][0])
-
-
-def main_learn(js_dirs=arg_obj['d'], js_dirs_validate=arg_obj['vd'], labels_validate=arg_obj['vl'],
-               labels_d=arg_obj['l'], model_dir=arg_obj['md'], model_name=arg_obj['mn'],
-               print_score=arg_obj['ps'], print_res=arg_obj['pr'], level=arg_obj['level'],
-               n=arg_obj['n'][0], estimators=arg_obj['nt'], features_choice=arg_obj['features'],
-               analysis_path=arg_obj['analysis_path'][0]):
+def main_learn(js_dirs=None, js_dirs_validate=None, labels_validate=None, labels_d=None,
+               model_dir=os.path.join(SRC_PATH, 'Analysis'), model_name='model',
+               print_score=False, print_res=False, level=None, n=4, estimators=500,
+               features_choice=None, analysis_path=os.path.join(SRC_PATH, 'Analysis'),
+               criterion='chi2', top_k=None, min_support=features_selection.MIN_SUPPORT,
+               model_format='pickle', warm_start=None, store=None, shard_size=None,
+               compare_selection=False):
     """
         Main function, performs a static analysis (syntactic) of JavaScript files given as input
         to build a model to classify future JavaScript files.
@@ -173,8 +297,30 @@ def main_learn(js_dirs=arg_obj['d'], js_dirs_validate=arg_obj['vd'], labels_vali
             Either 'ngrams' or 'value' depending on the features you want.
         - analysis_path: str
             Folder to store the features' analysis results in.
-        Default values are the ones given in the command lines or in the
-        ArgumentParser object (function parsingCommands()).
+        - criterion: str
+            Either 'chi2' or 'mi', criterion to select the features with.
+        - top_k: int
+            Maximum number of features to select, None for no maximum.
+        - min_support: int
+            Only the features found in more files are analyzed for the features selection.
+        - compare_selection: bool
+            Indicates whether to select the features with every criterion too, in the
+            selection report.
+        - model_format: str
+            Either 'pickle' or 'bundle', format to store the model in.
+        - warm_start: str
+            Pickled model to add trees to, keeping its features, instead of training a new one.
+        - store: str
+            Folder of the training set to append the samples to and to train the model on.
+        - shard_size: int
+            Maximum number of samples per shard for the out-of-core training, None to train
+            the model in memory.
+        Default values are the ones of the ArgumentParser object (function parsing_commands()),
+        the command line being handled by main().
+
+        -------
+        Returns:
+        - The model trained (see classify and classify_out_of_core), or None.
     """
 
     if js_dirs is None:
@@ -192,52 +338,106 @@ def main_learn(js_dirs=arg_obj['d'], js_dirs_validate=arg_obj['vd'], labels_vali
         logging.error('Please, indicate as many directory labels (--l option) as the number %s of '
                       'directories to analyze', str(len(js_dirs)))
 
-    elif js_dirs_validate is None:
+    elif js_dirs_validate is None and warm_start is None:
         logging.error('Please, indicate the 2 JS directories (--vd option) '
                       'with corresponding labels (--vl option, 1 benign and 1 malicious) '
                       'for the features validation process')
 
-    elif len(js_dirs_validate) != 2 or labels_validate is None\
-            or 'benign' not in labels_validate or 'malicious' not in labels_validate:
+    elif warm_start is None and (len(js_dirs_validate) != 2 or labels_validate is None
+                                 or 'benign' not in labels_validate
+                                 or 'malicious' not in labels_validate):
         logging.error('Please, indicate the 2 JS directories (--vd option) '
                       'with corresponding labels (--vl option, 1 benign and 1 malicious) '
                       'for the features validation process.\nGot %s directories with following '
                       'labels %s', str(len(js_dirs_validate)), labels_validate)
 
+    elif shard_size is not None and (store is None or warm_start is not None):
+        logging.error('The out-of-core training (--shard_size option) needs a training set '
+                      '(--store option), and cannot add trees to a model (--warm_start option)')
+
     elif utility.check_params(level, features_choice) == 0:
-        return
+        return None
 
     else:
         analysis_path = os.path.join(analysis_path, 'Features')
         utility.check_folder_exists(analysis_path)
 
-        features2int_dict_path = os.path.join(analysis_path, features_choice[0],
-                                              level[0] + '_selected_features_99')
+        features2int_dict_path = os.path.join(analysis_path, features_choice,
+                                              level + '_selected_features_99')
+
+        if warm_start is None:
+            features_preselection.handle_features_all(js_dirs, labels_d, level, features_choice,
+                                                      analysis_path, n)
+            features_selection.store_features_all(js_dirs_validate, labels_validate, level,
+                                                  features_choice, analysis_path, n,
+                                                  criterion=criterion, top_k=top_k,
+                                                  min_support=min_support,
+                                                  compare_criteria=compare_selection)
+        elif not os.path.isfile(features2int_dict_path):
+            logging.error('The features selected for the model %s are not in %s', warm_start,
+                          features2int_dict_path)
+            return None
+
+        if store is not None:  # Trained on all the samples of the training set
+            # The rows are appended to the store as they are extracted, not gathered first
+            if not static_analysis.main_analysis_store(js_dirs, labels_d, level, features_choice,
+                                                       n, features2int_dict_path, store):
+                logging.warning('No valid JS file found for the analysis')
+                return None
+            if shard_size is not None:
+                return classify_out_of_core(store, model_dir, model_name, estimators,
+                                            shard_size, (level, features_choice, n),
+                                            features2int_dict_path)
+            names, attributes, labels = training_set.load_training_set(store)
 
-        features_preselection.handle_features_all(js_dirs, labels_d, level[0], features_choice[0],
-                                                  analysis_path, n)
-        features_selection.store_features_all(js_dirs_validate, labels_validate, level[0],
-                                              features_choice[0], analysis_path, n)
-
-        names, attributes, labels = static_analysis.main_analysis\
-            (js_dirs=js_dirs, labels_dirs=labels_d, js_files=None, labels_files=None,
-             n=n, level=level[0], features_choice=features_choice[0],
-             features2int_dict_path=features2int_dict_path)
+        else:
+            res = static_analysis.main_analysis(
+                js_dirs=js_dirs, labels_dirs=labels_d, js_files=None, labels_files=None,
+                n=n, level=level, features_choice=features_choice,
+                features2int_dict_path=features2int_dict_path)
+            if res is None:
+                return None
+            names, attributes, labels = res
 
         if names:
             # Uncomment to save the analysis results in pickle objects.
             """
-            utility.save_analysis_results(os.path.join(model_dir[0], "Analysis-n" + str(n) + "-dict"
+            utility.save_analysis_results(os.path.join(model_dir, "Analysis-n" + str(n) + "-dict"
                                                        + str(dict_not_hash)),
                                           names, attributes, labels)
             """
 
-            classify(names, labels, attributes, model_dir=model_dir[0], model_name=model_name[0],
-                     print_score=print_score[0], print_res=print_res[0], estimators=estimators[0])
+            return classify(names, labels, attributes, model_dir=model_dir, model_name=model_name,
+                            print_score=print_score, print_res=print_res, estimators=estimators,
+                            model_format=model_format, module=(level, features_choice, n),
+                            features2int_dict_path=features2int_dict_path,
+                            warm_start=warm_start)
 
-        else:
-            logging.warning('No valid JS file found for the analysis')
+        logging.warning('No valid JS file found for the analysis')
+    return None
+
+
+def main():
+    """ Command line of main_learn. """
+
+    arg_obj = parsing_commands()
+    utility.control_logger(arg_obj['v'][0])
+    utility.control_parallelism(arg_obj['workers'][0], arg_obj['backend'][0])
+    utility.control_cache(arg_obj['cache'][0])
+    utility.control_hashing(arg_obj['hash_bits'][0])
+    utility.control_vectorizer(arg_obj['vectorizer_bits'][0])
+
+    main_learn(js_dirs=arg_obj['d'], js_dirs_validate=arg_obj['vd'], labels_validate=arg_obj['vl'],
+               labels_d=arg_obj['l'], model_dir=arg_obj['md'][0], model_name=arg_obj['mn'][0],
+               print_score=arg_obj['ps'][0], print_res=arg_obj['pr'][0],
+               level=(arg_obj['level'] or [None])[0], n=arg_obj['n'][0],
+               estimators=arg_obj['nt'][0], features_choice=(arg_obj['features'] or [None])[0],
+               analysis_path=arg_obj['analysis_path'][0], criterion=arg_obj['selection'][0],
+               top_k=arg_obj['top_k'][0], min_support=arg_obj['min_support'][0],
+               model_format=arg_obj['format'][0], warm_start=arg_obj['warm_start'][0],
+               store=arg_obj['store'][0], shard_size=arg_obj['shard_size'][0],
+               compare_selection=arg_obj['compare_selection'][0])
 
 
 if __name__ == "__main__":  # Executed only if run as a script
-    main_learn()
+    main()
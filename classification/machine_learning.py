@@ -17,11 +17,25 @@
 """
 
 import os
+import sys
+import csv
+import json
 import logging
 import pickle
+from functools import partial
+import numpy as np
 
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import confusion_matrix
+import utility
+import parallel
+import compiled_forest
+import features_hashing
+import training_set
+
+
+TREES_BATCH_SIZE = 4096  # Samples whose per-tree probabilities are in memory at once
+RESULTS_BATCH_SIZE = 65536  # Results formatted and written at once
+RESULTS_BUFFER_SIZE = 2 ** 20  # Buffer of the results files, in bytes
+LABELS = np.array(['benign', 'malicious'], dtype=object)  # Label per malicious_mask value
 
 
 def classifier_choice(estimators=500):
@@ -34,9 +48,94 @@ def classifier_choice(estimators=500):
             Corresponds to the optimal RF sklearn classifier.
     """
 
+    from sklearn.ensemble import RandomForestClassifier  # Slow to import, only to train
+
     return RandomForestClassifier(n_estimators=estimators, max_depth=50, random_state=0, n_jobs=-1)
 
 
+def fit_out_of_core(store_path, estimators, shard_size):
+    """
+        Trains a forest on the samples of the training set store_path (see training_set.py)
+        with a bounded memory: a forest is trained on each stratified shard of at most
+        shard_size samples (see training_set.get_shards), with its share of the estimators
+        trees (at least one, i.e. at least as many trees as shards), then compiled (see
+        compiled_forest.py) before the next shard is loaded. The compiled forests are merged.
+        The shards with only one label are not used, their trees going to the other shards.
+
+        -------
+        Returns:
+        - CompiledForest
+        - or None if no shard had both labels.
+    """
+
+    is_malicious = training_set.load_labels(store_path)
+    shards = training_set.get_shards(is_malicious, shard_size)
+    shards_used = [rows for rows in shards if 0 < is_malicious[rows].sum() < len(rows)]
+    if len(shards_used) < len(shards):
+        logging.warning('%s of the %s shards of %s have only one label, their %s samples are not '
+                        'used: there are fewer malicious or benign samples than shards',
+                        str(len(shards) - len(shards_used)), str(len(shards)), store_path,
+                        str(len(is_malicious) - sum(len(rows) for rows in shards_used)))
+    if not shards_used:
+        logging.error('No shard of %s has both benign and malicious samples', store_path)
+        return None
+
+    nb_shards = len(shards_used)
+    if estimators < nb_shards:
+        logging.warning('Fewer trees (%s) than shards (%s): each shard trains one tree, i.e. %s '
+                        'trees in total', str(estimators), str(nb_shards), str(nb_shards))
+    forests = list()
+    for shard, (attributes, labels) in enumerate(training_set.iter_shards(store_path, shards_used,
+                                                                          is_malicious)):
+        clf = classifier_choice(estimators=max(1, estimators // nb_shards
+                                               + (shard < estimators % nb_shards)))
+        clf.set_params(random_state=shard)
+        clf.fit(attributes, labels)
+        forests.append(compiled_forest.compile_forest(clf))
+        logging.debug('Shard %s/%s: %s samples, %s trees', str(shard + 1), str(nb_shards),
+                      str(len(labels)), str(clf.n_estimators))
+    return compiled_forest.merge_compiled_forests(forests)
+
+
+def warm_start_classifier(model_path, estimators, features2int_dict_path=None):
+    """
+        Loads a forest stored by learner.py (pickle file) so that fitting it adds estimators
+        trees to its trees, instead of training a new forest.
+
+        -------
+        Returns:
+        - RandomForestClassifier
+        - or None if model_path is not a pickled forest (e.g. a compiled model or a bundle), or
+        was not trained with the features dictionary features2int_dict_path.
+    """
+
+    if os.path.isdir(model_path):
+        logging.error('Can only add trees to a pickled model (learner.py --format pickle), '
+                      'got %s', model_path)
+        return None
+    if not features_hashing.check_model_config(model_path, features2int_dict_path):
+        return None
+    clf = pickle.load(open(model_path, 'rb'))
+    clf.set_params(warm_start=True, n_estimators=len(clf.estimators_) + estimators)
+    return clf
+
+
+def load_model(model_path):
+    """ Loads a model stored by learner.py (pickle file) or compiled by compiled_forest.py
+    (folder, memory-mapped). """
+
+    if os.path.isdir(model_path):
+        return compiled_forest.load_compiled_forest(model_path)
+    return pickle.load(open(model_path, 'rb'))
+
+
+def get_malicious_mask(labels_predicted_proba, threshold):
+    """ Boolean array, True for the samples whose probability of being malicious (second column
+    of labels_predicted_proba) is over the threshold. """
+
+    return np.asarray(labels_predicted_proba)[:, 1] >= threshold
+
+
 def predict_labels_using_threshold(names_length, labels_predicted_proba, threshold):
     """
         Perform classification on the files 'names' using a threshold (probability of the sample
@@ -55,21 +154,19 @@ def predict_labels_using_threshold(names_length, labels_predicted_proba, thresho
 
         -------
         Returns:
-        - list
-            Contains the predicted labels of the files being analysed.
+        - np.array
+            Contains the predicted labels of the files being analysed (references to the 2
+            strings of LABELS).
     """
 
-    labels_predicted_test = ['benign' for _ in range(names_length)]
-    for i, _ in enumerate(labels_predicted_test):
-        if labels_predicted_proba[i, 1] >= threshold:  # If the proba of the sample being malicious
-            # is over the threshold...
-            labels_predicted_test[i] = 'malicious'  # ... we classify the sample as malicious.
-
-    return labels_predicted_test
+    if names_length == 0:
+        return LABELS[:0]
+    return LABELS[get_malicious_mask(labels_predicted_proba, threshold).view(np.int8)]
 
 
 def get_classification_results_verbose(names, labels, labels_predicted, labels_predicted_proba,
-                                       model, attributes, threshold):
+                                       model, attributes, threshold,
+                                       counts_of_same_predictions=None):
     """
         Print in stdout the classification results of the files 'names' after our analysis.
         Format: 'Name: labelPredicted (trueLabel) Probability[benign, malicious] majorityVoteTrees'
@@ -92,16 +189,23 @@ def get_classification_results_verbose(names, labels, labels_predicted, labels_p
         - threshold: float
             Probability of a sample being malicious over which the sample will be classified
             as malicious.
+        - counts_of_same_predictions: list
+            Output of get_nb_trees_specific_label if already computed.
     """
 
-    counts_of_same_predictions = get_nb_trees_specific_label(model, attributes,
-                                                             labels, labels_predicted, threshold)
-    nb_trees = len(model.estimators_)
+    if counts_of_same_predictions is None:
+        counts_of_same_predictions = get_nb_trees_specific_label(model, attributes, labels,
+                                                                 labels_predicted, threshold)
+    majority = '/' + str(model.n_estimators)
 
-    for i, _ in enumerate(names):
-        print(str(names[i]) + ': ' + str(labels_predicted[i]) + ' ('
-              + str(labels[i]) + ') ' + 'Proba: ' + str(labels_predicted_proba[i])
-              + ' Majority: ' + str(counts_of_same_predictions[i]) + '/' + str(nb_trees))
+    for start in range(0, len(names), RESULTS_BATCH_SIZE):
+        end = start + RESULTS_BATCH_SIZE
+        sys.stdout.write(''.join(
+            '%s: %s (%s) Proba: %s Majority: %s%s\n' % (name, label_predicted, label, proba, count,
+                                                       majority)
+            for name, label_predicted, label, proba, count in zip(
+                names[start:end], labels_predicted[start:end], labels[start:end],
+                labels_predicted_proba[start:end], counts_of_same_predictions[start:end])))
 
     print('> Name: labelPredicted (trueLabel) Probability[benign, malicious] majorityVoteTrees')
 
@@ -119,11 +223,96 @@ def get_classification_results(names, labels_predicted):
             Contains the predicted labels of the files being analysed.
     """
 
-    for i, _ in enumerate(names):
-        print(str(names[i]) + ': ' + str(labels_predicted[i]))
+    for start in range(0, len(names), RESULTS_BATCH_SIZE):
+        end = start + RESULTS_BATCH_SIZE
+        sys.stdout.write(''.join('%s: %s\n' % (name, label_predicted) for name, label_predicted
+                                 in zip(names[start:end], labels_predicted[start:end])))
     print('> Name: labelPredicted')
 
 
+def get_results_format(results_path):
+    """ 'jsonl' for a .jsonl or .json results file, 'csv' otherwise. """
+
+    if os.path.splitext(results_path)[1].lower() in ('.jsonl', '.json'):
+        return 'jsonl'
+    return 'csv'
+
+
+def format_floats(values):
+    """ repr of each float of values, computed once per distinct value (e.g. the confidence
+    only takes nb_trees + 1 values). """
+
+    unique_values, inverse = np.unique(values, return_inverse=True)
+    return np.array([repr(value) for value in unique_values.tolist()], dtype=object)[inverse]\
+        .tolist()
+
+
+def is_plain(strings, special):
+    """ True if the strings only contain printable ASCII characters, none from special, i.e.
+    can be written in a CSV or JSON file without quoting nor escaping. """
+
+    joined = ''.join(strings)
+    return joined.isascii() and joined.isprintable() and not any(char in joined
+                                                                 for char in special)
+
+
+def write_results(results_path, names, labels, labels_predicted, labels_predicted_proba,
+                  confidence=None):
+    """
+        Writes the classification results in a CSV file, or in a JSON Lines file if
+        results_path ends with .jsonl (see get_results_format), by batches of
+        RESULTS_BATCH_SIZE samples through a RESULTS_BUFFER_SIZE buffer.
+        Columns: name, label, prediction, proba_malicious and confidence (if given).
+
+        -------
+        Parameters:
+        - results_path: str
+            Path of the file to store the results in.
+        - names: list
+            Contains the path of the files being analysed.
+        - labels: list
+            Contains the labels (real classification or '?') of the files being analysed.
+        - labels_predicted: list
+            Contains the predicted labels of the files being analysed.
+        - labels_predicted_proba: matrix
+            Contains in the first column the probability of the samples being benign,
+            and malicious in the second one.
+        - confidence: np.array
+            Fraction of the trees which gave the same prediction as the forest, per sample.
+    """
+
+    columns = ['name', 'label', 'prediction', 'proba_malicious']
+    if confidence is not None:
+        columns.append('confidence')
+    results_format = get_results_format(results_path)
+    if os.path.dirname(results_path):
+        os.makedirs(os.path.dirname(results_path), exist_ok=True)
+
+    with open(results_path, 'w', buffering=RESULTS_BUFFER_SIZE, newline='') as results_file:
+        if results_format == 'csv':
+            writer = csv.writer(results_file)
+            writer.writerow(columns)
+        for start in range(0, len(names), RESULTS_BATCH_SIZE):
+            end = start + RESULTS_BATCH_SIZE
+            rows = [names[start:end], list(labels[start:end]), list(labels_predicted[start:end]),
+                    format_floats(np.asarray(labels_predicted_proba)[start:end, 1])]
+            if confidence is not None:
+                rows.append(format_floats(np.asarray(confidence)[start:end]))
+            plain = is_plain(rows[0] + rows[1] + rows[2], ',"\\')
+            if results_format == 'csv' and plain:  # Nothing to quote
+                results_file.write(''.join(line + '\r\n' for line in map(','.join, zip(*rows))))
+            elif results_format == 'csv':
+                writer.writerows(zip(*rows))
+            else:
+                for i in range(3):
+                    rows[i] = ['"' + string + '"' for string in rows[i]] if plain\
+                        else [json.dumps(string) for string in rows[i]]
+                template = '{' + ', '.join('"' + column + '": %s' for column in columns) + '}\n'
+                results_file.write(''.join(template % row for row in zip(*rows)))
+
+    logging.info('The classification results have been stored in %s', results_path)
+
+
 def get_score(labels, labels_predicted):
     """
         Print in stdout the accuracy results of our classification (i.e. detection accuracy,
@@ -141,6 +330,8 @@ def get_score(labels, labels_predicted):
         logging.info("No ground truth given: unable to evaluate the accuracy of the "
                      "classifier's predictions")
     else:
+        from sklearn.metrics import confusion_matrix
+
         try:
             tn, fp, fn, tp = confusion_matrix(labels, labels_predicted,
                                               labels=['benign', 'malicious']).ravel()
@@ -155,6 +346,40 @@ def get_score(labels, labels_predicted):
             logging.exception(error_message)
 
 
+def get_tree_proba(tree, attributes):
+    """ predict_proba of a tree of the forest, attributes being already validated. """
+
+    return tree.predict_proba(attributes, check_input=False)
+
+
+def iter_trees_proba(model, attributes):
+    """
+        Yields the probabilities of each tree of the forest for batches of TREES_BATCH_SIZE
+        samples, the trees being run in parallel (threads, as the trees' predictions release
+        the GIL).
+
+        -------
+        Returns:
+        - generator of np.array
+            (n_trees, n_samples_batch, n_classes) probabilities per tree, per batch of samples.
+    """
+
+    if isinstance(model, compiled_forest.CompiledForest):
+        yield from model.iter_trees_proba(attributes)
+        return
+    from sklearn.utils import check_array  # Only for sklearn forests, compiled ones need none
+
+    attributes = check_array(attributes, accept_sparse='csr', dtype=np.float32)
+    backend = 'serial' if utility.BACKEND == 'serial' else 'thread'
+    for start in range(0, attributes.shape[0], TREES_BATCH_SIZE):
+        trees_proba, errors = parallel.parallel_map(
+            partial(get_tree_proba, attributes=attributes[start:start + TREES_BATCH_SIZE]),
+            model.estimators_, backend=backend, chunksize=1)
+        if errors:
+            raise ValueError(str(len(errors)) + ' trees could not predict the samples')
+        yield np.stack(trees_proba)
+
+
 def get_nb_trees_specific_label(model, attributes, labels, labels_predicted, threshold):
     """
         Get the number of trees which gave the same prediction as the one of the whole forest.
@@ -173,24 +398,62 @@ def get_nb_trees_specific_label(model, attributes, labels, labels_predicted, thr
             Probability of a sample being malicious over which the sample will be classified
             as malicious.
 
+        -------
+        Returns:
+        - list
+            Number of trees per sample.
     """
 
-    # Initialize a vector to hold counts of trees that gave the same class as in labels_predicted
-    counts_of_same_predictions = [0 for _, _ in enumerate(labels)]
-    # i = 0
-    for each_tree in model.estimators_:
-        single_tree_predictions_proba = each_tree.predict_proba(attributes)
-        single_tree_predictions = predict_labels_using_threshold(len(labels),
-                                                                 single_tree_predictions_proba,
-                                                                 threshold)
-        # Check if predictions are the same with the global (forest's) predictions
-        for j, _ in enumerate(single_tree_predictions):
-            if single_tree_predictions[j] == labels_predicted[j]:
-                counts_of_same_predictions[j] += 1
+    predicted_malicious = np.array(labels_predicted) == 'malicious'
+    counts_of_same_predictions = list()
+    start = 0
+    for trees_proba in iter_trees_proba(model, attributes):
+        end = start + trees_proba.shape[1]
+        # Trees predicting the same label as the forest, with the same threshold
+        same_predictions = (trees_proba[:, :, 1] >= threshold) == predicted_malicious[start:end]
+        counts_of_same_predictions.extend(same_predictions.sum(axis=0).tolist())
+        start = end
 
     return counts_of_same_predictions
 
 
+def predict_proba_agreement(model, attributes, threshold):
+    """
+        predict_proba of the forest along with the number of trees which gave the same prediction
+        as the forest, in one pass over the trees.
+
+        -------
+        Parameters:
+        - model
+            Model to be used to classify new observations.
+        - attributes: csr_matrix
+            Features of the data considered.
+        - threshold: float
+            Probability of a sample being malicious over which the sample will be classified
+            as malicious.
+
+        -------
+        Returns:
+        - np.array
+            Probabilities of the samples, first column = benign, second = malicious.
+        - np.array
+            Number of trees which gave the same prediction as the forest, per sample.
+    """
+
+    labels_predicted_proba = list()
+    counts_of_same_predictions = list()
+    for trees_proba in iter_trees_proba(model, attributes):
+        # Averaged in the trees' order, like RandomForestClassifier.predict_proba
+        proba = trees_proba.sum(axis=0) / len(trees_proba)
+        same_predictions = (trees_proba[:, :, 1] >= threshold) == (proba[:, 1] >= threshold)
+        labels_predicted_proba.append(proba)
+        counts_of_same_predictions.append(same_predictions.sum(axis=0))
+
+    if not labels_predicted_proba:
+        return np.zeros((0, len(model.classes_))), np.zeros(0, dtype=np.int64)
+    return np.concatenate(labels_predicted_proba), np.concatenate(counts_of_same_predictions)
+
+
 def save_analysis_results(save_dir, names, attributes, labels):
     """
         Save the results of a previous analysis, i.e. files name, attributes and label.
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    Model bundles: a folder holding everything needed to classify with a model, without pickle.
+    Layout:
+        * the arrays of the compiled forest (see compiled_forest.py), memory-mapped read-only
+        when loaded, so that their pages are shared by all the processes using the bundle;
+        * features.json: the selected features, in the order of their column;
+        * buckets<VECTORIZER_BITS>.npy and .json: the buckets mask of the hashing vectorizer and
+        its metadata, if the model was trained with one (see features_hashing.py);
+        * bundle.json: level, features_choice, n, threshold, hash_bits, vectorizer_bits and
+        training statistics.
+    A bundle can be given instead of a model and of its features dictionary.
+"""
+
+import os
+import json
+import pickle
+import shutil
+import logging
+import argparse
+
+import utility
+import compiled_forest
+import features_cache
+import features_hashing
+
+
+BUNDLE_FORMAT = 'jstap-bundle'
+BUNDLE_VERSION = 1
+DEFAULT_THRESHOLD = 0.5
+
+
+def is_bundle(path):
+    """ Indicates whether path is a model bundle. """
+
+    return path is not None and os.path.isfile(os.path.join(path, 'bundle.json'))
+
+
+def save_bundle(bundle_path, model, features2int_dict, level, features_choice, n,
+                threshold=DEFAULT_THRESHOLD, stats=None):
+    """
+        Stores a model with its features dictionary in the bundle bundle_path. The bundle is
+        written next to bundle_path then renamed, so that it is never seen incomplete.
+
+        -------
+        Parameters:
+        - bundle_path: str
+            Folder to store the bundle in.
+        - model: RandomForestClassifier or CompiledForest
+            Trained forest.
+        - features2int_dict: dict
+            Selected features, key: feature, value: its column.
+        - level, features_choice, n:
+            Module the model was trained for, see static_analysis.main_analysis.
+        - threshold: float
+            Threshold to classify the samples with, if not given to the classifier.
+        - stats: dict
+            Training statistics.
+    """
+
+    tmp_path = bundle_path.rstrip(os.sep) + '.' + str(os.getpid()) + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    if not isinstance(model, compiled_forest.CompiledForest):
+        model = compiled_forest.compile_forest(model)
+    model.save(tmp_path)
+    with open(os.path.join(tmp_path, 'features.json'), 'w') as features_file:
+        features_file.write(features_cache.encode_features(
+            sorted(features2int_dict, key=features2int_dict.get)))
+    if utility.VECTORIZER_BITS is not None:
+        features_hashing.store_vectorizer(tmp_path, features2int_dict)
+    with open(os.path.join(tmp_path, 'bundle.json'), 'w') as meta_file:
+        json.dump({'format': BUNDLE_FORMAT, 'version': BUNDLE_VERSION, 'level': level,
+                   'features_choice': features_choice, 'n': n, 'threshold': threshold,
+                   'hash_bits': utility.HASH_BITS, 'vectorizer_bits': utility.VECTORIZER_BITS,
+                   'stats': stats or dict()}, meta_file, indent=2)
+    if os.path.isdir(bundle_path):
+        shutil.rmtree(bundle_path)
+    elif os.path.isfile(bundle_path):  # E.g. a pickled model stored before
+        os.remove(bundle_path)
+    os.replace(tmp_path, bundle_path)
+    logging.info('The model bundle has been successfully stored in %s', bundle_path)
+
+
+def load_bundle_meta(bundle_path):
+    """ Metadata of a bundle, see save_bundle. Returns None if it is not a valid bundle, or if
+    it was built with other hashing options than the current ones. """
+
+    with open(os.path.join(bundle_path, 'bundle.json')) as meta_file:
+        meta = json.load(meta_file)
+    if meta.get('format') != BUNDLE_FORMAT or meta.get('version', 0) > BUNDLE_VERSION:
+        logging.error('%s is not a model bundle this version can read', bundle_path)
+        return None
+    if not features_hashing.check_hashing_config(meta, bundle_path):
+        return None
+    return meta
+
+
+def load_features2int_dict(bundle_path):
+    """ Features dictionary of a bundle, key: feature, value: its column. """
+
+    with open(os.path.join(bundle_path, 'features.json')) as features_file:
+        features = features_cache.decode_features(features_file.read())
+    return {feature: col for col, feature in enumerate(features)}
+
+
+def get_threshold(threshold, model_path):
+    """ threshold if given, otherwise the one of the bundle model_path, or DEFAULT_THRESHOLD. """
+
+    if threshold is None and is_bundle(model_path):
+        with open(os.path.join(model_path, 'bundle.json')) as meta_file:
+            return json.load(meta_file)['threshold']
+    return DEFAULT_THRESHOLD if threshold is None else threshold
+
+
+def get_modules_models(modules_specs, n, analysis_path):
+    """
+        Parses the specifications of the modules: either 'level:features_choice:model', the
+        features dictionary being then in analysis_path (or in the model if it is a bundle), or
+        the path of a bundle.
+
+        -------
+        Returns:
+        - dict
+            Key: module (level, features_choice, n);
+            Value: [model path, features dictionary path].
+        - or None if a specification is not valid.
+    """
+
+    modules_models = dict()
+    for module_spec in modules_specs:
+        if is_bundle(module_spec):
+            meta = load_bundle_meta(module_spec)
+            if meta is None:
+                return None
+            modules_models[(meta['level'], meta['features_choice'], meta['n'])] = [module_spec,
+                                                                                   module_spec]
+            continue
+        try:
+            level, features_choice, model = module_spec.split(':', 2)
+        except ValueError:
+            logging.error('Expected LEVEL:FEATURES:MODEL or BUNDLE for the --modules option, '
+                          'got %s', module_spec)
+            return None
+        if utility.check_params(level, features_choice) == 0:
+            return None
+        features2int_dict_path = os.path.join(analysis_path, 'Features', features_choice,
+                                              level + '_selected_features_99')
+        module_n = n
+        if is_bundle(model):
+            meta = load_bundle_meta(model)
+            if meta is None:
+                return None
+            if (meta['level'], meta['features_choice']) != (level, features_choice):
+                logging.error('The bundle %s was built for %s:%s, got %s', model,
+                              meta['level'], meta['features_choice'], module_spec)
+                return None
+            features2int_dict_path, module_n = model, meta['n']
+        elif not features_hashing.check_model_config(model, features2int_dict_path):
+            return None
+        modules_models[(level, features_choice, module_n)] = [model, features2int_dict_path]
+    return modules_models
+
+
+def main_bundle():
+    """ Stores a model built by learner.py (pickle) with its features dictionary in a
+    bundle. """
+
+    parser = argparse.ArgumentParser(description='Stores a model built by learner.py with its '
+                                                 'features dictionary in a model bundle.')
+    parser.add_argument('--m', metavar='MODEL', type=str, nargs=1, required=True,
+                        help='path of the model to store in a bundle')
+    parser.add_argument('--out', metavar='DIR', type=str, nargs=1, required=True,
+                        help='folder to store the bundle in')
+    parser.add_argument('--th', metavar='THRESHOLD', type=float, nargs=1,
+                        default=[DEFAULT_THRESHOLD],
+                        help='threshold over which all samples are considered malicious')
+    utility.parsing_commands(parser)
+    arg_obj = vars(parser.parse_args())
+    utility.control_logger(arg_obj['v'][0])
+    utility.control_hashing(arg_obj['hash_bits'][0])
+    utility.control_vectorizer(arg_obj['vectorizer_bits'][0])
+
+    level, features_choice = arg_obj['level'], arg_obj['features']
+    if utility.check_params(level, features_choice) == 0:
+        return
+    features2int_dict_path = os.path.join(arg_obj['analysis_path'][0], 'Features',
+                                          features_choice[0], level[0] + '_selected_features_99')
+    if not features_hashing.check_model_config(arg_obj['m'][0], features2int_dict_path):
+        return
+    save_bundle(arg_obj['out'][0], pickle.load(open(arg_obj['m'][0], 'rb')),
+                pickle.load(open(features2int_dict_path, 'rb')), level[0], features_choice[0],
+                arg_obj['n'][0], threshold=arg_obj['th'][0])
+
+
+if __name__ == "__main__":  # Executed only if run as a script
+    main_bundle()
@@ -0,0 +1,215 @@
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    Parallel map shared by the classification modules, with process, thread or serial backends
+    (NUM_WORKERS and BACKEND defined in utility.py).
+"""
+
+import logging
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import utility
+
+
+BACKENDS = ('process', 'thread', 'serial')
+
+
+def run_chunk(func, chunk):
+    """ Applies func to each item of a chunk. Returns [item, True, result] on success and
+    [item, False, error] on failure, so that one item does not make the whole chunk fail. """
+
+    res = list()
+    for item in chunk:
+        try:
+            res.append([item, True, func(item)])
+        except Exception as e:  # Handle exception occurring in the processes spawned
+            res.append([item, False, repr(e)])
+    return res
+
+
+def get_chunks(items, chunksize):
+    """ Splits items (any iterable) into lists of chunksize elements. """
+
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_chunksize(items, workers):
+    """ Default chunk size: about 4 chunks per worker, between 1 and 64 items. """
+
+    try:
+        return max(1, min(64, len(items) // (4 * workers)))
+    except TypeError:  # items has no len
+        return 1
+
+
+def init_process(config, initializer, initargs):
+    """ Sets the configuration of utility.py in a worker process before calling initializer. """
+
+    utility.set_config(config)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def get_executor(backend, workers, initializer, initargs):
+    """ Returns the concurrent.futures executor corresponding to backend. """
+
+    if backend == 'process':
+        return ProcessPoolExecutor(max_workers=workers, initializer=init_process,
+                                   initargs=(utility.get_config(), initializer, initargs))
+    if initializer is not None:  # Threads share the current process' state
+        initializer(*initargs)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def parallel_imap(func, items, errors=None, workers=None, backend=None, chunksize=None,
+                  ordered=True, initializer=None, initargs=()):
+    """
+        Applies func to each item of items in parallel and yields the results.
+
+        -------
+        Parameters:
+        - func: function
+            Function to apply. Has to be picklable (i.e. defined at the top level of a module)
+            for the process backend.
+        - items: iterable
+            Items to handle. Consumed lazily, at most 2 chunks per worker are in flight.
+        - errors: list
+            If not None, filled with [item, error] for each item func failed on, or which was
+            not handled because a worker died.
+        - workers: int
+            Number of workers. Default: utility.NUM_WORKERS.
+        - backend: str
+            Either 'process', 'thread' or 'serial'. Default: utility.BACKEND.
+        - chunksize: int
+            Number of items sent to a worker at once. Default: see get_chunksize.
+        - ordered: bool
+            Yields the results in the order of items if True, as they arrive otherwise.
+        - initializer, initargs:
+            Called once in each worker process, e.g. to set global variables.
+
+        -------
+        Returns:
+        - generator
+            Results of func for the items it did not fail on.
+    """
+
+    workers = utility.NUM_WORKERS if workers is None else workers
+    backend = utility.BACKEND if backend is None else backend
+    chunksize = get_chunksize(items, workers) if chunksize is None else chunksize
+
+    if backend not in BACKENDS:
+        logging.error('Expected \'process\' or \'thread\' or \'serial\', got %s instead', backend)
+        return
+
+    if backend == 'serial' or workers < 1:
+        if initializer is not None:
+            initializer(*initargs)
+        done = (run_chunk(func, chunk) for chunk in get_chunks(items, chunksize))
+        for chunk_res in done:
+            yield from handle_chunk_results(chunk_res, errors)
+        return
+
+    chunks = get_chunks(items, chunksize)
+    with get_executor(backend, workers, initializer, initargs) as executor:
+        in_flight = deque()
+        submitted = dict()  # Chunk of each future, to report its items if the pool breaks
+        for chunk in itertools.islice(chunks, 2 * workers):
+            future = executor.submit(run_chunk, func, chunk)
+            submitted[future] = chunk
+            in_flight.append(future)
+
+        while in_flight:
+            if ordered:
+                finished = [in_flight.popleft()]
+            else:
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    in_flight.remove(future)
+            lost, broken = list(), None
+            for future in finished:
+                try:
+                    chunk_res = future.result()
+                except BrokenProcessPool as e:  # A worker died (e.g. segfault), pool unusable
+                    lost.append(submitted.pop(future))
+                    broken = e
+                    continue
+                del submitted[future]
+                yield from handle_chunk_results(chunk_res, errors)
+                for chunk in itertools.islice(chunks, 1 if broken is None else 0):
+                    try:
+                        future = executor.submit(run_chunk, func, chunk)
+                    except BrokenProcessPool as e:  # Broken since the chunk's result came
+                        lost.append(chunk)
+                        broken = e
+                        continue
+                    submitted[future] = chunk
+                    in_flight.append(future)
+            if broken is not None:
+                for future_left in in_flight:
+                    future_left.cancel()
+                lost.extend(submitted[future_left] for future_left in in_flight)
+                lost.extend(chunks)
+                handle_lost_items(itertools.chain.from_iterable(lost), broken, errors)
+                return
+
+
+def handle_lost_items(items, error, errors):
+    """ Logs the items not handled because the pool broke, and adds them to errors. """
+
+    items = list(items)
+    logging.error('A worker died, %s remaining items are not handled: %s', str(len(items)),
+                  error)
+    if errors is not None:
+        errors.extend([item, repr(error)] for item in items)
+
+
+def handle_chunk_results(chunk_res, errors):
+    """ Yields the results of a chunk, logs and collects its errors. """
+
+    for [item, success, res] in chunk_res:
+        if success:
+            yield res
+        else:
+            logging.error('Something went wrong with %s: %s', item, res)
+            if errors is not None:
+                errors.append([item, res])
+
+
+def parallel_map(func, items, workers=None, backend=None, chunksize=None, ordered=True,
+                 initializer=None, initargs=()):
+    """
+        parallel_imap, returning all results at once.
+
+        -------
+        Returns:
+        - list
+            Results of func for the items it did not fail on.
+        - list
+            [item, error] for each item func failed on.
+    """
+
+    errors = list()
+    res = list(parallel_imap(func, items, errors, workers=workers, backend=backend,
+                             chunksize=chunksize, ordered=ordered, initializer=initializer,
+                             initargs=initargs))
+    return res, errors
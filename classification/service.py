@@ -0,0 +1,419 @@
+#!/usr/bin/python
+
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    Resident classification service: the models, the features dictionaries and the features
+    extraction workers are loaded once, then the JS files are classified as the requests come,
+    one JSON object per line, on a Unix socket or on stdin.
+    Request: {"id": ..., "path": JS file} or {"id": ..., "source": JS code}. The PDG of the file
+    is the one in Analysis/PDG of its folder if any, otherwise it is built on the fly.
+    Response: {"id": ..., "modules": {"level:features": {"proba": [benign, malicious],
+    "prediction": label, "batch_size": rows predicted with it}}, "latency": {"features": s,
+    "predict": s, "total": s}}, or {"id": ..., "error": message}.
+"""
+
+import os
+import sys
+import json
+import uuid
+import socket
+import signal
+import shutil
+import logging
+import asyncio
+import argparse
+import timeit
+from functools import partial
+
+import utility
+import parallel
+import features_space
+import static_analysis
+import machine_learning
+import model_bundle
+
+
+MAX_BATCH = 64  # Maximum number of rows per call to predict_proba
+MAX_WAIT = 0.005  # Maximum time (in s) a row waits for other rows to fill its batch
+QUEUE_DEPTH = 1024  # Rows waiting for a batch, per module, before the requests wait
+
+
+def warm_worker():
+    """ Imports the features extraction modules in a worker. """
+
+    import features_ngrams
+    import features_value
+    return os.getpid()
+
+
+class MicroBatcher:
+    """
+        Accumulates the features vectors of concurrent requests into micro-batches of at most
+        max_batch rows, a batch waiting at most max_wait seconds after its first row, so that
+        the model's predict_proba is called once per batch. At most queue_depth rows wait for
+        a batch, the next requests wait for a place in the queue.
+    """
+
+    def __init__(self, model, nb_features, max_batch=MAX_BATCH, max_wait=MAX_WAIT,
+                 queue_depth=QUEUE_DEPTH):
+        self.model = model
+        self.nb_features = nb_features
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue(maxsize=queue_depth)
+        self.not_empty = asyncio.Event()
+        self.task = None
+
+    async def predict_proba(self, row):
+        """ Probabilities of a features vector (indices, data), with the size of the batch
+        it was predicted in. """
+
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((row, future))
+        self.not_empty.set()
+        return await future
+
+    async def get_batch(self):
+        """ Waits for the rows of the next batch. """
+
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            self.not_empty.clear()
+            try:
+                await asyncio.wait_for(self.not_empty.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def predict_batch(self, rows):
+        """ predict_proba of a batch of features vectors. """
+
+        csr_builder = features_space.CsrBuilder(self.nb_features)
+        for indices, data in rows:
+            csr_builder.add_row(indices, data)
+        return self.model.predict_proba(csr_builder.get_csr())
+
+    async def run(self):
+        """ Predicts the batches one after the other, the next batch filling up meanwhile. """
+
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.get_batch()
+            try:
+                proba = await loop.run_in_executor(None, self.predict_batch,
+                                                   [row for row, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), row_proba in zip(batch, proba):
+                if not future.done():
+                    future.set_result((row_proba, len(batch)))
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+
+
+class Scorer:
+    """
+        Classifies JS files with several modules. The models and the features dictionaries are
+        loaded once, the features are extracted by workers started once, and the predictions
+        of concurrent requests are batched per module (see MicroBatcher).
+    """
+
+    def __init__(self, modules_models, features2int_dicts, threshold=None, max_batch=MAX_BATCH,
+                 max_wait=MAX_WAIT, queue_depth=QUEUE_DEPTH):
+        self.modules = list(modules_models.keys())
+        self.models = {module: machine_learning.load_model(modules_models[module][0])
+                       for module in self.modules}
+        self.features2int_dicts = features2int_dicts  # See static_analysis.load_features2int_dicts
+        self.thresholds = {module: model_bundle.get_threshold(threshold, modules_models[module][0])
+                           for module in self.modules}  # Bundles come with their threshold
+        self.tmp_dir = static_analysis.get_tmp_dir('jstap_service_')
+        self.executor = parallel.get_executor(utility.BACKEND, max(1, utility.NUM_WORKERS),
+                                              static_analysis.set_features2int_dicts,
+                                              (self.features2int_dicts,))
+        for future in [self.executor.submit(warm_worker)
+                       for _ in range(max(1, utility.NUM_WORKERS))]:
+            future.result()  # The workers are started before serving
+        self.batchers = {module: MicroBatcher(self.models[module],
+                                              len(self.features2int_dicts[module]), max_batch,
+                                              max_wait, queue_depth) for module in self.modules}
+
+    def close(self):
+        for batcher in self.batchers.values():
+            batcher.close()
+        self.executor.shutdown()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def get_js_path(self, request):
+        """ Path of the JS file of a request, the source being written in tmp_dir. Returns
+        the path and whether it is a temporary file. """
+
+        if 'source' in request:
+            js_path = os.path.join(self.tmp_dir, uuid.uuid4().hex + '.js')
+            with open(js_path, 'w') as js_file:
+                js_file.write(request['source'])
+            return js_path, True
+        return request['path'], False
+
+    async def predict(self, rows):
+        """ Probabilities and predicted label of each module, given the features vector of
+        each module. """
+
+        res, modules, predictions = dict(), list(), list()
+        for module, row in rows.items():
+            if row is None:
+                res[module[0] + ':' + module[1]] = {'error': 'no features could be extracted'}
+            else:
+                modules.append(module)
+                predictions.append(self.batchers[module].predict_proba(row))
+        for module, (proba, batch_size) in zip(modules, await asyncio.gather(*predictions)):
+            res[module[0] + ':' + module[1]] = {
+                'proba': proba.tolist(),
+                'prediction': 'malicious' if proba[1] >= self.thresholds[module] else 'benign',
+                'batch_size': batch_size}
+        return res
+
+    async def score(self, request):
+        """ Response to a request (see the module's docstring). """
+
+        start = timeit.default_timer()
+        loop = asyncio.get_running_loop()
+        response = {'id': request.get('id')}
+        js_path, tmp_file = None, False
+        try:
+            js_path, tmp_file = self.get_js_path(request)
+            pdg_path = static_analysis.get_pdg_path(js_path)
+            if not os.path.isfile(js_path) and not os.path.isfile(pdg_path):
+                raise FileNotFoundError(js_path)
+            _, rows = await loop.run_in_executor(
+                self.executor, partial(static_analysis.get_features_file_modules,
+                                       modules=self.modules, pdg_dir=self.tmp_dir,
+                                       pdg_path=pdg_path), js_path)
+            features_time = timeit.default_timer() - start
+            response['modules'] = await self.predict(rows)
+            response['latency'] = {'features': features_time,
+                                   'predict': timeit.default_timer() - start - features_time,
+                                   'total': timeit.default_timer() - start}
+        except Exception as e:
+            logging.error('Could not classify the request %s: %s', str(response['id']), e)
+            response['error'] = repr(e)
+        finally:
+            if tmp_file:
+                os.remove(js_path)
+        return response
+
+
+def parse_request(line):
+    """ Request of a line: a JSON object, or the path of a JS file. """
+
+    line = line.strip()
+    if line.startswith('{'):
+        return json.loads(line)
+    return {'id': line, 'path': line}
+
+
+async def handle_requests(scorer, read_line, write_response):
+    """ Handles the requests read with read_line concurrently, the responses being written
+    with write_response as they are ready, until read_line returns ''. """
+
+    async def handle_line(line):
+        try:
+            request = parse_request(line)
+        except ValueError as e:
+            response = {'id': None, 'error': 'invalid request: ' + repr(e)}
+        else:
+            response = await scorer.score(request)
+        await write_response(json.dumps(response) + '\n')
+
+    tasks = set()
+    while True:
+        line = await read_line()
+        if not line:
+            break
+        if line.strip():
+            task = asyncio.ensure_future(handle_line(line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.wait(tasks)
+
+
+async def serve_unix(scorer, socket_path):
+    """ Serves the requests of the clients connected to the Unix socket socket_path. """
+
+    async def handle_client(reader, writer):
+        async def read_line():
+            return (await reader.readline()).decode('utf-8')
+
+        async def write_response(response):
+            writer.write(response.encode('utf-8'))
+            await writer.drain()
+
+        try:
+            await handle_requests(scorer, read_line, write_response)
+        finally:
+            writer.close()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = await asyncio.start_unix_server(handle_client, path=socket_path)
+    logging.info('Listening on %s', socket_path)
+    async with server:
+        await server.serve_forever()
+
+
+async def serve_stdin(scorer):
+    """ Serves the requests read on stdin, the responses being written on stdout. """
+
+    loop = asyncio.get_running_loop()
+
+    async def read_line():
+        return await loop.run_in_executor(None, sys.stdin.readline)
+
+    async def write_response(response):
+        sys.stdout.write(response)
+        sys.stdout.flush()
+
+    await handle_requests(scorer, read_line, write_response)
+
+
+def query_service(socket_path, requests):
+    """
+        Client: sends requests to the service listening on socket_path and returns the
+        responses (in the order they come, see their id).
+
+        -------
+        Parameters:
+        - socket_path: str
+            Unix socket of the service.
+        - requests: list
+            Requests, as dicts or JS paths.
+
+        -------
+        Returns:
+        - list of dict
+            Responses.
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(''.join((json.dumps(request) if isinstance(request, dict) else request)
+                               + '\n' for request in requests).encode('utf-8'))
+        client.shutdown(socket.SHUT_WR)
+        with client.makefile('r', encoding='utf-8') as stream:
+            return [json.loads(line) for line in stream]
+
+
+def parsing_commands():
+    """
+        Creation of an ArgumentParser object, holding all the information necessary to parse
+        the command line into Python data types.
+    """
+
+    parser = argparse.ArgumentParser(description='Resident service classifying JS inputs '
+                                                 'given as JSON lines on a Unix socket or '
+                                                 'stdin.')
+
+    parser.add_argument('--modules', metavar='LEVEL:FEATURES:MODEL', type=str, nargs='+',
+                        help='modules to classify the JS inputs with, e.g. tokens:ngrams:MODEL1 '
+                             'pdg:value:MODEL2, or model bundles')
+    parser.add_argument('--th', metavar='THRESHOLD', type=float, nargs=1, default=[None],
+                        help='threshold over which all samples are considered malicious; per '
+                             'default, the one of the bundles, or 0.5')
+    parser.add_argument('--socket', metavar='PATH', type=str, nargs=1, default=[None],
+                        help='Unix socket to listen on; per default, the requests are read on '
+                             'stdin and the responses written on stdout')
+    parser.add_argument('--connect', metavar='PATH', type=str, nargs=1, default=[None],
+                        help='client mode: sends the requests read on stdin to the service '
+                             'listening on PATH and prints the responses')
+    parser.add_argument('--max_batch', metavar='INTEGER', type=int, nargs=1, default=[MAX_BATCH],
+                        help='maximum number of requests predicted at once per module')
+    parser.add_argument('--max_wait', metavar='MS', type=float, nargs=1,
+                        default=[MAX_WAIT * 1000],
+                        help='maximum time (in ms) a request waits for other requests to fill '
+                             'its batch')
+    parser.add_argument('--queue_depth', metavar='INTEGER', type=int, nargs=1,
+                        default=[QUEUE_DEPTH],
+                        help='maximum number of requests waiting for a batch per module')
+    utility.parsing_commands(parser)
+
+    return vars(parser.parse_args())
+
+
+def main_service():
+    """ Starts the service (or the client with --connect); TO CALL. """
+
+    arg_obj = parsing_commands()
+    utility.control_logger(arg_obj['v'][0])
+
+    if arg_obj['connect'][0] is not None:
+        for response in query_service(arg_obj['connect'][0],
+                                      [line.strip() for line in sys.stdin if line.strip()]):
+            print(json.dumps(response))
+        return
+
+    utility.control_parallelism(arg_obj['workers'][0], arg_obj['backend'][0])
+    utility.control_cache(arg_obj['cache'][0])
+    utility.control_hashing(arg_obj['hash_bits'][0])
+    utility.control_vectorizer(arg_obj['vectorizer_bits'][0])
+
+    if arg_obj['modules'] is None:
+        logging.error('Please, indicate the modules (--modules option) to classify the JS inputs '
+                      'with')
+        return
+    modules_models = model_bundle.get_modules_models(arg_obj['modules'], arg_obj['n'][0],
+                                                     arg_obj['analysis_path'][0])
+    if modules_models is None:
+        return
+    features2int_dicts = static_analysis.load_features2int_dicts(
+        list(modules_models.keys()), [features2int_dict_path
+                                      for _, features2int_dict_path in modules_models.values()])
+    if features2int_dicts is None:
+        return
+
+    scorer = Scorer(modules_models, features2int_dicts, threshold=arg_obj['th'][0],
+                    max_batch=arg_obj['max_batch'][0], max_wait=arg_obj['max_wait'][0] / 1000,
+                    queue_depth=arg_obj['queue_depth'][0])
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # To clean up on kill too
+    try:
+        if arg_obj['socket'][0] is not None:
+            asyncio.run(serve_unix(scorer, arg_obj['socket'][0]))
+        else:
+            asyncio.run(serve_stdin(scorer))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scorer.close()
+        if arg_obj['socket'][0] is not None and os.path.exists(arg_obj['socket'][0]):
+            os.remove(arg_obj['socket'][0])
+
+
+if __name__ == "__main__":  # Executed only if run as a script
+    main_service()
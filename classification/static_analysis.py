@@ -19,18 +19,34 @@
 """
 
 import os
+import sys
+import uuid
 import logging
 import timeit
 import pickle
-from multiprocessing import Process, Queue
-import queue  # For the exception queue.Empty which is not in the multiprocessing package
-from scipy import sparse
+import shutil
+import tempfile
+import threading
+import contextlib
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import numpy as np
 
 import utility
 import features_space
+import features_hashing
+import parallel
+import model_bundle
+import training_set
 
 
 features2int_dict = None
+features2int_dicts = None  # Per module, see main_analysis_modules
+SHM_PATH = '/dev/shm'  # The workers' rows are written there if it exists (RAM-backed)
+STORE_BATCH_SIZE = 1000  # Files per batch of main_analysis_store
+PDG_EXECUTOR = None  # See get_pdg_executor
+PDG_EXECUTOR_LOCK = threading.Lock()
+SRC_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
 
 class Analysis:
@@ -95,17 +111,115 @@ def main_analysis(js_dirs, js_files, labels_files, labels_dirs, level, features_
     start = timeit.default_timer()
 
     global features2int_dict
-    features2int_dict = pickle.load(open(features2int_dict_path, 'rb'))
+    features2int_dict = load_features2int_dict(features2int_dict_path, features_choice)
+    if features2int_dict is None:
+        return None
 
     if js_dirs is None and js_files is None:
         logging.error('Please, indicate a directory or a JS file to be analyzed')
         return None
 
+    files2do, labels = get_files2do(js_dirs, js_files, labels_files, labels_dirs)
+
+    arena_dir = get_tmp_dir('jstap_')
+    try:
+        chunks = get_features(files2do, labels, level, features_choice, n, arena_dir)
+        logging.debug('Got all features')
+        features_repr = get_features_representation(chunks)
+    finally:
+        shutil.rmtree(arena_dir, ignore_errors=True)
+
+    utility.micro_benchmark('Elapsed time for the input analysis (without features selection):',
+                            timeit.default_timer() - start)
+
+    return features_repr
+
+
+def main_analysis_store(js_dirs, labels_dirs, level, features_choice, n, features2int_dict_path,
+                        store_path, batch_size=STORE_BATCH_SIZE):
+    """
+        main_analysis for corpora whose features do not fit in memory: the features of each
+        batch of batch_size files are appended to the training set store_path (see
+        training_set.py) as soon as they are extracted, instead of being gathered in a CSR
+        matrix. Returns the number of samples in the store, or None.
+    """
+
+    start = timeit.default_timer()
+
+    global features2int_dict
+    features2int_dict = load_features2int_dict(features2int_dict_path, features_choice)
+    if features2int_dict is None:
+        return None
+
+    if js_dirs is None:
+        logging.error('Please, indicate a directory to be analyzed')
+        return None
+
+    files2do, labels = get_files2do(js_dirs, None, None, labels_dirs)
+    stored = training_set.get_stored_names(store_path, features2int_dict_path,
+                                           len(features2int_dict))
+    if stored:  # Their features are not extracted again
+        labels = [label for js_path, label in zip(files2do, labels) if js_path not in stored]
+        files2do = [js_path for js_path in files2do if js_path not in stored]
+        logging.info('%s files already in the training set %s', str(len(stored)), store_path)
+
+    arena_dir = get_tmp_dir('jstap_')
+    try:
+        training_set.append_chunks(store_path, iter_features(
+            files2do, labels, level, features_choice, n, arena_dir, batch_size=batch_size,
+            discard=True), features2int_dict_path, len(features2int_dict))
+    finally:
+        shutil.rmtree(arena_dir, ignore_errors=True)
+
+    utility.micro_benchmark('Elapsed time for the input analysis (without features selection):',
+                            timeit.default_timer() - start)
+
+    return training_set.load_store_meta(store_path)['nb_rows']
+
+
+def load_features2int_dict(features2int_dict_path, features_choice):
+    """ Loads the features dictionary, or its HashingVectorizer if utility.VECTORIZER_BITS is
+    set (then the dictionary is not loaded). Returns None if the features were not selected with
+    the current vectorizer. """
+
+    if utility.VECTORIZER_BITS is not None:
+        return features_hashing.get_vectorizer(features2int_dict_path)
+    features2int_dict = read_features2int_dict(features2int_dict_path)
+    if not features_hashing.check_features2int_dict(features2int_dict, features_choice):
+        return None
+    return features2int_dict
+
+
+def load_features2int_dicts(modules, features2int_dict_paths):
+    """ load_features2int_dict for several modules, given the path of the features dictionary
+    of each module. Returns a dict (key: module), or None if a dictionary could not be used. """
+
+    features2int_dicts_modules = dict()
+    for module, features2int_dict_path in zip(modules, features2int_dict_paths):
+        features2int_dicts_modules[module] = load_features2int_dict(features2int_dict_path,
+                                                                    module[1])
+        if features2int_dicts_modules[module] is None:
+            return None
+    return features2int_dicts_modules
+
+
+def read_features2int_dict(features2int_dict_path):
+    """ Features dictionary stored in features2int_dict_path, pickled or in a model bundle. """
+
+    if model_bundle.is_bundle(features2int_dict_path):
+        return model_bundle.load_features2int_dict(features2int_dict_path)
+    return pickle.load(open(features2int_dict_path, 'rb'))
+
+
+def get_files2do(js_dirs, js_files, labels_files, labels_dirs, skip_dirs=False):
+    """ Returns the list of files to analyze with the list of their labels ('?' if unknown).
+    Sub-directories of js_dirs are skipped if skip_dirs. """
+
     if js_files is not None:
-        files2do = js_files
+        files2do = list(js_files)
         if labels_files is None:
             labels_files = ['?' for _, _ in enumerate(js_files)]
-        labels = labels_files
+        labels = list(labels_files)
     else:
         files2do, labels = [], []
     if js_dirs is not None:
@@ -114,162 +228,303 @@ def main_analysis(js_dirs, js_files, labels_files, labels_dirs, level, features_
             labels_dirs = ['?' for _, _ in enumerate(js_dirs)]
         for cdir in js_dirs:
             for cfile in os.listdir(cdir):
+                if skip_dirs and os.path.isdir(os.path.join(cdir, cfile)):
+                    continue
                 files2do.append(os.path.join(cdir, cfile))
                 if labels_dirs is not None:
                     labels.append(labels_dirs[i])
             i += 1
 
-    analyses = get_features(files2do, labels, level, features_choice, n)
-    logging.debug('Got all features')
-    features_repr = get_features_representation(analyses)
+    return files2do, labels
 
-    utility.micro_benchmark('Elapsed time for the input analysis (without features selection):',
-                            timeit.default_timer() - start)
 
-    return features_repr
+def get_pdg_path(js_path):
+    """ Path of the PDG of js_path, as stored by pdg_generation/pdgs_generation.py. """
 
+    return os.path.join(os.path.dirname(js_path), 'Analysis', 'PDG',
+                        os.path.basename(js_path.replace('.js', '')))
 
-def worker_get_features_vector(my_queue, out_queue, except_queue):
-    """ Worker to get the features."""
 
-    while True:
-        try:
-            [analysis, level, features_choice, n] = my_queue.get(timeout=2)
-            try:
-                features = features_space.features_vector(analysis.pdg_path, level, features_choice,
-                                                          n, features2int_dict)
-                analysis.set_features(features)
-                out_queue.put(analysis)  # To share modified analysis object between processes
-            except Exception as e:  # Handle exception occurring in the processes spawned
-                logging.error('Something went wrong with %s', analysis.pdg_path)
-                print(e)
-                except_queue.put([analysis.pdg_path, e])
-        except queue.Empty:  # Empty queue exception
-            break
+def get_pdg(js_path, pdg_dir):
+    """ Builds the PDG of js_path and pickles it in pdg_dir. Returns its path, or None.
+    The PDGs generation times out with SIGALRM and its prints are redirected, which only work
+    in the main thread of a process: from another thread (e.g. the thread backend), the PDG is
+    built by the processes of get_pdg_executor. """
 
+    if threading.current_thread() is threading.main_thread():
+        return build_pdg(js_path, pdg_dir)
+    executor = get_pdg_executor()
+    try:
+        return executor.submit(build_pdg, js_path, pdg_dir).result()
+    except BrokenProcessPool:
+        reset_pdg_executor(executor)  # E.g. a segfault, the next PDGs get new processes
+        raise
 
-def get_features(files2do, labels, level, features_choice, n):
+
+def get_pdg_executor():
+    """ Processes building the PDGs for the threads, started once. """
+
+    global PDG_EXECUTOR
+    with PDG_EXECUTOR_LOCK:
+        if PDG_EXECUTOR is None:
+            PDG_EXECUTOR = parallel.get_executor('process', max(1, utility.NUM_WORKERS), None, ())
+        return PDG_EXECUTOR
+
+
+def reset_pdg_executor(executor):
+    """ Replaces executor, whose pool is broken, by a new one at the next get_pdg_executor. """
+
+    global PDG_EXECUTOR
+    with PDG_EXECUTOR_LOCK:
+        if PDG_EXECUTOR is executor:
+            PDG_EXECUTOR = None
+    executor.shutdown(wait=False)
+
+
+def build_pdg(js_path, pdg_dir):
+    """ get_pdg, in the main thread of the current process. """
+
+    pdg_generation_path = os.path.join(SRC_PATH, 'pdg_generation')
+    if pdg_generation_path not in sys.path:  # Once, build_pdg runs for each request of a service
+        sys.path.insert(0, pdg_generation_path)
+    import pdgs_generation
+
+    with contextlib.redirect_stdout(sys.stderr):  # stdout may carry the results
+        pdg = pdgs_generation.get_data_flow(js_path, benchmarks=dict())
+    if pdg is None:
+        return None
+    pdg_path = os.path.join(pdg_dir, uuid.uuid4().hex)
+    with open(pdg_path, 'wb') as pdg_file:
+        pickle.dump(pdg, pdg_file)
+    return pdg_path
+
+
+def main_analysis_modules(js_dirs, js_files, labels_files, labels_dirs, modules,
+                          features2int_dict_paths):
     """
-        Returns an analysis object with its features attribute filled
+        main_analysis for several modules at once: for each JS file, its features for all
+        modules are extracted together, i.e. the file is tokenized at most once and its PDG
+        (stored in <JS folder>/Analysis/PDG, see get_pdg_path) is loaded at most once.
+
+        -------
+        Parameters:
+        - js_dirs, js_files, labels_files, labels_dirs:
+            See main_analysis. Contain JS files, not PDGs.
+        - modules: list of (level, features_choice, n)
+            Modules to get the features of.
+        - features2int_dict_paths: list of str
+            Path of the features dictionary of each module.
+
+        -------
+        Returns:
+        - dict
+            Key: module (level, features_choice, n);
+            Value: [names, csr_matrix, labels], see main_analysis.
     """
 
-    my_queue = Queue()
-    out_queue = Queue()
-    except_queue = Queue()
-    workers = list()
+    start = timeit.default_timer()
+
+    if js_dirs is None and js_files is None:
+        logging.error('Please, indicate a directory or a JS file to be analyzed')
+        return None
+
+    global features2int_dicts
+    features2int_dicts = load_features2int_dicts(modules, features2int_dict_paths)
+    if features2int_dicts is None:
+        return None
 
-    logging.debug('Preparing processes to get all features')
+    files2do, labels = get_files2do(js_dirs, js_files, labels_files, labels_dirs, skip_dirs=True)
 
-    for i, _ in enumerate(files2do):
-        analysis = Analysis(pdg_path=files2do[i], label=labels[i])
-        my_queue.put([analysis, level, features_choice, n])
+    names_modules = {module: [[], []] for module in modules}
+    csr_builders = {module: features_space.CsrBuilder(len(features2int_dicts[module]))
+                    for module in modules}
 
-    for i in range(utility.NUM_WORKERS):
-        p = Process(target=worker_get_features_vector, args=(my_queue, out_queue, except_queue))
-        p.start()
-        workers.append(p)
+    for [file_id, rows] in parallel.parallel_imap(
+            partial(get_features_modules_file, modules=modules), list(enumerate(files2do)),
+            initializer=set_features2int_dicts, initargs=(features2int_dicts,)):
+        for module, row in rows.items():
+            if row is not None:
+                names_modules[module][0].append(files2do[file_id])
+                names_modules[module][1].append(labels[file_id])
+                csr_builders[module].add_row(*row)
 
-    analyses = list()
+    utility.micro_benchmark('Elapsed time for the input analysis of all modules:',
+                            timeit.default_timer() - start)
 
-    while True:
-        try:
-            analysis = out_queue.get(timeout=0.01)
-            analyses.append(analysis)
-        except queue.Empty:
-            pass
-        all_exited = True
-        for w in workers:  # Instead of join, as the worker cannot be joined when elements
-            # are still in except_queue or out_queue, so it deadlocks. But they must be
-            # joined before the elements are taken out of the queue
-            if w.exitcode is None:
-                all_exited = False
-                break
-        if all_exited & out_queue.empty():
-            break
-
-    return analyses
-
-
-def worker_features_representation(my_queue, out_queue):
-    """ Worker to represent the features in the corresponding form (list or CSR). """
-
-    analyses = list()
-    tab_res0 = list()
-    tab_res2 = list()
-    concat_features = None
-
-    while True:
+    return {module: [names_modules[module][0], csr_builders[module].get_csr(),
+                     names_modules[module][1]] for module in modules}
+
+
+def set_features2int_dicts(features2int_dicts_worker):
+    """ Sets features2int_dicts in the workers. """
+
+    global features2int_dicts
+    features2int_dicts = features2int_dicts_worker
+
+
+def get_features_modules_file(item, modules):
+    """ Gets the features vectors of a JS file for all modules. """
+
+    [file_id, js_path] = item
+    return [file_id, get_features_file_modules(js_path, modules)[1]]
+
+
+def get_features_file_modules(js_path, modules, pdg_dir=None, pdg_path=None, keep_pdg=False):
+    """
+        Features vectors of a JS file for several modules, with the features dictionaries of
+        features2int_dicts. Its PDG is read from pdg_path (per default, see get_pdg_path), or
+        built in pdg_dir if a module needs it and it does not exist.
+
+        -------
+        Parameters:
+        - js_path: str
+            JS file.
+        - modules: list of (level, features_choice, n)
+            Modules to get the features of.
+        - pdg_dir: str
+            Folder to build the missing PDG in (see get_tmp_dir), None not to build it.
+        - pdg_path: str
+            Path of the PDG of js_path, per default the stored one.
+        - keep_pdg: bool
+            If False, the PDG built is deleted once the features are extracted.
+
+        -------
+        Returns:
+        - PDG built: None if not built, False if it could not be, else its path;
+        - dict
+            Key: module; Value: (indices, data), or None if the features could not be extracted.
+    """
+
+    if pdg_path is None:
+        pdg_path = get_pdg_path(js_path)
+    pdg_built = None
+    if pdg_dir is not None and any(module[0] != 'tokens' for module in modules)\
+            and not os.path.isfile(pdg_path):
         try:
-            analysis = my_queue.get(timeout=2)
-            analyses.append(analysis)
-        except queue.Empty:  # Empty queue exception
-            break
+            pdg_path = pdg_built = get_pdg(js_path, pdg_dir)
+        except Exception as e:
+            logging.error('Could not build the PDG of %s: %s', js_path, e)
+            pdg_path = None
+        if pdg_path is None:
+            pdg_built = False
+    rows = {module: None for module in modules}
+    modules2do = [module for module in modules if module[0] == 'tokens' or pdg_path is not None]
+    try:
+        rows.update(features_space.features_vector_modules(js_path, pdg_path, modules2do,
+                                                           features2int_dicts))
+    except Exception as e:
+        logging.error('Something went wrong with %s: %s', js_path, e)
+    finally:
+        if pdg_built and not keep_pdg:
+            os.remove(pdg_built)
+    return pdg_built, rows
+
+
+def get_tmp_dir(prefix):
+    """ Creates a temporary folder, in SHM_PATH if it exists (RAM-backed). Returns its path. """
+
+    return tempfile.mkdtemp(prefix=prefix, dir=SHM_PATH if os.path.isdir(SHM_PATH) else None)
+
+
+def get_arena_paths(arena_dir, batch_id):
+    """ Paths of the files storing the indices and data of the rows of a batch. """
 
-    for analysis in analyses:
-        features = analysis.features
-        if features is not None:
-            tab_res0.append(analysis.pdg_path)
-            concat_features = sparse.vstack((concat_features, features), format='csr')
-            if concat_features is None or concat_features.nnz == 0:
-                logging.error('Something strange occurred for %s with the features ',
-                              analysis.pdg_path)
-                logging.error(concat_features)
-            tab_res2.append(analysis.label)
+    return os.path.join(arena_dir, str(batch_id) + '_indices'),\
+        os.path.join(arena_dir, str(batch_id) + '_data')
+
+
+def load_arena_array(path, dtype):
+    """ Memory-maps an array written by a worker. """
+
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def set_features2int_dict(features2int_dict_worker):
+    """ Sets features2int_dict in the workers. """
+
+    global features2int_dict
+    features2int_dict = features2int_dict_worker
 
-    logging.debug('Merged features in subprocess')
 
-    out_queue.put([tab_res0, tab_res2, concat_features])
+def get_features_batch(batch, level, features_choice, n, arena_dir):
+    """ Gets the features of a batch of files. The rows are written to the batch's arena files,
+    only the batch's id, the files' id and the rows' size are sent back. """
 
+    [batch_id, files] = batch
+    file_ids, rows_nnz = list(), list()
+    indices_path, data_path = get_arena_paths(arena_dir, batch_id)
 
-def get_features_representation(analyses):
+    with open(indices_path, 'wb') as indices_file, open(data_path, 'wb') as data_file:
+        for [file_id, pdg_path] in files:
+            try:
+                features = features_space.features_vector(pdg_path, level, features_choice,
+                                                          n, features2int_dict)
+            except Exception as e:
+                logging.error('Something went wrong with %s: %s', pdg_path, e)
+                continue
+            if features is not None:
+                indices, data = features
+                indices_file.write(indices.astype(np.int32).tobytes())
+                data_file.write(data.astype(np.float64).tobytes())
+                file_ids.append(file_id)
+                rows_nnz.append(len(indices))
+
+    return [batch_id, file_ids, rows_nnz]
+
+
+def get_features(files2do, labels, level, features_choice, n, arena_dir):
     """
-        Returns the features representation used in the ML modules.
+        Returns one chunk [names, labels, indptr, indices, data] per batch of files, with the
+        features of the valid files. The indices and data are memory-mapped from arena_dir.
     """
 
-    my_queue = Queue()
-    out_queue = Queue()
-    workers = list()
+    return list(iter_features(files2do, labels, level, features_choice, n, arena_dir))
 
-    tab_res = [[], [], []]
-    concat_features = None
 
-    logging.debug('Preparing processes to merge all features efficiently')
+def iter_features(files2do, labels, level, features_choice, n, arena_dir, batch_size=None,
+                  discard=False):
+    """ get_features, yielding the chunks as the batches of batch_size files (per default, as
+    many batches as workers) are processed. If discard, the arena files of a chunk are deleted
+    once the next one is asked for. """
 
-    for i, _ in enumerate(analyses):
-        analysis = analyses[i]
-        my_queue.put(analysis)
+    logging.debug('Preparing workers to get all features')
 
-    for i in range(utility.NUM_WORKERS):
-        p = Process(target=worker_features_representation, args=(my_queue, out_queue))
-        p.start()
-        workers.append(p)
+    if batch_size is None:
+        batch_size = parallel.get_chunksize(files2do, utility.NUM_WORKERS)
+    batches = enumerate(parallel.get_chunks(enumerate(files2do), batch_size))
 
-    while True:
-        try:
-            # Get modified analysis objects
-            [tab_res0, tab_res2, features] = out_queue.get(timeout=0.01)
-            if features is not None and features.nnz > 0:
-                tab_res[0].extend(tab_res0)
-                tab_res[2].extend(tab_res2)
-                try:
-                    concat_features = sparse.vstack((concat_features, features), format='csr')
-                except ValueError:
-                    logging.error('Problem to merge %s with %s', concat_features, features)
-            logging.debug('Merged features in main process')
-        except queue.Empty:
-            pass
-        all_exited = True
-        for w in workers:  # Instead of join, as the worker cannot be joined when elements
-            # are still in except_queue or out_queue, so it deadlocks. But they must be
-            # joined before the elements are taken out of the queue
-            if w.exitcode is None:
-                all_exited = False
-                break
-        if all_exited & out_queue.empty():
-            break
-
-    tab_res[1].append(concat_features)
-    tab_res[1] = tab_res[1][0]
+    for [batch_id, file_ids, rows_nnz] in parallel.parallel_imap(
+            partial(get_features_batch, level=level, features_choice=features_choice, n=n,
+                    arena_dir=arena_dir), batches, chunksize=1,
+            initializer=set_features2int_dict, initargs=(features2int_dict,)):
+        indices_path, data_path = get_arena_paths(arena_dir, batch_id)
+        indptr = np.zeros(len(rows_nnz) + 1, dtype=np.int64)
+        np.cumsum(rows_nnz, out=indptr[1:])
+        yield [[files2do[i] for i in file_ids], [labels[i] for i in file_ids], indptr,
+               load_arena_array(indices_path, np.int32)[:indptr[-1]],
+               load_arena_array(data_path, np.float64)[:indptr[-1]]]
+        if discard:
+            os.remove(indices_path)
+            os.remove(data_path)
+
+
+def get_features_representation(chunks):
+    """
+        Returns the features representation used in the ML modules: the chunks from the workers
+        are concatenated once into a CSR matrix.
+    """
+
+    tab_res = [[], None, []]
+    csr_builder = features_space.CsrBuilder(len(features2int_dict))
+
+    for [names, labels, indptr, indices, data] in chunks:
+        tab_res[0].extend(names)
+        tab_res[2].extend(labels)
+        csr_builder.add_chunk(indptr, indices, data)
+
+    tab_res[1] = csr_builder.get_csr()
 
     if len(tab_res[0]) != tab_res[1].shape[0] or len(tab_res[0]) != len(tab_res[2])\
             or tab_res[1].shape[0] != len(tab_res[2]):
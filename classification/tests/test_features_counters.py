@@ -0,0 +1,78 @@
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    Merging on-disk counters (features_counters.ShardedCounter) counts each sample once,
+    whatever the compactions in between.
+"""
+
+import features_counters
+
+
+def get_counter(path, samples):
+    """ Counter of path, in which samples (lists of features) are counted. """
+
+    counter = features_counters.ShardedCounter(str(path), nb_shards=4, max_entries=3)
+    for features in samples:
+        counter.add(features)
+    counter.flush()
+    return counter
+
+
+def test_merge_compact_merge(tmp_path):
+    other = get_counter(tmp_path / 'other', [['a', 'b'], ['b', ('c', 1)], ['d']])
+    counter = get_counter(tmp_path / 'counter', [['a']])
+    counter.merge(other.path)
+    counter.compact()
+    other.compact()
+    counter.merge(other.path)  # Nothing new
+    counter.compact()
+    counter.merge(other.path)
+    assert counter.get_features() == {'a': 2, 'b': 2, ('c', 1): 1, 'd': 1}
+    assert counter.get_nb_samples() == 4
+
+
+def test_merge_new_samples(tmp_path):
+    other = get_counter(tmp_path / 'other', [['a', 'b']])
+    counter = get_counter(tmp_path / 'counter', [])
+    counter.merge(other.path)
+    counter.compact()
+    other.add(['b', 'c'])
+    other.flush()
+    counter.merge(other.path)  # Only the new flush
+    assert counter.get_features() == {'a': 1, 'b': 2, 'c': 1}
+    assert counter.get_nb_samples() == 2
+
+
+def test_merge_compacted_new_samples(tmp_path):
+    """ Refused, as the counts already merged cannot be told from the new ones. """
+
+    other = get_counter(tmp_path / 'other', [['a', 'b']])
+    counter = get_counter(tmp_path / 'counter', [])
+    counter.merge(other.path)
+    other.add(['a'])
+    other.compact()
+    counter.merge(other.path)
+    assert counter.get_features() == {'a': 1, 'b': 1}
+    assert counter.get_nb_samples() == 1
+
+
+def test_merge_counters(tmp_path):
+    paths = [str(tmp_path / str(i)) for i in range(3)]
+    for i, path in enumerate(paths):
+        get_counter(path, [['x', i]] * (i + 1))
+    features_counters.merge_counters(str(tmp_path / 'all'), paths + paths)
+    counter = features_counters.ShardedCounter(str(tmp_path / 'all'))
+    assert counter.get_features() == {'x': 6, 0: 1, 1: 2, 2: 3}
+    assert counter.get_nb_samples() == 6
@@ -0,0 +1,62 @@
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    The features preselection counts the features of the corpus it analyzes, not adding them to
+    the counts of a former analysis.
+"""
+
+import os
+import pickle
+
+import features_counters
+import features_preselection
+from test_traversals import get_random_pdg
+
+
+def write_pdgs(pdg_dir, seeds):
+    """ Pickles a random PDG per seed in pdg_dir. """
+
+    os.makedirs(pdg_dir, exist_ok=True)
+    for seed in seeds:
+        with open(os.path.join(pdg_dir, str(seed)), 'wb') as pdg_file:
+            pickle.dump(get_random_pdg(30, 0.3, 5, seed), pdg_file)
+
+
+def get_counts(analysis_path):
+    """ Counts of the features of the benign folder, with the number of files. """
+
+    counter_path = features_counters.get_counter_path(
+        os.path.join(analysis_path, 'ngrams', 'ast_all_features_benign'))
+    counter = features_counters.ShardedCounter(counter_path)
+    return counter.get_features(), counter.get_nb_samples()
+
+
+def test_preselection_twice(tmp_path):
+    pdg_dir, analysis_path = str(tmp_path / 'benign'), str(tmp_path / 'Features')
+    write_pdgs(pdg_dir, range(5))
+    features_preselection.handle_features_all([pdg_dir], ['benign'], 'ast', 'ngrams',
+                                              analysis_path)
+    counts, nb_samples = get_counts(analysis_path)
+    assert nb_samples == 5 and counts
+    features_preselection.handle_features_all([pdg_dir], ['benign'], 'ast', 'ngrams',
+                                              analysis_path)
+    assert get_counts(analysis_path) == (counts, nb_samples)
+
+    write_pdgs(pdg_dir, range(5, 7))  # Another corpus
+    os.remove(os.path.join(pdg_dir, '0'))
+    features_preselection.handle_features_all([pdg_dir], ['benign'], 'ast', 'ngrams',
+                                              analysis_path)
+    assert get_counts(analysis_path)[1] == 6
+    assert os.listdir(os.path.join(analysis_path, 'ngrams')) == ['ast_all_features_benign_counts']
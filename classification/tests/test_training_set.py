@@ -0,0 +1,84 @@
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    The out-of-core training (machine_learning.fit_out_of_core) trains on stratified shards of
+    the training set, and its peak memory does not grow with the number of samples.
+"""
+
+import tracemalloc
+import numpy as np
+import pytest
+
+import benchmark
+import training_set
+import machine_learning
+
+
+SHARD_SIZE = 1000
+NNZ = 50  # Non-zero values per row on average, i.e. about 600 bytes per row in the store
+
+
+@pytest.mark.parametrize('nb_samples, ratio', [(10000, 0.5), (9999, 0.1), (2500, 0.01)])
+def test_shards_stratified(nb_samples, ratio):
+    is_malicious = np.random.RandomState(0).random_sample(nb_samples) < ratio
+    shards = training_set.get_shards(is_malicious, SHARD_SIZE)
+    assert len(shards) == -(-nb_samples // SHARD_SIZE)
+    assert (np.sort(np.concatenate(shards)) == np.arange(nb_samples)).all()
+    assert all(len(rows) <= SHARD_SIZE for rows in shards)
+    assert all((np.diff(rows) > 0).all() for rows in shards)
+    nb_malicious = [is_malicious[rows].sum() for rows in shards]
+    assert max(nb_malicious) - min(nb_malicious) <= 1
+
+
+def test_single_label_shards(tmp_path, caplog):
+    store_path = str(tmp_path / 'store')
+    nb_samples = 3 * SHARD_SIZE
+    features_path = store_path + '_features'
+    with open(features_path, 'w') as features_file:
+        features_file.write('8')
+    rng = np.random.RandomState(0)
+    labels = ['malicious' if i < 2 else 'benign' for i in range(nb_samples)]  # Fewer than shards
+    rows = [[str(i) for i in range(nb_samples)], labels, np.arange(nb_samples + 1),
+            rng.randint(0, 8, nb_samples).astype(np.int32), rng.random_sample(nb_samples)]
+    training_set.append_chunks(store_path, [rows], features_path, 8)
+    trained = machine_learning.fit_out_of_core(store_path, 10, SHARD_SIZE)
+    assert trained.n_estimators == 10  # The trees of the unused shard go to the other ones
+    assert '1 of the 3 shards' in caplog.text
+
+
+def get_fit_peak(store_path, estimators):
+    """ Peak of the memory allocated by fit_out_of_core, in bytes. """
+
+    tracemalloc.start()
+    try:
+        assert machine_learning.fit_out_of_core(store_path, estimators, SHARD_SIZE) is not None
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_fit_out_of_core_memory(tmp_path):
+    peaks, stores_size = list(), list()
+    for nb_samples in [4 * SHARD_SIZE, 8 * SHARD_SIZE, 16 * SHARD_SIZE]:
+        store_path = str(tmp_path / str(nb_samples))
+        benchmark.build_random_store(store_path, nb_samples, 2 ** 16, nnz=NNZ)
+        if not peaks:  # Not measured, the first fit imports the lazily loaded modules
+            machine_learning.fit_out_of_core(store_path, 16, SHARD_SIZE)
+        peaks.append(get_fit_peak(store_path, 16))
+        stores_size.append(training_set.load_store_meta(store_path)['nnz'] * 12)
+    for i in range(1, len(peaks)):
+        # Only the per-sample labels and offsets grow, not the loaded rows
+        assert peaks[i] - peaks[i - 1] < 0.1 * (stores_size[i] - stores_size[i - 1])
+    assert peaks[-1] < stores_size[-1] / 2
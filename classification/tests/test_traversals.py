@@ -0,0 +1,138 @@
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    The iterative traversals of features_ngrams and features_value give the same features as
+    the recursive ones (recursive_ngrams and recursive_value) on random synthetic PDGs.
+"""
+
+import sys
+
+import numpy as np
+import pytest
+
+import features_ngrams
+import features_value
+import features_counting
+import recursive_ngrams
+import recursive_value
+
+
+Node = features_ngrams._node.Node
+Dependence = features_ngrams._node.Dependence
+
+LEVELS = ('ast', 'cfg', 'pdg-dfg', 'pdg', 'pdg-cfg-ast', 'pdg-ast')
+INNER_NAMES = ['ExpressionStatement', 'CallExpression', 'MemberExpression', 'BinaryExpression',
+               'VariableDeclaration', 'IfStatement', 'AssignmentExpression', 'ReturnStatement']
+LITERALS = ['eval', 'x', '', 0, 7, 2.5, True, None]
+
+
+def get_random_pdg(nb_nodes, depth_bias, nb_deps, seed):
+    """ Synthetic PDG: a random AST of nb_nodes nodes (each new node being a child of the last
+    inner node with probability depth_bias, of a random one otherwise), and nb_deps random
+    control and data dependencies between its nodes, cycles included. """
+
+    rng = np.random.RandomState(seed)
+    inner_nodes, leaves = [Node('Program')], list()
+    for i in range(nb_nodes):
+        if rng.random_sample() < depth_bias:
+            parent = inner_nodes[-1]
+        else:
+            parent = inner_nodes[rng.randint(len(inner_nodes))]
+        kind = rng.randint(4)
+        if kind == 0:
+            node = Node('Identifier', parent)
+            node.set_attribute('name', 'v' + str(rng.randint(20)))
+            leaves.append(node)
+        elif kind == 1:
+            node = Node('Literal', parent)
+            if rng.random_sample() < 0.9:
+                node.set_attribute('value', LITERALS[rng.randint(len(LITERALS))])
+            else:
+                node.set_attribute('regex', '/a/')
+            leaves.append(node)
+        else:
+            node = Node(INNER_NAMES[rng.randint(len(INNER_NAMES))], parent)
+            inner_nodes.append(node)
+        parent.set_child(node)
+
+    nodes = inner_nodes[1:] + leaves
+    if leaves and nodes:
+        for _ in range(nb_deps):
+            begin, end = nodes[rng.randint(len(nodes))], nodes[rng.randint(len(nodes))]
+            if rng.random_sample() < 0.5:
+                begin.control_dep_children.append(Dependence('control dependency', end, True))
+            else:
+                begin.data_dep_children.append(
+                    Dependence('data dependency', end, 'data', leaves[rng.randint(len(leaves))],
+                               leaves[rng.randint(len(leaves))]))
+    return inner_nodes[0]
+
+
+def get_random_pdgs():
+    """ Parameters of the random PDGs: from a few nodes to deep and wide ones. """
+
+    rng = np.random.RandomState(0)
+    return [(int(rng.randint(5, 1500)), float(rng.choice([0.2, 0.6, 0.95])),
+             int(rng.randint(0, 300)), seed) for seed in range(60)]
+
+
+@pytest.fixture(autouse=True)
+def recursion_limit():
+    """ The recursive oracles go as deep as the PDGs. """
+
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, 100000))
+    yield
+    sys.setrecursionlimit(limit)
+
+
+@pytest.mark.parametrize('nb_nodes, depth_bias, nb_deps, seed', get_random_pdgs())
+def test_ngrams(nb_nodes, depth_bias, nb_deps, seed):
+    pdg = get_random_pdg(nb_nodes, depth_bias, nb_deps, seed)
+    for level in LEVELS:
+        expected = recursive_ngrams.get_syntactic_features(pdg, level)
+        features_list = features_ngrams.get_syntactic_features(pdg, level)
+        assert features_list == expected, level
+        assert features_counting.count_ngrams_list(
+            features_ngrams.units2int(features_list, level), 4) == \
+            features_counting.count_ngrams_list(features_ngrams.units2int(expected, level), 4)
+
+
+@pytest.mark.parametrize('nb_nodes, depth_bias, nb_deps, seed', get_random_pdgs())
+def test_value(nb_nodes, depth_bias, nb_deps, seed):
+    pdg = get_random_pdg(nb_nodes, depth_bias, nb_deps, seed)
+    for level in LEVELS:
+        expected = recursive_value.get_syntactic_features(pdg, level)
+        features_list = features_value.get_syntactic_features(pdg, level)
+        assert features_list == expected, level
+        assert features_counting.count_value_list(
+            features_value.units2int(features_list, level)) == \
+            features_counting.count_value_list(features_value.units2int(expected, level))
+
+
+@pytest.mark.parametrize('nb_nodes, depth_bias, nb_deps, seed', get_random_pdgs()[:20])
+def test_levels(nb_nodes, depth_bias, nb_deps, seed):
+    """ Several levels extracted at once, the n-grams units being shared with the value
+    traversals, as in features_counting.get_units_modules. """
+
+    pdg = get_random_pdg(nb_nodes, depth_bias, nb_deps, seed)
+    names_levels = dict()
+    value_levels = features_value.get_syntactic_features_levels(pdg, LEVELS,
+                                                                names_levels=names_levels)
+    ngrams_levels = features_ngrams.get_syntactic_features_levels(pdg, LEVELS,
+                                                                  features_levels=names_levels)
+    for level in LEVELS:
+        assert value_levels[level] == recursive_value.get_syntactic_features(pdg, level)
+        assert ngrams_levels[level] == recursive_ngrams.get_syntactic_features(pdg, level)
@@ -0,0 +1,279 @@
+# Copyright (C) 2019 Aurore Fass
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+    On-disk store of the training samples of a model, to which the newly labelled samples are
+    appended, and which is memory-mapped to train the model. Layout:
+        * indices, data: int32 columns and float64 values of the rows, appended as raw bytes;
+        * rows_nnz: int64, number of non-zero values of each row;
+        * samples.jsonl: [name, label] of each row;
+        * store.json: number of rows and of non-zero values committed (written last, so that
+        an interrupted append is ignored), number of features and digest of the features
+        dictionary the rows were computed with.
+"""
+
+import os
+import json
+import logging
+import itertools
+import numpy as np
+from scipy.sparse import csr_matrix
+
+import utility
+import features_cache
+
+
+ARRAYS = [('indices', np.int32), ('data', np.float64), ('rows_nnz', np.int64)]
+
+
+def get_store_meta(features2int_dict_path, nb_features):
+    """ What the rows of a store depend on, besides their files. """
+
+    return {'features_digest': features_cache.file_digest(features2int_dict_path),
+            'nb_features': nb_features, 'hash_bits': utility.HASH_BITS,
+            'vectorizer_bits': utility.VECTORIZER_BITS}
+
+
+def load_store_meta(store_path):
+    """ Content of store.json, or None if there is no store in store_path. """
+
+    meta_path = os.path.join(store_path, 'store.json')
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path) as meta_file:
+        return json.load(meta_file)
+
+
+def get_stored_names(store_path, features2int_dict_path, nb_features):
+    """ Names of the samples of the store store_path, i.e. which would not be appended again;
+    none if the store was computed with other features (it would be emptied). """
+
+    meta = load_store_meta(store_path)
+    new_meta = get_store_meta(features2int_dict_path, nb_features)
+    if meta is None or any(meta[key] != value for key, value in new_meta.items()):
+        return set()
+    return set(name for name, _ in itertools.islice(iter_samples(store_path), meta['nb_rows']))
+
+
+def truncate_store(store_path, meta):
+    """ Drops what an interrupted append wrote after the rows committed in meta. """
+
+    sizes = {'indices': meta['nnz'] * 4, 'data': meta['nnz'] * 8, 'rows_nnz': meta['nb_rows'] * 8}
+    for name, _ in ARRAYS:
+        with open(os.path.join(store_path, name), 'ab') as array_file:
+            array_file.truncate(sizes[name])
+    with open(os.path.join(store_path, 'samples.jsonl'), 'r+') as samples_file:
+        for _ in range(meta['nb_rows']):
+            samples_file.readline()
+        samples_file.truncate(samples_file.tell())
+
+
+def append_training_set(store_path, names, labels, attributes, features2int_dict_path):
+    """
+        Appends samples to the store store_path, except the ones already in it (same name).
+        The store is emptied first if its rows were computed with another features dictionary.
+
+        -------
+        Parameters:
+        - store_path: str
+            Folder of the store.
+        - names, labels, attributes:
+            Samples to append, see static_analysis.main_analysis.
+        - features2int_dict_path: str
+            Path of the features dictionary the attributes were computed with.
+    """
+
+    attributes = csr_matrix(attributes)
+    append_chunks(store_path, [[names, labels, attributes.indptr, attributes.indices,
+                                attributes.data]], features2int_dict_path, attributes.shape[1])
+
+
+def append_chunks(store_path, chunks, features2int_dict_path, nb_features):
+    """ append_training_set for chunks [names, labels, indptr, indices, data] of rows, e.g. as
+    yielded by static_analysis.iter_features; only one chunk is held in memory at a time. """
+
+    new_meta = get_store_meta(features2int_dict_path, nb_features)
+    meta = load_store_meta(store_path)
+    if meta is not None and any(meta[key] != value for key, value in new_meta.items()):
+        logging.info('The features changed, the training set %s is emptied', store_path)
+        meta = None
+    os.makedirs(store_path, exist_ok=True)
+    if meta is None:
+        meta = dict(new_meta, nb_rows=0, nnz=0)
+        for name in [name for name, _ in ARRAYS] + ['samples.jsonl']:
+            open(os.path.join(store_path, name), 'w').close()
+    truncate_store(store_path, meta)
+
+    stored = set(name for name, _ in iter_samples(store_path))
+    nb_rows, nb_skipped = meta['nb_rows'], 0
+    with open(os.path.join(store_path, 'indices'), 'ab') as indices_file,\
+            open(os.path.join(store_path, 'data'), 'ab') as data_file,\
+            open(os.path.join(store_path, 'rows_nnz'), 'ab') as rows_nnz_file,\
+            open(os.path.join(store_path, 'samples.jsonl'), 'a') as samples_file:
+        for [names, labels, indptr, indices, data] in chunks:
+            keep = np.zeros(len(names), dtype=bool)
+            for i, name in enumerate(names):
+                keep[i] = name not in stored
+                stored.add(name)
+            nb_skipped += len(names) - int(keep.sum())
+            rows_nnz = np.diff(np.asarray(indptr, dtype=np.int64))
+            values = np.repeat(keep, rows_nnz)  # Non-zero values of the rows kept
+            start = int(indptr[0])
+            indices_file.write(np.asarray(indices[start:start + len(values)],
+                                          dtype=np.int32)[values].tobytes())
+            data_file.write(np.asarray(data[start:start + len(values)],
+                                       dtype=np.float64)[values].tobytes())
+            rows_nnz_file.write(rows_nnz[keep].tobytes())
+            samples_file.writelines(json.dumps([names[i], labels[i]]) + '\n'
+                                    for i in np.flatnonzero(keep))
+            meta['nb_rows'] += int(keep.sum())
+            meta['nnz'] += int(rows_nnz[keep].sum())
+
+    with open(os.path.join(store_path, 'store.json.tmp'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(os.path.join(store_path, 'store.json.tmp'), os.path.join(store_path, 'store.json'))
+    if nb_skipped:
+        logging.info('%s samples already in the training set %s', str(nb_skipped), store_path)
+    logging.info('%s samples appended to the training set %s (%s samples)',
+                 str(meta['nb_rows'] - nb_rows), store_path, str(meta['nb_rows']))
+
+
+def iter_samples(store_path):
+    """ Yields the [name, label] of the samples of a store, in the order of its rows. """
+
+    with open(os.path.join(store_path, 'samples.jsonl')) as samples_file:
+        for line in samples_file:
+            yield json.loads(line)
+
+
+def load_arrays(store_path, meta):
+    """ Memory-maps the indices, data and rows_nnz of the rows committed in meta. """
+
+    arrays = dict()
+    for name, dtype in ARRAYS:
+        path = os.path.join(store_path, name)
+        arrays[name] = np.memmap(path, dtype=dtype, mode='r') if os.path.getsize(path)\
+            else np.zeros(0, dtype=dtype)
+    return arrays['indices'][:meta['nnz']], arrays['data'][:meta['nnz']],\
+        arrays['rows_nnz'][:meta['nb_rows']]
+
+
+def load_training_set(store_path):
+    """
+        Loads the samples of the store store_path, their features being memory-mapped.
+
+        -------
+        Returns:
+        - list: names of the samples;
+        - csr_matrix: their features, one row per sample;
+        - list: their labels.
+        - or None if there is no store in store_path.
+    """
+
+    meta = load_store_meta(store_path)
+    if meta is None:
+        logging.error('No training set in %s', store_path)
+        return None
+    indices, data, rows_nnz = load_arrays(store_path, meta)
+    indptr = np.zeros(meta['nb_rows'] + 1, dtype=np.int32 if meta['nnz'] < 2 ** 31 else np.int64)
+    np.cumsum(rows_nnz, out=indptr[1:])
+    if indptr.dtype == np.int64:
+        indices = indices.astype(np.int64)  # Same dtype as indptr, otherwise scipy copies both
+    attributes = csr_matrix((data, indices, indptr), shape=(meta['nb_rows'], meta['nb_features']),
+                            copy=False)
+
+    names, labels = list(), list()
+    for name, label in iter_samples(store_path):
+        if len(names) == meta['nb_rows']:
+            break
+        names.append(name)
+        labels.append(label)
+    return names, attributes, labels
+
+
+def get_nb_shards(store_path, shard_size):
+    """ Number of shards of at most shard_size samples of the store store_path. """
+
+    return -(-load_store_meta(store_path)['nb_rows'] // shard_size)
+
+
+def load_labels(store_path):
+    """ Labels of the samples of the store store_path, as one boolean per sample (True if
+    malicious). """
+
+    meta = load_store_meta(store_path)
+    is_malicious = np.zeros(meta['nb_rows'], dtype=bool)
+    for i, (_, label) in zip(range(meta['nb_rows']), iter_samples(store_path)):
+        is_malicious[i] = label == 'malicious'
+    return is_malicious
+
+
+def get_shards(is_malicious, shard_size, seed=0):
+    """
+        Splits samples at random into shards of at most shard_size samples, stratified: the
+        samples of each label are shuffled and dealt in turn to the shards, so that each shard
+        has both labels in their proportions (unless a label has fewer samples than there are
+        shards).
+
+        -------
+        Parameters:
+        - is_malicious: np.array
+            Label of each sample, see load_labels.
+
+        -------
+        Returns:
+        - list of np.array
+            Sorted rows of each shard.
+    """
+
+    nb_shards = -(-len(is_malicious) // shard_size)
+    random_state = np.random.RandomState(seed)
+    rows = np.concatenate([random_state.permutation(np.flatnonzero(is_malicious == label))
+                           for label in [True, False]])
+    return [np.sort(rows[shard::nb_shards]) for shard in range(nb_shards)]
+
+
+def iter_shards(store_path, shards, is_malicious):
+    """
+        Yields the samples of the store store_path by shards (see get_shards). Only one shard is
+        loaded in memory at a time: its rows are gathered from the memory-mapped store.
+
+        -------
+        Parameters:
+        - shards: list of np.array
+            Sorted rows of each shard, so that the store is read sequentially.
+        - is_malicious: np.array
+            Label of each sample, see load_labels.
+
+        -------
+        Returns:
+        - generator of (csr_matrix, np.array)
+            Features and labels of the samples of each shard.
+    """
+
+    meta = load_store_meta(store_path)
+    indices, data, rows_nnz = load_arrays(store_path, meta)
+    indptr = np.zeros(meta['nb_rows'] + 1, dtype=np.int64)
+    np.cumsum(rows_nnz, out=indptr[1:])
+
+    for shard_rows in shards:
+        shard_nnz = rows_nnz[shard_rows]
+        shard_indptr = np.zeros(len(shard_rows) + 1, dtype=np.int64)
+        np.cumsum(shard_nnz, out=shard_indptr[1:])
+        # Position in the store of each non-zero value of the shard
+        positions = np.repeat(indptr[shard_rows] - shard_indptr[:-1], shard_nnz)\
+            + np.arange(shard_indptr[-1])
+        yield csr_matrix((data[positions], indices[positions], shard_indptr),
+                         shape=(len(shard_rows), meta['nb_features'])),\
+            np.where(is_malicious[shard_rows], 'malicious', 'benign')
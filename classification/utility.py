@@ -22,6 +22,10 @@ import logging
 
 
 NUM_WORKERS = 2
+BACKEND = 'process'  # Either 'process', 'thread' or 'serial', see parallel.py
+CACHE_DIR = None  # Directory of the features cache, see features_cache.py; None to disable it
+HASH_BITS = None  # Size of the value features' hashes, see features_hashing.py; None to disable
+VECTORIZER_BITS = None  # 2^VECTORIZER_BITS buckets, see features_hashing.py; None to disable
 SRC_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
 
@@ -49,6 +53,16 @@ def micro_benchmark(message, elapsed_time):
     return timeit.default_timer()
 
 
+def get_peak_memory():
+    """ Peak resident memory of the process so far, in MB, or None if not available. """
+
+    try:
+        import resource
+    except ImportError:  # Not on Windows
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # In KB on Linux
+
+
 def check_folder_exists(folder_path):
     """ Checks if folder exists, otherwise create it. """
 
@@ -97,6 +111,23 @@ def parsing_commands(parser):
     parser.add_argument('--features', metavar='FEATURES_CHOICE', type=str, nargs=1,
                         choices=['ngrams', 'value'],
                         help='features\'s choice (ngrams, value)')
+    parser.add_argument('--workers', metavar='INTEGER', type=int, nargs=1, default=[NUM_WORKERS],
+                        help='number of workers to extract the features with')
+    parser.add_argument('--backend', metavar='BACKEND', type=str, nargs=1, default=[BACKEND],
+                        choices=['process', 'thread', 'serial'],
+                        help='how the workers run (process, thread, serial)')
+    parser.add_argument('--cache', metavar='DIR', type=str, nargs=1, default=[CACHE_DIR],
+                        help='folder to cache the features of each file in; per default, the '
+                             'features are not cached')
+    parser.add_argument('--hash_bits', metavar='INTEGER', type=int, nargs=1, default=[HASH_BITS],
+                        choices=range(8, 65),
+                        help='replaces the (context, value) features by their hash on '
+                             'HASH_BITS bits (between 8 and 64); per default, the features '
+                             'are not hashed')
+    parser.add_argument('--vectorizer_bits', metavar='INTEGER', type=int, nargs=1,
+                        default=[VECTORIZER_BITS], choices=range(8, 29),
+                        help='maps the features to 2^VECTORIZER_BITS buckets (between 8 and 28) '
+                             'with a hashing vectorizer instead of the features dictionary')
 
     return parser
 
@@ -115,6 +146,58 @@ def control_logger(logging_level):
                         level=logging.getLevelName(logging_level * 10))
 
 
+def control_parallelism(workers, backend):
+    """
+        Sets the number of workers and their backend used by parallel.py.
+
+        -------
+        Parameters:
+        - workers: int
+            Number of workers.
+        - backend: str
+            Either 'process', 'thread' or 'serial'.
+    """
+
+    global NUM_WORKERS, BACKEND
+    NUM_WORKERS = workers
+    BACKEND = backend
+
+
+def control_cache(cache_dir):
+    """ Sets the directory of the features cache (None or 'None' to disable it). """
+
+    global CACHE_DIR
+    CACHE_DIR = None if cache_dir in (None, 'None') else cache_dir
+
+
+def control_hashing(hash_bits):
+    """ Sets the size of the value features' hashes (None to disable the hashing mode). """
+
+    global HASH_BITS
+    HASH_BITS = hash_bits
+
+
+def control_vectorizer(vectorizer_bits):
+    """ Sets the number of bits of the hashing vectorizer (None to use the features
+    dictionary). """
+
+    global VECTORIZER_BITS
+    VECTORIZER_BITS = vectorizer_bits
+
+
+def get_config():
+    """ Returns the configuration set in the current process, to be passed to the workers. """
+
+    return {'NUM_WORKERS': NUM_WORKERS, 'BACKEND': BACKEND, 'CACHE_DIR': CACHE_DIR,
+            'HASH_BITS': HASH_BITS, 'VECTORIZER_BITS': VECTORIZER_BITS}
+
+
+def set_config(config):
+    """ Sets a configuration obtained with get_config, e.g. in a worker process. """
+
+    globals().update(config)
+
+
 def check_params(level, features_choice):
     """ Generic parameters checks before running. """
 